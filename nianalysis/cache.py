@@ -0,0 +1,422 @@
+import os
+import os.path
+import errno
+import shutil
+import hashlib
+import json
+import tempfile
+import logging
+import pydicom
+from pydicom.errors import InvalidDicomError
+from nipype.interfaces.base import isdefined
+
+
+logger = logging.getLogger('arcana')
+
+# Shared directory in which the results of registrations are cached so that
+# re-derivations and sibling studies don't need to re-register the same
+# images (disabled if not set), and its maximum size in GB
+REGISTRATION_CACHE_DIR = os.environ.get('NIANALYSIS_REGISTRATION_CACHE', None)
+REGISTRATION_CACHE_SIZE = float(
+    os.environ.get('NIANALYSIS_REGISTRATION_CACHE_SIZE', 20))
+
+# Shared directory in which the timing information read from the headers of
+# PET list-mode files is cached (disabled if not set)
+LIST_MODE_CACHE_DIR = os.environ.get('NIANALYSIS_LIST_MODE_CACHE', None)
+
+# File in which the versions and executable paths resolved for required
+# tools are stored so they are probed once per machine instead of once per
+# process (only cached in memory if not set)
+REQUIREMENT_CACHE_PATH = os.environ.get('NIANALYSIS_REQUIREMENT_CACHE', None)
+
+# Digests of files that have already been hashed, keyed by path, size and
+# modification time
+_file_digests = {}
+
+
+class FileCache(object):
+    """
+    A content-addressed cache of files stored in a shared directory. Each
+    entry is stored in a sub-directory named after the hash of its key and
+    entries are evicted in least-recently-used order once the total size of
+    the cache exceeds 'max_size'
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the directory the cache is stored in (created if it doesn't
+        exist)
+    max_size : int | None
+        The maximum size (in bytes) of the cache. If None the cache is never
+        pruned
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def entry_path(self, key):
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def fetch(self, key):
+        """
+        Returns the paths to the files stored under the given key (sorted by
+        name), or None if there is no matching entry
+        """
+        entry = self.entry_path(key)
+        try:
+            fnames = sorted(os.listdir(entry))
+        except OSError:
+            return None
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        logger.debug("Found cached entry for {} in '{}'".format(key, entry))
+        return [os.path.join(entry, f) for f in fnames]
+
+    def store(self, key, paths, names=None):
+        """
+        Stores the given files under the key (using the basenames of the
+        files unless 'names' is provided) and prunes the cache if it has
+        grown past its maximum size. If an entry already exists for the key
+        (e.g. stored by a concurrent process) it is kept and the new files
+        are discarded
+        """
+        entry = self.entry_path(key)
+        tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        if names is None:
+            names = [os.path.basename(p) for p in paths]
+        for path, name in zip(paths, names):
+            link(path, os.path.join(tmp_entry, name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process has already stored an entry for this key
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.prune()
+        return entry
+
+    def prune(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.startswith('.'):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                entries.append((os.stat(path).st_mtime, path_size(path),
+                                path))
+            except OSError:
+                continue  # Removed by a concurrent process
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def link(src, dst):
+    """
+    Hard-links 'src' to 'dst', falling back to copying if a hard link can't
+    be created (e.g. they are on different devices). Directories are
+    recreated and their contents linked
+    """
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=link)
+    else:
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    return dst
+
+
+def retrieve(src, dst):
+    """
+    Copies a cached file (or directory) to 'dst', so that modifying the copy
+    in place can't corrupt the entry in the cache
+    """
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def dicom_series_key(dicom_dir):
+    """
+    Returns the SeriesInstanceUID of the DICOM series in the directory along
+    with the number of files in it, or None if the directory doesn't contain
+    readable DICOMs
+    """
+    fnames = sorted(f for f in os.listdir(dicom_dir) if not f.startswith('.'))
+    for fname in fnames:
+        try:
+            hdr = pydicom.dcmread(
+                os.path.join(dicom_dir, fname), stop_before_pixels=True,
+                specific_tags=['SeriesInstanceUID'])
+            return (str(hdr.SeriesInstanceUID), len(fnames))
+        except (InvalidDicomError, AttributeError, IsADirectoryError):
+            continue
+    return None
+
+
+def conversion_cache(interface, converter, target_format, exclude=()):
+    """
+    Returns the conversion cache specified by the 'cache_dir' input of the
+    interface and the key of the conversion within it, (None, None) if the
+    cache is not set or the input isn't a DICOM series. The key is made up of
+    the SeriesInstanceUID, number of files, converter, target format and the
+    values of all other hashed inputs of the interface apart from those in
+    'exclude' (i.e. the locations of the outputs), with input files
+    replaced by the digests of their contents.
+    """
+    inputs = interface.inputs
+    if not isdefined(inputs.cache_dir) or not inputs.cache_dir:
+        return None, None
+    in_dir = getattr(inputs, interface._cache_input)
+    if not os.path.isdir(in_dir):
+        return None, None
+    series_key = dicom_series_key(in_dir)
+    if series_key is None:
+        return None, None
+    options = tuple(
+        (n, _content_key(v)) for n, v in sorted(inputs.get().items())
+        if (not inputs.trait(n).nohash and isdefined(v) and
+            n != interface._cache_input and n not in exclude))
+    key = series_key + (converter, target_format, options)
+    max_size = (inputs.cache_max_size if isdefined(inputs.cache_max_size)
+                else None)
+    return FileCache(inputs.cache_dir, max_size=max_size), key
+
+
+def file_digest(path):
+    """
+    Returns the SHA-1 digest of the contents of the file, which is only
+    recalculated if the size or modification time of the file changes
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    signature = (path, stat.st_size, stat.st_mtime)
+    try:
+        return _file_digests[signature]
+    except KeyError:
+        pass
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            sha.update(chunk)
+    digest = _file_digests[signature] = sha.hexdigest()
+    return digest
+
+
+def _content_key(value):
+    "Replaces paths to existing files in an input value with their digests"
+    if isinstance(value, (list, tuple)):
+        return tuple(_content_key(v) for v in value)
+    elif isinstance(value, str) and os.path.isfile(value):
+        return ('file', file_digest(value))
+    return repr(value)
+
+
+def set_registration_cache(node):
+    if REGISTRATION_CACHE_DIR:
+        node.inputs.cache_dir = REGISTRATION_CACHE_DIR
+        node.inputs.cache_max_size = int(REGISTRATION_CACHE_SIZE * 1e9)
+
+
+def set_list_mode_cache(node):
+    if LIST_MODE_CACHE_DIR:
+        node.inputs.cache_dir = LIST_MODE_CACHE_DIR
+
+
+def registration_cache(interface, tool):
+    """
+    Returns the registration cache specified by the 'cache_dir' input of the
+    interface and the key of the registration within it, (None, None) if the
+    cache is not set. The key is made up of the tool, its version and the
+    values of all hashed inputs, with input files replaced by the digests of
+    their contents so that the same images registered from different
+    studies share an entry.
+    """
+    inputs = interface.inputs
+    if not isdefined(inputs.cache_dir) or not inputs.cache_dir:
+        return None, None
+    params = tuple(
+        (n, _content_key(v)) for n, v in sorted(inputs.get().items())
+        if not inputs.trait(n).nohash)
+    try:
+        version = interface.version
+    except Exception:
+        version = None
+    key = ('registration', tool, str(version), params)
+    max_size = (inputs.cache_max_size if isdefined(inputs.cache_max_size)
+                else None)
+    return FileCache(inputs.cache_dir, max_size=max_size), key
+
+
+def cached_registration(interface, runtime, run_interface, tool):
+    """
+    Runs the registration (via the 'run_interface' method) unless its outputs
+    are found in the registration cache, in which case they are copied into
+    the locations the interface would have written them to.
+    """
+    cache, key = registration_cache(interface, tool)
+    if cache is not None:
+        cached = cache.fetch(key)
+        if cached is not None:
+            outputs = interface._list_outputs()
+            for path in cached:
+                out_path = outputs[os.path.basename(path)]
+                if os.path.lexists(out_path):
+                    os.remove(out_path)
+                retrieve(path, out_path)
+            return runtime
+    runtime = run_interface(runtime)
+    if cache is not None:
+        outputs = sorted(
+            (n, p) for n, p in interface._list_outputs().items()
+            if isinstance(p, str) and os.path.isfile(p))
+        cache.store(key, [p for _, p in outputs],
+                    names=[n for n, _ in outputs])
+    return runtime
+
+
+class RequirementCache(object):
+    """
+    Caches the results of probing the environment for the tools required by
+    nodes (e.g. the version reported by a tool, the path to its executable or
+    the available environment modules) so each probe is only run once per
+    process and, if 'path' is provided, shared between processes via a JSON
+    file. Each entry records the modification times of the files it was
+    derived from and is re-probed if any of them change
+
+    Parameters
+    ----------
+    path : str | None
+        Path to the JSON file the cache is persisted in (only kept in memory
+        if None)
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = None
+
+    def get(self, key, probe, depends_on=()):
+        """
+        Returns the cached value of the key or, if it is missing or any of
+        the files it depends on have changed, the value returned by 'probe'
+
+        Parameters
+        ----------
+        key : str
+            The key the value is stored under
+        probe : callable
+            Called (without arguments) to resolve the value, which must be
+            serializable to JSON
+        depends_on : list(str)
+            Paths to files (or directories) the value is derived from
+        """
+        if self._entries is None:
+            self._entries = self._read()
+        stamps = self._stamps(depends_on)
+        entry = self._entries.get(key)
+        if entry is not None and entry['stamps'] == stamps:
+            return entry['value']
+        logger.debug("Probing environment for '{}'".format(key))
+        value = probe()
+        self._entries[key] = {'value': value, 'stamps': stamps}
+        self._write(key)
+        return value
+
+    def clear(self):
+        "Clears the entries held in memory (reloaded from 'path' if set)"
+        self._entries = None
+
+    @classmethod
+    def _stamps(cls, paths):
+        stamps = {}
+        for path in paths:
+            try:
+                stamps[path] = os.stat(path).st_mtime
+            except OSError:
+                stamps[path] = None
+        return stamps
+
+    def _read(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, key):
+        if self.path is None:
+            return
+        # Merge with entries written by other processes since it was read
+        entries = self._read()
+        entries[key] = self._entries[key]
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write requirement cache '{}': {}"
+                           .format(self.path, e))
+
+
+requirement_cache = RequirementCache(REQUIREMENT_CACHE_PATH)
+
+
+def cached_which(executable):
+    """
+    Returns the path to the executable on the PATH (None if it isn't found),
+    which is only searched for again if the directories on the PATH change
+    """
+    search_path = os.environ.get('PATH', '')
+    return requirement_cache.get(
+        'which:{}:{}'.format(executable, search_path),
+        lambda: shutil.which(executable),
+        depends_on=[d for d in search_path.split(os.pathsep) if d])
+
+
+def cached_version(tool, probe, executable=None):
+    """
+    Returns the version of a tool reported by 'probe', which is only called
+    again if the executable of the tool (if provided) changes
+
+    Parameters
+    ----------
+    tool : str
+        Name of the tool
+    probe : callable
+        Called (without arguments) to get the version of the tool
+    executable : str | None
+        Name of the executable of the tool
+    """
+    depends_on = []
+    key = 'version:{}'.format(tool)
+    if executable is not None:
+        exec_path = cached_which(executable)
+        key += ':{}'.format(exec_path)
+        if exec_path is not None:
+            depends_on.append(exec_path)
+    return requirement_cache.get(key, probe, depends_on=depends_on)
@@ -1,5 +1,6 @@
+import os
 from copy import deepcopy, copy
-from arcana.node import Node
+from nianalysis.node import Node
 from arcana.file_format import FileFormat, Converter
 from nianalysis.interfaces.mrtrix import MRConvert
 from nianalysis.requirement import (
@@ -9,6 +10,20 @@ from arcana.file_format import (
     text_format, directory_format, zip_format, targz_format)  # @UnusedImport
 
 
+# Shared directory in which DICOM conversions are cached so that re-runs and
+# sibling studies don't need to reconvert the same series (disabled if not
+# set), and its maximum size in GB
+CONVERSION_CACHE_DIR = os.environ.get('NIANALYSIS_CONVERSION_CACHE', None)
+CONVERSION_CACHE_SIZE = float(
+    os.environ.get('NIANALYSIS_CONVERSION_CACHE_SIZE', 50))
+
+
+def set_conversion_cache(node):
+    if CONVERSION_CACHE_DIR:
+        node.inputs.cache_dir = CONVERSION_CACHE_DIR
+        node.inputs.cache_max_size = int(CONVERSION_CACHE_SIZE * 1e9)
+
+
 class Dcm2niixConverter(Converter):
 
     requirements = [dcm2niix_req]
@@ -17,7 +32,11 @@ class Dcm2niixConverter(Converter):
         convert_node = Node(Dcm2niix(), name=name,
                             requirements=self.requirements,
                             wall_time=20)
-        convert_node.inputs.compression = 'y'
+        if self._output_format.extension == '.nii.gz':
+            convert_node.inputs.compression = 'y'
+        else:
+            convert_node.inputs.compression = 'n'
+        set_conversion_cache(convert_node)
         return convert_node, 'input_dir', 'converted'
 
 
@@ -30,6 +49,7 @@ class MrtrixConverter(Converter):
                             requirements=self.requirements)
         convert_node.inputs.out_ext = self._output_format.extension
         convert_node.inputs.quiet = True
+        set_conversion_cache(convert_node)
         return convert_node, 'in_file', 'out_file'
 
 
@@ -67,6 +87,7 @@ mrtrix_format = FileFormat(name='mrtrix', extension='.mif',
 rfile_format = FileFormat(name='rdata', extension='.RData')
 # matlab_format = FileFormat(name='matlab', extension='.mat')
 csv_format = FileFormat(name='comma-separated_file', extension='.csv')
+json_format = FileFormat(name='json', extension='.json')
 text_matrix_format = FileFormat(name='text_matrix', extension='.mat')
 
 # Diffusion gradient-table data formats
@@ -2,6 +2,8 @@ from nipype.interfaces.base import (
     TraitedSpec, traits, File, CommandLineInputSpec, CommandLine)
 import os
 from nipype.interfaces.base import isdefined
+from nipype.interfaces.ants.base import Info
+from nianalysis.cache import cached_registration, cached_version
 
 ants_reg_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), 'resources', 'bash',
@@ -27,7 +29,8 @@ class AntsRegSynInputSpec(CommandLineInputSpec):
         's:rigid+affine+deformable Syn, sr:rigid+deformable Syn, so:'
         'deformable Syn, b:rigid+affine+deformable b-spline Syn, br:'
         'rigid+deformable b-spline Syn, bo:deformable b-spline Syn')
-    num_threads = traits.Int(desc='number of threads', argstr='-n %s')
+    num_threads = traits.Int(desc='number of threads', argstr='-n %s',
+                             nohash=True)
     radius = traits.Float(
         desc='radius for cross correlation metric used during SyN stage'
         ' (default = 4)', argstr='-r %f')
@@ -41,6 +44,15 @@ class AntsRegSynInputSpec(CommandLineInputSpec):
         '(default = d). f:float, d:double')
     use_histo_match = traits.Int(desc='use histogram matching (default = 0).'
                                  '0: False, 1:True', argstr='-j %s')
+    quick = traits.Bool(
+        desc=('use a reduced iteration schedule that skips the finest '
+              'resolution level of each stage'), argstr='-q 1')
+    cache_dir = traits.Str(
+        nohash=True, desc=("Shared directory in which registration results "
+                           "are cached (keyed by the contents of the input "
+                           "images and the registration parameters)"))
+    cache_max_size = traits.Int(
+        nohash=True, desc="Maximum size (in bytes) of the registration cache")
 
 
 class AntsRegSynOutputSpec(TraitedSpec):
@@ -58,6 +70,15 @@ class AntsRegSyn(CommandLine):
     mat_ext = '.mat'
     img_ext = '.nii.gz'
 
+    @property
+    def version(self):
+        return cached_version('ants', Info.version, 'antsRegistration')
+
+    def _run_interface(self, runtime):
+        return cached_registration(
+            self, runtime, super(AntsRegSyn, self)._run_interface,
+            'antsRegistrationSyN')
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['regmat'] = os.path.join(os.getcwd(),
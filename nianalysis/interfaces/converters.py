@@ -1,15 +1,71 @@
 
 import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
 from nipype.interfaces.base import (
-    TraitedSpec, BaseInterface, File, Directory, traits, isdefined,
-    CommandLineInputSpec, CommandLine)
+    TraitedSpec, BaseInterface, BaseInterfaceInputSpec, File, Directory,
+    traits, isdefined, CommandLineInputSpec, CommandLine)
 import pydicom
 import nibabel as nib
+from nibabel.openers import Opener
 from arcana.utils import split_extension
 import re
 from arcana.exception import ArcanaError
 import numpy as np
 from nipype.utils.filemanip import split_filename
+from nianalysis.cache import conversion_cache, retrieve
+from nianalysis.interfaces.mrtrix import MRConvert
+
+
+ECHO_NUM_RE = re.compile(r'_e(\d+)')
+
+
+def concatenate_echoes(in_files, out_file):
+    """
+    Concatenates 3D echo images along a 4th dimension, writing the output one
+    echo at a time in the native data type of the inputs (so only a single
+    echo is ever held in memory)
+    """
+    images = [nib.load(f) for f in in_files]
+    ref = images[0]
+    if any(i.shape[:3] != ref.shape[:3] for i in images):
+        raise ArcanaError(
+            "Cannot concatenate echoes with differing shapes ({})".format(
+                ', '.join(str(i.shape) for i in images)))
+    slope_inters = set((float(i.dataobj.slope), float(i.dataobj.inter))
+                       for i in images)
+    if len(slope_inters) == 1:
+        # Echoes share the same scaling so the raw values can be copied
+        # across unchanged
+        dtype = np.result_type(*(i.get_data_dtype() for i in images))
+        slope, inter = slope_inters.pop()
+        scaled = False
+    else:
+        dtype = np.dtype(np.float32)
+        slope, inter = 1.0, 0.0
+        scaled = True
+    hdr = nib.Nifti1Header()
+    for key in ('pixdim', 'xyzt_units', 'qform_code', 'sform_code',
+                'quatern_b', 'quatern_c', 'quatern_d', 'qoffset_x',
+                'qoffset_y', 'qoffset_z', 'srow_x', 'srow_y', 'srow_z',
+                'dim_info', 'descrip'):
+        hdr[key] = ref.header[key]
+    hdr.set_data_dtype(dtype)
+    hdr.set_data_shape(ref.shape[:3] + (len(images),))
+    hdr.set_slope_inter(slope, inter)
+    hdr.set_data_offset(hdr.single_vox_offset)
+    with Opener(out_file, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (hdr.get_data_offset() - f.tell()))
+        for image in images:
+            if scaled:
+                data = np.asanyarray(image.dataobj).astype(dtype)
+            else:
+                data = image.dataobj.get_unscaled().astype(dtype, copy=False)
+            data = data.reshape(ref.shape[:3])
+            f.write(data.tobytes(order='F'))
+            del data
+    return out_file
 
 
 class Dcm2niixInputSpec(CommandLineInputSpec):
@@ -20,6 +76,17 @@ class Dcm2niixInputSpec(CommandLineInputSpec):
     out_dir = Directory(genfile=True, argstr='-o %s', desc="output directory")
     multifile_concat = traits.Bool(default=False, desc="concatenate multiple "
                                    "echoes into one file")
+    echo_order = traits.List(
+        traits.Int(), desc=("Order (by echo number) in which the echoes are "
+                            "concatenated when 'multifile_concat' is set. By "
+                            "default echoes are concatenated in ascending "
+                            "echo number"))
+    cache_dir = traits.Str(
+        nohash=True, desc=("Shared directory in which converted series are "
+                           "cached (keyed by SeriesInstanceUID) so repeated "
+                           "conversions of the same series are skipped"))
+    cache_max_size = traits.Int(
+        nohash=True, desc="Maximum size (in bytes) of the conversion cache")
 
 
 class Dcm2niixOutputSpec(TraitedSpec):
@@ -30,47 +97,102 @@ class Dcm2niix(CommandLine):
     """Convert a DICOM folder to a nifti_gz file"""
 
     _cmd = 'dcm2niix'
+    _cache_input = 'input_dir'
     input_spec = Dcm2niixInputSpec
     output_spec = Dcm2niixOutputSpec
 
+    # The output filename the products are stored under in the conversion
+    # cache, so the same series converted from differently named directories
+    # (or to different filenames) shares an entry
+    _cache_filename = 'series'
+
+    def _run_interface(self, runtime):
+        cache, key = conversion_cache(self, 'dcm2niix', self._im_ext(),
+                                      exclude=('out_dir', 'filename'))
+        filename = self._gen_filename('filename')
+        if cache is not None:
+            cached = cache.fetch(key)
+            if cached is not None:
+                out_dir = self._gen_filename('out_dir')
+                for path in cached:
+                    retrieve(path, os.path.join(out_dir, self._rename(
+                        os.path.basename(path), self._cache_filename,
+                        filename)))
+                return runtime
+        runtime = super(Dcm2niix, self)._run_interface(runtime)
+        products = self._products()
+        if len(products) > 1 and self.inputs.multifile_concat:
+            concatenate_echoes(self._order_echoes(products),
+                               self._concat_filename())
+            products.append(self._concat_filename())
+        if cache is not None and products:
+            cache.store(key, products, names=[
+                self._rename(os.path.basename(p), filename,
+                             self._cache_filename) for p in products])
+        return runtime
+
+    @classmethod
+    def _rename(cls, fname, old, new):
+        "Swaps the output filename within the name of one of the products"
+        match = re.match(r'(_e\d+)?{}(.*)$'.format(re.escape(old)), fname)
+        return (match.group(1) or '') + new + match.group(2)
+
     def _list_outputs(self):
+        outputs = self._outputs().get()
+        products = self._products()
+        if len(products) == 1:
+            converted = products[0]
+        elif len(products) > 1 and self.inputs.multifile_concat:
+            converted = self._concat_filename()
+        elif len(products) > 1 and not self.inputs.multifile_concat:
+            converted = products[-1]
+        else:
+            raise ArcanaError("No products produced by dcm2niix ({})"
+                              .format(', '.join(os.listdir(
+                                  self._gen_filename('out_dir')))))
+        outputs['converted'] = converted
+        return outputs
+
+    def _im_ext(self):
         if (not isdefined(self.inputs.compression) or
                 (self.inputs.compression == 'y' or
                  self.inputs.compression == 'i')):
             im_ext = '.nii.gz'
         else:
             im_ext = '.nii'
-        outputs = self._outputs().get()
+        return im_ext
+
+    def _products(self):
         # As Dcm2niix sometimes prepends a prefix onto the filenames to avoid
         # name clashes with multiple echos, we need to check the output folder
         # for all filenames that end with the "generated filename".
         out_dir = self._gen_filename('out_dir')
-        fname = self._gen_filename('filename') + im_ext
+        fname = self._gen_filename('filename') + self._im_ext()
         base, ext = split_extension(fname)
         match_re = re.compile(r'(_e\d+)?{}(_(?:e|c)\d+)?{}'
                               .format(base, ext if ext is not None else ''))
-        products = [os.path.join(out_dir, f) for f in os.listdir(out_dir)
-                    if match_re.match(f) is not None]
-        if len(products) == 1:
-            converted = products[0]
-        elif len(products) > 1 and self.inputs.multifile_concat:
-            ex_file = nib.load(products[0])
-            data = ex_file.get_data()
-            merged_file = np.zeros((data.shape[0], data.shape[1],
-                                    data.shape[2], len(products)))
-            for i, el in enumerate(products):
-                f = nib.load(el)
-                merged_file[:, :, :, i] = f.get_data()
-            im2save = nib.Nifti1Image(merged_file, ex_file.affine)
-            nib.save(im2save, out_dir + fname)
-            converted = out_dir + fname
-        elif len(products) > 1 and not self.inputs.multifile_concat:
-            converted = products[-1]
-        else:
-            raise ArcanaError("No products produced by dcm2niix ({})"
-                                  .format(', '.join(os.listdir(out_dir))))
-        outputs['converted'] = converted
-        return outputs
+        return sorted(os.path.join(out_dir, f) for f in os.listdir(out_dir)
+                      if match_re.match(f) is not None)
+
+    def _concat_filename(self):
+        return os.path.join(
+            self._gen_filename('out_dir'),
+            self._gen_filename('filename') + '_concat' + self._im_ext())
+
+    def _order_echoes(self, products):
+        echoes = {}
+        for i, product in enumerate(products):
+            match = ECHO_NUM_RE.search(os.path.basename(product))
+            echoes[int(match.group(1)) if match is not None else i] = product
+        if isdefined(self.inputs.echo_order) and self.inputs.echo_order:
+            missing = [e for e in self.inputs.echo_order if e not in echoes]
+            if missing:
+                raise ArcanaError(
+                    "Echo number(s) {} requested in 'echo_order' were not "
+                    "produced by dcm2niix (found {})".format(
+                        missing, sorted(echoes)))
+            return [echoes[e] for e in self.inputs.echo_order]
+        return [echoes[e] for e in sorted(echoes)]
 
     def _gen_filename(self, name):
         if name == 'out_dir':
@@ -96,6 +218,112 @@ class Dcm2niix(CommandLine):
         return out_name
 
 
+class BatchDicomConversionInputSpec(BaseInterfaceInputSpec):
+    series_dirs = traits.List(
+        Directory(exists=True), mandatory=True,
+        desc="DICOM series directories of the session to convert")
+    converter = traits.Enum(
+        'dcm2niix', 'mrconvert', usedefault=True,
+        desc="The tool used to convert each of the series")
+    out_ext = traits.Str(
+        '.nii.gz', usedefault=True,
+        desc="Extension (and therefore format) of the converted images")
+    num_workers = traits.Int(
+        4, usedefault=True,
+        desc="Maximum number of series converted concurrently")
+    cache_dir = traits.Str(
+        nohash=True, desc=("Shared directory in which converted series are "
+                           "cached (keyed by SeriesInstanceUID)"))
+    cache_max_size = traits.Int(
+        nohash=True, desc="Maximum size (in bytes) of the conversion cache")
+
+
+class BatchDicomConversionOutputSpec(TraitedSpec):
+    converted = traits.List(
+        File(exists=True), desc="Converted images in the order of the inputs")
+    conversion_map = traits.Dict(
+        desc="Mapping from the name of each series directory to its "
+        "converted image")
+    conversion_times = traits.Dict(
+        desc="Wall time (in seconds) taken to convert each series")
+
+
+class BatchDicomConversion(BaseInterface):
+    """
+    Converts all the DICOM series of a session in one node, running the
+    conversions concurrently in a bounded pool of workers instead of setting
+    up a separate converter node for each series
+
+    Note that Arcana inserts a separate converter node for each input
+    dataset of a pipeline that needs converting, and provides no hook to
+    convert all the inputs of a session together, so this interface is not
+    used by the studies. It is intended for converting whole sessions
+    outside of a study (e.g. scripts/benchmark_batch_conversion.py)
+    """
+
+    input_spec = BatchDicomConversionInputSpec
+    output_spec = BatchDicomConversionOutputSpec
+
+    def _run_interface(self, runtime):
+        names = [os.path.basename(os.path.normpath(d))
+                 for d in self.inputs.series_dirs]
+        if len(set(names)) != len(names):
+            raise ArcanaError(
+                "Series directories need to have unique names to be batch "
+                "converted ({})".format(', '.join(self.inputs.series_dirs)))
+        num_workers = max(min(self.inputs.num_workers, len(names)), 1)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(self._convert,
+                                        self.inputs.series_dirs, names))
+        self.converted = [r[0] for r in results]
+        self.conversion_times = dict(zip(names, (r[1] for r in results)))
+        return runtime
+
+    def _convert(self, series_dir, name):
+        # The conversions are run as sub-processes so threads are sufficient
+        # to run them in parallel
+        start = time.time()
+        out_dir = os.path.join(os.getcwd(), name)
+        os.makedirs(out_dir, exist_ok=True)
+        interface, out_field = self._converter_interface(series_dir, out_dir,
+                                                         name)
+        if isdefined(self.inputs.cache_dir):
+            interface.inputs.cache_dir = self.inputs.cache_dir
+        if isdefined(self.inputs.cache_max_size):
+            interface.inputs.cache_max_size = self.inputs.cache_max_size
+        result = interface.run()
+        return (getattr(result.outputs, out_field), time.time() - start)
+
+    def _converter_interface(self, series_dir, out_dir, name):
+        """
+        Returns the interface that converts a series along with the name of
+        its output field
+        """
+        if self.inputs.converter == 'dcm2niix':
+            if self.inputs.out_ext.endswith('.gz'):
+                compression = 'y'
+            else:
+                compression = 'n'
+            interface = Dcm2niix(input_dir=series_dir, out_dir=out_dir,
+                                 filename=name, compression=compression)
+            out_field = 'converted'
+        else:
+            interface = MRConvert(
+                in_file=series_dir, quiet=True,
+                out_file=os.path.join(out_dir, name + self.inputs.out_ext))
+            out_field = 'out_file'
+        return interface, out_field
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        names = [os.path.basename(os.path.normpath(d))
+                 for d in self.inputs.series_dirs]
+        outputs['converted'] = self.converted
+        outputs['conversion_map'] = dict(zip(names, self.converted))
+        outputs['conversion_times'] = self.conversion_times
+        return outputs
+
+
 class Nii2DicomInputSpec(TraitedSpec):
     in_file = File(mandatory=True, desc='input nifti file')
     reference_dicom = traits.List(mandatory=True, desc='original umap')
@@ -174,3 +402,4 @@ class Nii2Dicom(BaseInterface):
                 '_dicom')
             fpath = os.path.join(os.getcwd(), fname)
         return fpath
+
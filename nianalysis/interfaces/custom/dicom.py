@@ -6,12 +6,19 @@ from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
 import numpy as np
 import glob
 import pydicom
+from pydicom.errors import InvalidDicomError
 from nipype.utils.filemanip import split_filename
 import datetime as dt
 import os.path
+import json
+import shutil
+import tempfile
+import mmap
 import nibabel as nib
 from arcana.utils import split_extension
 import nibabel.nicom.csareader as csareader
+from nianalysis.utils import iter_slabs
+from nianalysis.cache import FileCache
 
 
 PEDP_TO_SIGN = {0: '-1', 1: '+1'}
@@ -153,6 +160,85 @@ class DicomHeaderInfoExtraction(BaseInterface):
         return sign, inplane_pe_dir
 
 
+def total_readout_time(dcm):
+    """
+    Calculates the total readout time of an EPI acquisition (the time from
+    the centre of the first to the centre of the last echo, as required by
+    topup and eddy) from its DICOM header in the same way as dcm2niix, i.e.
+    from the bandwidth per pixel in the phase encoding direction and the
+    number of reconstructed phase encoding lines
+
+    Parameters
+    ----------
+    dcm : pydicom.dataset.Dataset
+        The header of one of the DICOM files of the acquisition
+
+    Returns
+    -------
+    readout_time : float | None
+        The total readout time (in seconds) or None if the header does not
+        contain the bandwidth per pixel in the phase encoding direction
+        (a Siemens private tag)
+    """
+    try:
+        bandwidth = float(dcm[0x0019, 0x1028].value)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if dcm.InPlanePhaseEncodingDirection == 'ROW':
+        num_lines = int(dcm.Columns)
+    else:
+        num_lines = int(dcm.Rows)
+    # Mosaics hold the slices in a grid of tiles within each image
+    try:
+        num_mosaic = csareader.get_n_mosaic(
+            csareader.read(dcm[0x0029, 0x1010].value))
+    except (KeyError, csareader.CSAReadError):
+        num_mosaic = None
+    if num_mosaic:
+        num_lines //= int(np.ceil(np.sqrt(num_mosaic)))
+    echo_spacing = 1.0 / (bandwidth * num_lines)
+    return echo_spacing * (num_lines - 1)
+
+
+class TotalReadoutTimeInputSpec(BaseInterfaceInputSpec):
+
+    dicom_folder = Directory(exists=True, mandatory=True,
+                             desc='Directory with DICOM files')
+    default = traits.Float(
+        0.1, usedefault=True,
+        desc=('Total readout time used when it cannot be calculated from '
+              'the header (the default of MRtrix\'s dwipreproc)'))
+
+
+class TotalReadoutTimeOutputSpec(TraitedSpec):
+
+    readout_time = traits.Float(desc='Total readout time (s)')
+
+
+class TotalReadoutTime(BaseInterface):
+    """
+    Reads the total readout time of an EPI acquisition from its DICOM
+    header (see 'total_readout_time')
+    """
+
+    input_spec = TotalReadoutTimeInputSpec
+    output_spec = TotalReadoutTimeOutputSpec
+
+    def _run_interface(self, runtime):
+        dicom_path = sorted(glob.glob(self.inputs.dicom_folder + '/*'))[0]
+        readout_time = total_readout_time(
+            pydicom.read_file(dicom_path, stop_before_pixels=True))
+        self._readout_time = (readout_time if readout_time is not None
+                              else self.inputs.default)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if hasattr(self, '_readout_time'):
+            outputs['readout_time'] = self._readout_time
+        return outputs
+
+
 class ScanTimesInfoInputSpec(BaseInterfaceInputSpec):
 
     dicom_infos = traits.List(desc='List of dicoms to calculate the difference'
@@ -208,9 +294,101 @@ class ScanTimesInfo(BaseInterface):
         return outputs
 
 
+# Interfile keys searched for in the list-mode headers
+LIST_MODE_KEYS = {'image duration': b'image duration'}
+
+
+def probe_interfile_header(header_path, keys=LIST_MODE_KEYS):
+    """
+    Memory-maps a list-mode header and searches it for the given Interfile
+    keys, returning a dictionary with the (string) values found
+    """
+    values = {}
+    if not os.path.getsize(header_path):
+        return values
+    with open(header_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for name, key in keys.items():
+                # Later occurrences of a key override earlier ones
+                start = mm.rfind(key)
+                if start == -1:
+                    continue
+                eol = mm.find(b'\n', start)
+                if eol == -1:
+                    eol = len(mm)
+                line = mm[start:eol]
+                if b':=' not in line:
+                    continue
+                values[name] = line.split(b':=')[-1].strip().decode(
+                    'utf-8', errors='ignore')
+        finally:
+            mm.close()
+    return values
+
+
+def list_mode_time_info(pet_data_dir, cache_dir=None):
+    """
+    Returns the (path, size, start_time, duration) of every list-mode (.bf)
+    file within the PET data directory, sorted by decreasing size. If a
+    cache directory is provided the result is stored in it, keyed by the
+    path, size and modification time of the list-mode files, so the
+    headers are only read again if the list-mode files change
+    """
+    bf_files = []
+    for root, dirs, files in os.walk(pet_data_dir):
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+        bf_files.extend(os.path.join(root, f) for f in files
+                        if not f[0] == '.' and '.bf' in f)
+    signature = []
+    for bf in sorted(bf_files):
+        st = os.stat(bf)
+        signature.append((bf, st.st_size, st.st_mtime))
+    if cache_dir is not None:
+        cache = FileCache(cache_dir)
+        key = ('list_mode_info', os.path.realpath(pet_data_dir),
+               tuple(signature))
+        cached = cache.fetch(key)
+        if cached:
+            with open(cached[0]) as f:
+                return [tuple(i) for i in json.load(f)]
+    info = []
+    for bf, size, _ in signature:
+        header = bf.split('.bf')[0] + '.dcm'
+        start_time = duration = None
+        if os.path.exists(header):
+            try:
+                hd = pydicom.read_file(
+                    header, stop_before_pixels=True,
+                    specific_tags=['AcquisitionTime'])
+                start_time = str(hd.AcquisitionTime)
+            except (AttributeError, InvalidDicomError):
+                start_time = None
+            values = probe_interfile_header(header)
+            try:
+                duration = int(values['image duration'])
+            except (KeyError, ValueError):
+                duration = None
+        info.append((bf, size, start_time, duration))
+    info = sorted(info, key=lambda i: i[1], reverse=True)
+    if cache_dir is not None:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tmp_path = os.path.join(tmp_dir, 'list_mode_info.json')
+            with open(tmp_path, 'w') as f:
+                json.dump(info, f)
+            cache.store(key, [tmp_path])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return info
+
+
 class PetTimeInfoInputSpec(BaseInterfaceInputSpec):
     pet_data_dir = Directory(exists=True,
                              desc='Directory the the list-mode data.')
+    cache_dir = traits.Str(
+        nohash=True, desc=('Shared directory in which the timing information '
+                           'of the list-mode files is cached'))
 
 
 class PetTimeInfoOutputSpec(TraitedSpec):
@@ -218,6 +396,12 @@ class PetTimeInfoOutputSpec(TraitedSpec):
     pet_end_time = traits.Str(desc='PET end time.')
     pet_start_time = traits.Str(desc='PET start time.')
     pet_duration = traits.Int(desc='PET temporal duration in seconds.')
+    list_mode_files = traits.List(
+        File(exists=True), desc='All the list-mode files found, sorted by '
+        'decreasing size.')
+    list_mode_durations = traits.List(
+        desc='Duration (in seconds) of each of the list-mode files (None if '
+        'it could not be extracted from the header).')
 
 
 class PetTimeInfo(BaseInterface):
@@ -228,50 +412,30 @@ class PetTimeInfo(BaseInterface):
     def _run_interface(self, runtime):
         pet_data_dir = self.inputs.pet_data_dir
         self.dict_output = {}
+        pet_start_time = None
+        pet_endtime = None
         pet_duration = None
-        for root, dirs, files in os.walk(pet_data_dir):
-            bf_files = [f for f in files if not f[0] == '.' and '.bf' in f]
-            dirs[:] = [d for d in dirs if not d[0] == '.']
-
-        if not bf_files:
-            pet_start_time = None
-            pet_endtime = None
+        info = list_mode_time_info(
+            pet_data_dir, cache_dir=(self.inputs.cache_dir
+                                     if isdefined(self.inputs.cache_dir)
+                                     else None))
+        if not info:
             print ('No .bf file found in {}. If you want to perform motion '
-                   'correction please provide the right pet data. ')
+                   'correction please provide the right pet data. '
+                   .format(pet_data_dir))
         else:
-            max_size = 0
-            for bf in bf_files:
-                size = os.path.getsize(os.path.join(root, bf))
-                if size > max_size:
-                    max_size = size
-                    list_mode_file = os.path.join(root, bf)
-
-            pet_image = list_mode_file.split('.bf')[0] + '.dcm'
-            try:
-                hd = pydicom.read_file(pet_image)
-                pet_start_time = hd.AcquisitionTime
-            except AttributeError:
-                pet_start_time = None
-            with open(pet_image, 'rb') as f:
-                for line in f:
-                    try:
-                        line = line[:-1].decode('utf-8')
-                    except UnicodeDecodeError:
-                        continue
-                    if 'image duration' in line:
-                        pet_duration = line.strip()
-                        pet_duration = int(pet_duration.split(':=')[-1])
-            if pet_duration:
+            # The largest list-mode file is the one used for the PET timing
+            _, _, pet_start_time, pet_duration = info[0]
+            if pet_duration and pet_start_time is not None:
                 pet_endtime = ((
                     dt.datetime.strptime(pet_start_time, '%H%M%S.%f') +
                     dt.timedelta(seconds=pet_duration))
                                     .strftime('%H%M%S.%f'))
-                pet_duration = pet_duration
-            else:
-                pet_endtime = None
         self.dict_output['pet_endtime'] = pet_endtime
         self.dict_output['pet_duration'] = pet_duration
         self.dict_output['pet_start_time'] = pet_start_time
+        self.dict_output['list_mode_files'] = [i[0] for i in info]
+        self.dict_output['list_mode_durations'] = [i[3] for i in info]
 
         return runtime
 
@@ -281,6 +445,9 @@ class PetTimeInfo(BaseInterface):
         outputs["pet_end_time"] = self.dict_output['pet_endtime']
         outputs["pet_start_time"] = self.dict_output['pet_start_time']
         outputs["pet_duration"] = self.dict_output['pet_duration']
+        outputs["list_mode_files"] = self.dict_output['list_mode_files']
+        outputs["list_mode_durations"] = self.dict_output[
+            'list_mode_durations']
 
         return outputs
 
@@ -315,17 +482,18 @@ class Nii2Dicom(BaseInterface):
             for f in to_remove:
                 dcms.remove(f)
         nifti_image = nib.load(self.inputs.in_file)
-        nii_data = nifti_image.get_data()
-        if len(dcms) != nii_data.shape[2]:
+        if len(dcms) != nifti_image.shape[2]:
             raise Exception('Different number of nifti and dicom files '
                             'provided. Dicom to nifti conversion require the '
                             'same number of files in order to run. Please '
                             'check.')
         os.mkdir('nifti2dicom')
         _, basename, _ = split_filename(self.inputs.in_file)
-        for i in range(nii_data.shape[2]):
+        # The slices are streamed from the image (assumed to be 3D) in slabs
+        slices = (s[:, :, j] for _, s in iter_slabs(nifti_image)
+                  for j in range(s.shape[2]))
+        for i, nifti in enumerate(slices):
             dcm = pydicom.read_file(dcms[i])
-            nifti = nii_data[:, :, i]
             nifti = nifti.astype('uint16')
             dcm.pixel_array.setflags(write=True)
             dcm.pixel_array.flat[:] = nifti.flat[:]
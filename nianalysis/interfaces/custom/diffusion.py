@@ -0,0 +1,1318 @@
+import os.path
+import json
+import csv
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.optimize import nnls
+from scipy import ndimage
+from nipype.interfaces.base import (
+    TraitedSpec, BaseInterface, BaseInterfaceInputSpec, File, traits,
+    isdefined, InputMultiPath)
+from arcana.utils import split_extension
+from nianalysis.utils import (
+    load_image_data, iter_slabs, DEFAULT_SLAB_SIZE)
+from nianalysis.interfaces.custom.motion_correction import (
+    phase_encoding_directions, topup_encoding)
+
+
+# Intrinsic parallel and isotropic (free water) diffusivities assumed by the
+# NODDI model (mm^2/s)
+NODDI_PARALLEL_DIFFUSIVITY = 1.7e-3
+NODDI_ISO_DIFFUSIVITY = 3.0e-3
+
+# b-value (s/mm^2) below which volumes are treated as unweighted, as in MRtrix
+B0_THRESHOLD = 10.0
+
+# Order of the unique tensor elements in tensor images (as written by
+# MRtrix's 'dwi2tensor')
+TENSOR_ELEMENTS = ((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))
+
+
+def load_fsl_gradients(bvecs_file, bvals_file, affine=None):
+    """
+    Loads a gradient table stored in FSL format, optionally rotating the
+    directions from the voxel axes of the image (with the x-axis flipped for
+    images with a positive determinant, as FSL expects) into world
+    coordinates
+
+    Parameters
+    ----------
+    bvecs_file : str
+        Path to the FSL bvecs file (3 rows or 3 columns)
+    bvals_file : str
+        Path to the FSL bvals file
+    affine : np.ndarray | None
+        The affine of the image the gradients correspond to
+
+    Returns
+    -------
+    bvecs : np.ndarray
+        The gradient directions (N x 3)
+    bvals : np.ndarray
+        The b-values (N)
+    """
+    bvecs = np.atleast_2d(np.loadtxt(bvecs_file))
+    if bvecs.shape[0] == 3 and bvecs.shape[1] != 3:
+        bvecs = bvecs.T
+    bvals = np.ravel(np.loadtxt(bvals_file))
+    if bvecs.shape[0] != len(bvals):
+        raise Exception(
+            "Number of gradient directions in '{}' ({}) does not match "
+            "number of b-values in '{}' ({})".format(
+                bvecs_file, bvecs.shape[0], bvals_file, len(bvals)))
+    if affine is not None:
+        linear = np.asarray(affine)[:3, :3]
+        rotation = linear / np.linalg.norm(linear, axis=0)
+        if np.linalg.det(linear) > 0:
+            bvecs = bvecs * (-1.0, 1.0, 1.0)
+        bvecs = bvecs.dot(rotation.T)
+    return bvecs, bvals
+
+
+def tensor_design_matrix(bvecs, bvals):
+    """
+    Returns the design matrix of the log-linear tensor model, with columns
+    corresponding to the elements of the tensor (in TENSOR_ELEMENTS order)
+    followed by the log of the unweighted signal
+    """
+    columns = [-bvals * bvecs[:, i] * bvecs[:, j] * (1 if i == j else 2)
+               for i, j in TENSOR_ELEMENTS]
+    columns.append(np.ones(len(bvals)))
+    return np.column_stack(columns)
+
+
+def fit_tensors(signal, design, min_signal=1e-6):
+    """
+    Fits the diffusion tensor to each row of 'signal' by weighted least
+    squares on the log signal, weighting each measurement by its squared
+    signal as predicted by an initial ordinary least-squares fit
+
+    Parameters
+    ----------
+    signal : np.ndarray
+        The measured signal (voxels x gradients)
+    design : np.ndarray
+        The design matrix (see 'tensor_design_matrix')
+    min_signal : float
+        Signals below this value are clipped to it before taking the log
+
+    Returns
+    -------
+    params : np.ndarray
+        The tensor elements (in TENSOR_ELEMENTS order) and the log of the
+        unweighted signal (voxels x 7)
+    """
+    log_signal = np.log(np.maximum(signal, min_signal))
+    # Initial ordinary least squares estimate for all voxels at once
+    params = log_signal.dot(np.linalg.pinv(design).T)
+    weights = np.exp(2 * params.dot(design.T))
+    # Batched weighted normal equations (voxels x 7 x 7), formed as matrix
+    # products with the outer products of the rows of the design matrix
+    num_params = design.shape[1]
+    outer = (design[:, :, None] * design[:, None, :]).reshape(
+        len(design), -1)
+    lhs = weights.dot(outer).reshape(-1, num_params, num_params)
+    rhs = (weights * log_signal).dot(design)
+    try:
+        params = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # Fall back to voxel-wise least squares if any system is singular
+        params = np.array([np.linalg.lstsq(l, r, rcond=None)[0]
+                           for l, r in zip(lhs, rhs)])
+    return params
+
+
+def tensor_metrics(tensors):
+    """
+    Calculates the fractional anisotropy (FA), mean (MD), axial (AD) and
+    radial (RD) diffusivities from tensor elements (voxels x 6, in
+    TENSOR_ELEMENTS order)
+    """
+    matrices = np.empty(tensors.shape[:-1] + (3, 3))
+    for k, (i, j) in enumerate(TENSOR_ELEMENTS):
+        matrices[..., i, j] = matrices[..., j, i] = tensors[..., k]
+    evals = np.linalg.eigvalsh(matrices)  # ascending order
+    md = evals.mean(axis=-1)
+    norm = np.sqrt((evals ** 2).sum(axis=-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fa = np.sqrt(1.5 * ((evals - md[..., None]) ** 2).sum(axis=-1)) / norm
+    fa = np.clip(np.nan_to_num(fa), 0.0, 1.0)
+    ad = evals[..., 2]
+    rd = evals[..., :2].mean(axis=-1)
+    return fa, md, ad, rd
+
+
+def fit_tensor_image(dwi, mask, bvecs, bvals, nthreads=1,
+                     max_memory=DEFAULT_SLAB_SIZE):
+    """
+    Fits the diffusion tensor to every voxel within the mask of a DWI series,
+    processing slabs of slices in parallel so that each only holds a bounded
+    number of voxels in memory
+
+    Parameters
+    ----------
+    dwi : np.ndarray
+        The (possibly memory-mapped) 4D DWI data
+    mask : np.ndarray
+        Mask of the voxels to fit (3D)
+    bvecs : np.ndarray
+        Gradient directions (N x 3)
+    bvals : np.ndarray
+        b-values (N)
+    nthreads : int
+        Number of slabs processed in parallel
+    max_memory : int
+        Approximate limit (in bytes) on the memory used by all slabs in
+        flight at once
+
+    Returns
+    -------
+    tensors : np.ndarray
+        The fitted tensor elements (X x Y x Z x 6)
+    metrics : tuple(np.ndarray)
+        FA, MD, AD and RD maps
+    """
+    shape = dwi.shape[:3]
+    design = tensor_design_matrix(bvecs, bvals)
+    tensors = np.zeros(shape + (6,), dtype=np.float32)
+    metrics = tuple(np.zeros(shape, dtype=np.float32) for _ in range(4))
+    # Working memory per voxel is dominated by the signal, weights and log
+    # signal arrays and the batched normal equations
+    voxel_bytes = 8 * (4 * len(bvals) + 2 * design.shape[1] ** 2)
+    slice_voxels = max(int(np.count_nonzero(mask, axis=(0, 1)).max()), 1)
+    step = max(int(max_memory // (nthreads * voxel_bytes * slice_voxels)),
+               1)
+
+    def fit_slab(start):
+        stop = min(start + step, shape[2])
+        slab_mask = mask[:, :, start:stop]
+        if not slab_mask.any():
+            return
+        signal = np.asarray(dwi[:, :, start:stop, :], dtype=float)[slab_mask]
+        params = fit_tensors(signal, design)
+        tensors[:, :, start:stop][slab_mask] = params[:, :6]
+        for out, metric in zip(metrics, tensor_metrics(params[:, :6])):
+            out[:, :, start:stop][slab_mask] = metric
+
+    with ThreadPoolExecutor(max_workers=max(nthreads, 1)) as executor:
+        list(executor.map(fit_slab, range(0, shape[2], step)))
+    return tensors, metrics
+
+
+def extract_b0(image, bvals, operation='mean', threshold=B0_THRESHOLD):
+    """
+    Extracts the mean or the first of the b0 volumes of a DWI series,
+    slicing the volumes one at a time from the data object of the image so
+    the other volumes are never read (for uncompressed images)
+
+    Parameters
+    ----------
+    image : nibabel.SpatialImage
+        The DWI series (4D)
+    bvals : np.ndarray
+        The b-values of the volumes
+    operation : str
+        Either 'mean' or 'first'
+    threshold : float
+        Volumes with b-values at or below this are treated as b0s
+
+    Returns
+    -------
+    b0 : np.ndarray
+        The mean or first b0 volume
+    """
+    indices = np.flatnonzero(np.asarray(bvals) <= threshold)
+    if image.ndim != 4 or image.shape[3] != len(bvals):
+        raise Exception(
+            "Shape of DWI series {} does not match number of b-values "
+            "({})".format(image.shape, len(bvals)))
+    if not len(indices):
+        raise Exception(
+            "No b0 volumes (b <= {}) found in DWI series".format(threshold))
+    if operation == 'first':
+        return np.asanyarray(image.dataobj[..., indices[0]])
+    total = np.zeros(image.shape[:3])
+    for index in indices:
+        total += image.dataobj[..., index]
+    return (total / len(indices)).astype(np.float32)
+
+
+def prepare_tbss_fa(fa):
+    """
+    Prepares an FA map for registration in the same way as FSL's
+    'tbss_1_preproc' ('fslmaths -min 1 -ero -roi ...'), i.e. clamps it to
+    1, erodes it to remove brain-edge artifacts and zeros the end slices,
+    and creates the mask used to weight the nonlinear registration (which
+    excludes a rim of voxels just outside the brain)
+
+    Parameters
+    ----------
+    fa : np.ndarray
+        The FA map
+
+    Returns
+    -------
+    prepared : np.ndarray
+        The prepared FA map
+    mask : np.ndarray
+        The registration mask
+    """
+    prepared = np.minimum(fa, 1.0)
+    box = np.ones((3, 3, 3), dtype=bool)
+    eroded = ndimage.binary_erosion(prepared != 0, structure=box,
+                                    border_value=1)
+    prepared = np.where(eroded, prepared, 0).astype(np.float32)
+    inner = (slice(1, -1),) * 3
+    edges = np.ones(prepared.shape, dtype=bool)
+    edges[inner] = False
+    prepared[edges] = 0
+    brain = prepared != 0
+    dilated = ndimage.binary_dilation(brain, structure=box, iterations=2)
+    mask = (brain | ~dilated).astype(np.uint8)
+    return prepared, mask
+
+
+def load_response(path):
+    "Loads an MRtrix response function (a row of coefficients per shell)"
+    return np.atleast_2d(np.loadtxt(path, comments='#'))
+
+
+def save_response(path, response):
+    "Saves a response function so that it can be reloaded exactly"
+    np.savetxt(path, np.atleast_2d(response), fmt='%.17g')
+
+
+class ResponseSum(object):
+    """
+    Running sum of response functions, held exactly (as fractions) so that
+    adding responses one at a time gives exactly the same, correctly
+    rounded, average as summing them all at once in any order. Also holds
+    the reference response, i.e. the average last used to estimate FODs
+
+    Parameters
+    ----------
+    ids : list(str)
+        The IDs of the responses that have been added
+    total : np.ndarray(Fraction) | None
+        The exact sum of the responses
+    reference : np.ndarray | None
+        The reference response
+    """
+
+    def __init__(self, ids=(), total=None, reference=None):
+        self.ids = list(ids)
+        self.total = total
+        self.reference = reference
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def add(self, id, response):  # @ReservedAssignment
+        """
+        Adds a response to the sum unless one with the same ID has already
+        been added. Returns whether the response was added
+        """
+        if id in self.ids:
+            return False
+        exact = np.vectorize(Fraction, otypes=[object])(
+            np.atleast_2d(response))
+        if self.total is None:
+            self.total = exact
+        elif self.total.shape != exact.shape:
+            raise Exception(
+                "Shape of response '{}' {} does not match that of the "
+                "responses already averaged {}".format(
+                    id, exact.shape, self.total.shape))
+        else:
+            self.total = self.total + exact
+        self.ids.append(id)
+        return True
+
+    def mean(self):
+        return np.vectorize(float, otypes=[float])(self.total / self.count)
+
+    def drift(self, response):
+        """
+        The change in the given response relative to the reference response
+        (relative Frobenius norm of the difference)
+        """
+        if self.reference is None:
+            return float('inf')
+        return float(np.linalg.norm(response - self.reference) /
+                     np.linalg.norm(self.reference))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'ids': self.ids,
+                'total': [[str(v) for v in row] for row in self.total],
+                'reference': (self.reference.tolist()
+                              if self.reference is not None else None)},
+                f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        total = np.array([[Fraction(v) for v in row]
+                          for row in state['total']], dtype=object)
+        reference = (np.array(state['reference'])
+                     if state['reference'] is not None else None)
+        return cls(state['ids'], total, reference)
+
+
+def se_epi_pair(forward, bvals, reverse, threshold=B0_THRESHOLD):
+    """
+    Creates the spin-echo EPI pair for distortion correction, i.e. the first
+    b0 of the forward phase-encoded series followed by the volume(s) of the
+    reverse phase-encoded image, reading only those volumes from disk. The
+    two images must share the same voxel grid and orientation
+
+    Parameters
+    ----------
+    forward : nibabel.SpatialImage
+        The forward phase-encoded DWI series (4D)
+    bvals : np.ndarray
+        The b-values of the forward series
+    reverse : nibabel.SpatialImage
+        The reverse phase-encoded image (3D or 4D)
+    threshold : float
+        Volumes with b-values at or below this are treated as b0s
+
+    Returns
+    -------
+    pair : np.ndarray
+        The forward b0 and the reverse volume(s) concatenated along the 4th
+        axis
+    """
+    if reverse.shape[:3] != forward.shape[:3]:
+        raise Exception(
+            "Dimensions of reverse phase-encoded image {} do not match "
+            "those of the DWI series {}".format(reverse.shape[:3],
+                                                forward.shape[:3]))
+    # The series are converted separately so check they haven't ended up
+    # with different voxel orderings (or positions), which topup would
+    # otherwise silently treat as a misregistered pair
+    if not np.allclose(reverse.affine, forward.affine, atol=1e-3):
+        raise Exception(
+            "Voxel-to-world transform of reverse phase-encoded image\n{}\n"
+            "does not match that of the DWI series\n{}\n(they may have been "
+            "converted with different axis orderings)".format(
+                reverse.affine, forward.affine))
+    num_reverse = reverse.shape[3] if reverse.ndim == 4 else 1
+    pair = np.empty(forward.shape[:3] + (1 + num_reverse,), dtype=np.float32)
+    pair[..., 0] = extract_b0(forward, bvals, operation='first',
+                              threshold=threshold)
+    if reverse.ndim == 4:
+        for i in range(num_reverse):
+            pair[..., i + 1] = reverse.dataobj[..., i]
+    else:
+        pair[..., 1] = np.asanyarray(reverse.dataobj)
+    return pair
+
+
+def dwi_qc_summary(dwi, bvals, mask, fa=None, md=None, motion_par=None,
+                   threshold=B0_THRESHOLD, outlier_threshold=4.0,
+                   min_slice_voxels=100, max_size=DEFAULT_SLAB_SIZE):
+    """
+    Calculates summary statistics of a preprocessed DWI series for quality
+    control, streaming the series a slab of volumes at a time so that it is
+    only read once and never held in memory in full
+
+    Parameters
+    ----------
+    dwi : nibabel.SpatialImage
+        The preprocessed DWI series (4D)
+    bvals : np.ndarray
+        The b-values of the volumes
+    mask : np.ndarray
+        The brain mask the statistics are calculated within
+    fa : np.ndarray | None
+        The FA map
+    md : np.ndarray | None
+        The mean diffusivity (ADC) map
+    motion_par : np.ndarray | None
+        The motion parameters estimated by eddy (translations in mm
+        followed by rotations in radians in the first 6 columns)
+    threshold : float
+        Volumes with b-values at or below this are treated as b0s
+    outlier_threshold : float
+        Number of (robust) standard deviations the mean signal of a slice
+        needs to drop below those of the other volumes in the same shell
+        for it to be counted as an outlier
+    min_slice_voxels : int
+        Slices with fewer voxels in the mask than this are not checked for
+        outliers
+    max_size : int
+        The maximum size of the slabs the series is read in (in bytes)
+
+    Returns
+    -------
+    summary : dict
+        The summary statistics
+    """
+    bvals = np.asarray(bvals, dtype=float)
+    mask = np.asarray(mask) > 0
+    if dwi.ndim != 4 or dwi.shape[3] != len(bvals):
+        raise Exception(
+            "Shape of DWI series {} does not match number of b-values "
+            "({})".format(dwi.shape, len(bvals)))
+    if mask.shape != dwi.shape[:3]:
+        raise Exception(
+            "Dimensions of mask {} do not match those of the DWI series "
+            "{}".format(mask.shape, dwi.shape[:3]))
+    is_b0 = bvals <= threshold
+    num_b0 = int(is_b0.sum())
+    slice_voxels = mask.sum(axis=(0, 1))
+    slice_means = np.zeros((len(bvals), dwi.shape[2]))
+    b0_sum = np.zeros(int(mask.sum()))
+    b0_sum_sq = np.zeros_like(b0_sum)
+    for slc, slab in iter_slabs(dwi, max_size=max_size, dtype=np.float32):
+        # Mean signal within the mask of each slice of each volume
+        slice_sums = np.einsum('ijzv,ijz->vz', slab, mask, dtype=float)
+        slice_means[slc] = slice_sums / np.maximum(slice_voxels, 1)
+        b0s = is_b0[slc]
+        if b0s.any():
+            masked = slab[mask][:, b0s].astype(float)
+            b0_sum += masked.sum(axis=1)
+            b0_sum_sq += (masked ** 2).sum(axis=1)
+    summary = {'num_volumes': len(bvals), 'num_b0': num_b0,
+               'mask_voxels': int(mask.sum()),
+               'mask_volume': float(mask.sum() * np.prod(
+                   dwi.header.get_zooms()[:3]))}
+    if num_b0:
+        b0_mean = b0_sum / num_b0
+        summary['b0_mean'] = float(b0_mean.mean())
+        # Temporal SNR of the b0s, which requires at least two of them
+        if num_b0 > 1:
+            b0_var = np.maximum(b0_sum_sq / num_b0 - b0_mean ** 2, 0)
+            b0_std = np.sqrt(b0_var * num_b0 / (num_b0 - 1))
+            valid = b0_std > 0
+            summary['b0_snr'] = (float(np.median(b0_mean[valid] /
+                                                 b0_std[valid]))
+                                 if valid.any() else None)
+        else:
+            summary['b0_snr'] = None
+    # Slices whose mean signal drops well below that of the other volumes
+    # in the same shell (e.g. due to signal dropout from bulk motion)
+    checked = slice_voxels >= min_slice_voxels
+    outliers = np.zeros(slice_means.shape, dtype=bool)
+    shells = np.round(bvals, -2)
+    for shell in np.unique(shells[~is_b0]):
+        volumes = np.flatnonzero((shells == shell) & ~is_b0)
+        if len(volumes) < 3:
+            continue
+        means = slice_means[volumes][:, checked]
+        median = np.median(means, axis=0)
+        spread = 1.4826 * np.median(np.abs(means - median), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (median - means) / spread
+        outliers[np.ix_(volumes, checked)] = (spread > 0) & (
+            z > outlier_threshold)
+    summary['outlier_slices'] = int(outliers.sum())
+    summary['outlier_volumes'] = int(outliers.any(axis=1).sum())
+    for name, metric in (('fa', fa), ('md', md)):
+        if metric is None:
+            continue
+        metric = np.asarray(metric)
+        if metric.shape != mask.shape:
+            raise Exception(
+                "Dimensions of {} map {} do not match those of the mask "
+                "{}".format(name.upper(), metric.shape, mask.shape))
+        values = metric[mask].astype(float)
+        summary[name + '_mean'] = float(values.mean())
+        summary[name + '_std'] = float(values.std())
+        summary[name + '_median'] = float(np.median(values))
+    if motion_par is not None:
+        motion_par = np.atleast_2d(motion_par)
+        summary['max_translation'] = float(
+            np.linalg.norm(motion_par[:, :3], axis=1).max())
+        summary['max_rotation'] = float(
+            np.degrees(np.abs(motion_par[:, 3:6])).max())
+    return summary
+
+
+def odi_to_kappa(odi):
+    "Converts orientation dispersion indices to Watson concentrations"
+    return 1.0 / np.tan(np.asarray(odi) * np.pi / 2)
+
+
+def kappa_to_odi(kappa):
+    "Converts Watson concentrations to orientation dispersion indices"
+    return 2.0 / np.pi * np.arctan(1.0 / np.asarray(kappa))
+
+
+def sphere_points(num_points):
+    "Approximately uniformly distributed points on the unit sphere"
+    index = np.arange(num_points) + 0.5
+    z = 1 - 2 * index / num_points
+    phi = np.pi * (1 + 5 ** 0.5) * index
+    radius = np.sqrt(1 - z ** 2)
+    return np.column_stack([radius * np.cos(phi), radius * np.sin(phi), z])
+
+
+def noddi_atoms(bvals, cos_angles, odis, icvfs,
+                dpar=NODDI_PARALLEL_DIFFUSIVITY,
+                diso=NODDI_ISO_DIFFUSIVITY, num_points=10000):
+    """
+    Calculates the signals of the NODDI dictionary atoms, i.e. mixtures of
+    Watson-distributed sticks (intra-cellular) and the corresponding
+    zeppelins (extra-cellular, with tortuous perpendicular diffusivity) for
+    each pair of ODI and intra-cellular volume fraction, followed by an
+    isotropic ball (free water)
+
+    Parameters
+    ----------
+    bvals : np.ndarray
+        The b-values (s/mm^2) to calculate the signals for
+    cos_angles : np.ndarray
+        Cosines of the angles between the gradient and the mean fibre
+        direction to calculate the signals for
+    odis : np.ndarray
+        The orientation dispersion indices of the atoms
+    icvfs : np.ndarray
+        The intra-cellular volume fractions of the atoms
+    dpar : float
+        Intrinsic parallel diffusivity (mm^2/s)
+    diso : float
+        Isotropic diffusivity (mm^2/s)
+    num_points : int
+        Number of points used to integrate over the Watson distributions
+
+    Returns
+    -------
+    atoms : np.ndarray
+        Signals of the atoms (b-values x angles x atoms), with the
+        anisotropic atoms ordered by ODI then volume fraction
+    """
+    bvals = np.asarray(bvals, dtype=float)
+    cos_angles = np.asarray(cos_angles, dtype=float)
+    points = sphere_points(num_points)
+    sin_angles = np.sqrt(np.maximum(1 - cos_angles ** 2, 0))
+    # Squared projections of the gradient onto the points of the sphere,
+    # with the mean fibre direction along z (angles x points)
+    proj2 = (sin_angles[:, None] * points[:, 0] +
+             cos_angles[:, None] * points[:, 2]) ** 2
+    atoms = np.empty((len(bvals), len(cos_angles),
+                      len(odis) * len(icvfs) + 1))
+    for i, kappa in enumerate(odi_to_kappa(odis)):
+        weights = np.exp(kappa * (points[:, 2] ** 2 - 1))
+        weights /= weights.sum()
+        # Mean squared projection of the fibres onto their mean direction
+        tau = weights.dot(points[:, 2] ** 2)
+        for k, bval in enumerate(bvals):
+            stick = np.exp(-bval * dpar * proj2).dot(weights)
+            for j, icvf in enumerate(icvfs):
+                dperp = dpar * (1 - icvf)
+                zeppelin = np.exp(-bval * (
+                    dperp + (dpar - dperp) *
+                    (tau * cos_angles ** 2 +
+                     (1 - tau) / 2 * sin_angles ** 2)))
+                atoms[k, :, i * len(icvfs) + j] = (
+                    icvf * stick + (1 - icvf) * zeppelin)
+    atoms[..., -1] = np.exp(-bvals * diso)[:, None]
+    return atoms
+
+
+class NODDIDictionary(object):
+    """
+    Look-up table of the signals of the NODDI dictionary atoms (see
+    'noddi_atoms') for the shells of an acquisition, tabulated against the
+    squared cosine of the angle between each gradient and the fibre
+    direction so the dictionary can be "rotated" onto the fibre direction
+    of each voxel by interpolation (as in AMICO)
+
+    Parameters
+    ----------
+    bvals : np.ndarray
+        The b-values of the acquisition
+    num_odis : int
+        Number of ODIs sampled by the dictionary
+    num_icvfs : int
+        Number of intra-cellular volume fractions sampled by the dictionary
+    num_samples : int
+        Number of angles at which the atoms are tabulated
+    shell_precision : float
+        b-values within this distance of each other are treated as one shell
+    """
+
+    def __init__(self, bvals, num_odis=12, num_icvfs=12, num_samples=256,
+                 shell_precision=10.0, **kwargs):
+        self.odis = np.linspace(0.01, 0.99, num_odis)
+        self.icvfs = np.linspace(0.01, 0.99, num_icvfs)
+        shells, self.shell_index = np.unique(
+            np.round(np.asarray(bvals) / shell_precision) * shell_precision,
+            return_inverse=True)
+        self.cos2 = np.linspace(0, 1, num_samples)
+        self.table = noddi_atoms(shells, np.sqrt(self.cos2), self.odis,
+                                 self.icvfs, **kwargs)
+
+    @property
+    def num_atoms(self):
+        return self.table.shape[-1]
+
+    def atom_odis(self):
+        return np.repeat(self.odis, len(self.icvfs))
+
+    def atom_icvfs(self):
+        return np.tile(self.icvfs, len(self.odis))
+
+    def rotate(self, bvecs, direction):
+        """
+        Returns the dictionary for a voxel with the given fibre direction
+        (volumes x atoms)
+        """
+        cos2 = np.minimum(bvecs.dot(direction) ** 2, 1.0)
+        position = cos2 * (len(self.cos2) - 1)
+        lower = np.minimum(position.astype(int), len(self.cos2) - 2)
+        frac = (position - lower)[:, None]
+        return ((1 - frac) * self.table[self.shell_index, lower] +
+                frac * self.table[self.shell_index, lower + 1])
+
+
+def fit_noddi(signal, bvecs, bvals, dictionary,
+              b0_threshold=B0_THRESHOLD):
+    """
+    Fits the NODDI model to each row of 'signal' in the AMICO fashion: the
+    fibre direction is taken from a tensor fit, the dictionary rotated onto
+    it and the (b0-normalised) signal decomposed into the dictionary atoms by
+    non-negative least squares. The parameters are then the averages of
+    those of the atoms weighted by their contributions
+
+    Parameters
+    ----------
+    signal : np.ndarray
+        The measured signal (voxels x volumes)
+    bvecs : np.ndarray
+        Gradient directions (volumes x 3)
+    bvals : np.ndarray
+        b-values (volumes)
+    dictionary : NODDIDictionary
+        The dictionary for the acquisition
+    b0_threshold : float
+        Volumes with b-values at or below this are treated as unweighted
+
+    Returns
+    -------
+    params : dict(str, np.ndarray)
+        The 'ficvf', 'odi', 'kappa', 'fiso', 'fibredirs' (voxels x 3), 'fmin'
+        (mean squared residual of the normalised signal) and 'error_code'
+        (non-zero where the signal could not be fitted) of each voxel
+    """
+    num_voxels = signal.shape[0]
+    b0s = bvals <= b0_threshold
+    s0 = signal[:, b0s].mean(axis=1)
+    valid = np.isfinite(s0) & (s0 > 0)
+    params = {
+        'ficvf': np.zeros(num_voxels), 'odi': np.zeros(num_voxels),
+        'kappa': np.zeros(num_voxels), 'fiso': np.zeros(num_voxels),
+        'fibredirs': np.zeros((num_voxels, 3)),
+        'fmin': np.zeros(num_voxels),
+        'error_code': np.where(valid, 0, 1).astype(np.int16)}
+    if not valid.any():
+        return params
+    normalised = signal[valid] / s0[valid, None]
+    # Fibre directions from the principal eigenvectors of the tensors
+    tensors = fit_tensors(normalised, tensor_design_matrix(bvecs, bvals))
+    matrices = np.empty((len(tensors), 3, 3))
+    for k, (i, j) in enumerate(TENSOR_ELEMENTS):
+        matrices[:, i, j] = matrices[:, j, i] = tensors[:, k]
+    directions = np.linalg.eigh(matrices)[1][:, :, -1]
+    atom_odis = dictionary.atom_odis()
+    atom_icvfs = dictionary.atom_icvfs()
+    results = np.zeros((len(normalised), 4))
+    for v, (y, direction) in enumerate(zip(normalised, directions)):
+        atoms = dictionary.rotate(bvecs, direction)
+        weights, residual = nnls(atoms, y)
+        aniso = weights[:-1]
+        total = weights.sum()
+        if aniso.sum() > 0:
+            results[v, 0] = aniso.dot(atom_icvfs) / aniso.sum()
+            results[v, 1] = aniso.dot(atom_odis) / aniso.sum()
+        if total > 0:
+            results[v, 2] = weights[-1] / total
+        results[v, 3] = residual ** 2 / len(y)
+    odi = np.clip(results[:, 1], dictionary.odis[0], dictionary.odis[-1])
+    params['ficvf'][valid] = results[:, 0]
+    params['odi'][valid] = np.where(results[:, 1] > 0, odi, 0)
+    params['kappa'][valid] = np.where(results[:, 1] > 0,
+                                      odi_to_kappa(odi), 0)
+    params['fiso'][valid] = results[:, 2]
+    params['fmin'][valid] = results[:, 3]
+    params['fibredirs'][valid] = directions
+    return params
+
+
+def fit_noddi_image(dwi, mask, bvecs, bvals, nthreads=1,
+                    max_memory=DEFAULT_SLAB_SIZE, **kwargs):
+    """
+    Fits the NODDI model (see 'fit_noddi') to every voxel within the mask of
+    a DWI series, processing slabs of slices in parallel
+
+    Parameters
+    ----------
+    dwi : np.ndarray
+        The (possibly memory-mapped) 4D DWI data
+    mask : np.ndarray
+        Mask of the voxels to fit (3D)
+    bvecs : np.ndarray
+        Gradient directions (N x 3)
+    bvals : np.ndarray
+        b-values (N)
+    nthreads : int
+        Number of slabs processed in parallel
+    max_memory : int
+        Approximate limit (in bytes) on the memory used by all slabs in
+        flight at once
+    kwargs : dict
+        Passed on to 'fit_noddi'
+
+    Returns
+    -------
+    maps : dict(str, np.ndarray)
+        The maps of each of the parameters returned by 'fit_noddi'
+    """
+    shape = dwi.shape[:3]
+    dictionary = NODDIDictionary(bvals)
+    maps = {'fibredirs': np.zeros(shape + (3,), dtype=np.float32),
+            'error_code': np.zeros(shape, dtype=np.int16)}
+    for name in ('ficvf', 'odi', 'kappa', 'fiso', 'fmin'):
+        maps[name] = np.zeros(shape, dtype=np.float32)
+    voxel_bytes = 8 * 4 * len(bvals)
+    slice_voxels = max(int(np.count_nonzero(mask, axis=(0, 1)).max()), 1)
+    step = max(int(max_memory // (nthreads * voxel_bytes * slice_voxels)),
+               1)
+
+    def fit_slab(start):
+        stop = min(start + step, shape[2])
+        slab_mask = mask[:, :, start:stop]
+        if not slab_mask.any():
+            return
+        signal = np.asarray(dwi[:, :, start:stop, :], dtype=float)[slab_mask]
+        for name, values in fit_noddi(signal, bvecs, bvals, dictionary,
+                                      **kwargs).items():
+            maps[name][:, :, start:stop][slab_mask] = values
+
+    with ThreadPoolExecutor(max_workers=max(nthreads, 1)) as executor:
+        list(executor.map(fit_slab, range(0, shape[2], step)))
+    return maps
+
+
+class TensorFitInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True, desc="DWI series (4D)")
+    bvecs_file = File(mandatory=True, exists=True,
+                      desc="Gradient directions in FSL format")
+    bvals_file = File(mandatory=True, exists=True,
+                      desc="b-values in FSL format")
+    in_mask = File(exists=True, desc="Mask of the voxels to fit")
+    nthreads = traits.Int(1, usedefault=True, nohash=True,
+                          desc="Number of slabs fitted in parallel")
+    max_memory = traits.Int(
+        DEFAULT_SLAB_SIZE * 4, usedefault=True, nohash=True,
+        desc="Approximate limit on the memory used by the fit (in bytes)")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output images")
+
+
+class TensorFitOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Tensor image (6 elements)")
+    fa = File(exists=True, desc="Fractional anisotropy map")
+    md = File(exists=True, desc="Mean diffusivity (ADC) map")
+    ad = File(exists=True, desc="Axial diffusivity map")
+    rd = File(exists=True, desc="Radial diffusivity map")
+
+
+class TensorFit(BaseInterface):
+    """
+    Fits the diffusion tensor by weighted least squares on the log signal
+    and calculates the FA, MD, AD and RD maps in the same pass, in place of
+    'dwi2tensor' followed by 'tensor2metric'. Tensors are written in world
+    coordinates with their elements in the same order as 'dwi2tensor'
+    """
+
+    input_spec = TensorFitInputSpec
+    output_spec = TensorFitOutputSpec
+
+    metric_names = ('fa', 'md', 'ad', 'rd')
+
+    def _run_interface(self, runtime):
+        image, dwi = load_image_data(self.inputs.in_file)
+        if isdefined(self.inputs.in_mask):
+            mask = np.asanyarray(nib.load(self.inputs.in_mask).dataobj) > 0
+        else:
+            mask = np.ones(dwi.shape[:3], dtype=bool)
+        bvecs, bvals = load_fsl_gradients(
+            self.inputs.bvecs_file, self.inputs.bvals_file,
+            affine=image.affine)
+        tensors, metrics = fit_tensor_image(
+            dwi, mask, bvecs, bvals, nthreads=self.inputs.nthreads,
+            max_memory=self.inputs.max_memory)
+        header = image.header.copy()
+        header.set_data_dtype(np.float32)
+        outputs = self._list_outputs()
+        nib.save(nib.Nifti1Image(tensors, image.affine, header),
+                 outputs['out_file'])
+        for name, metric in zip(self.metric_names, metrics):
+            nib.save(nib.Nifti1Image(metric, image.affine, header),
+                     outputs[name])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.join(
+            os.getcwd(), 'tensor' + self.inputs.out_ext)
+        for name in self.metric_names:
+            outputs[name] = os.path.join(
+                os.getcwd(), name + self.inputs.out_ext)
+        return outputs
+
+
+class NODDIFitInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True, desc="DWI series (4D)")
+    bvecs_file = File(mandatory=True, exists=True,
+                      desc="Gradient directions in FSL format")
+    bvals_file = File(mandatory=True, exists=True,
+                      desc="b-values in FSL format")
+    in_mask = File(exists=True, desc="Mask of the voxels to fit")
+    b0_threshold = traits.Float(
+        B0_THRESHOLD, usedefault=True,
+        desc="Volumes with b-values at or below this are treated as b0s")
+    nthreads = traits.Int(1, usedefault=True, nohash=True,
+                          desc="Number of slabs fitted in parallel")
+    max_memory = traits.Int(
+        DEFAULT_SLAB_SIZE, usedefault=True, nohash=True,
+        desc="Approximate limit on the memory used by the fit (in bytes)")
+    out_ext = traits.Str('.nii', usedefault=True,
+                         desc="Extension of the output images")
+
+
+class NODDIFitOutputSpec(TraitedSpec):
+    ficvf = File(
+        exists=True,
+        desc="Neurite density (or intra-cellular volume fraction)")
+    odi = File(exists=True, desc="Orientation dispersion index")
+    fiso = File(exists=True, desc="CSF volume fraction")
+    fibredirs_xvec = File(exists=True, desc="X fibre orientation")
+    fibredirs_yvec = File(exists=True, desc="Y fibre orientation")
+    fibredirs_zvec = File(exists=True, desc="Z fibre orientation")
+    fmin = File(exists=True, desc="Mean squared residuals of the fit")
+    kappa = File(exists=True, desc="Watson concentration parameter")
+    error_code = File(exists=True,
+                      desc="Non-zero where the fit could not be performed")
+
+
+class NODDIFit(BaseInterface):
+    """
+    Fits the NODDI (Watson stick, tortuous zeppelin and isotropic ball)
+    model by decomposing the signal of each voxel into a dictionary of
+    precomputed responses with non-negative least squares, following the
+    linearised AMICO approach, in place of the NODDI MATLAB toolbox. Fibre
+    directions are given in the frame of the gradient directions, as they
+    are by the toolbox
+    """
+
+    input_spec = NODDIFitInputSpec
+    output_spec = NODDIFitOutputSpec
+
+    param_names = ('ficvf', 'odi', 'fiso', 'fmin', 'kappa', 'error_code')
+
+    def _run_interface(self, runtime):
+        image, dwi = load_image_data(self.inputs.in_file)
+        if isdefined(self.inputs.in_mask):
+            mask = np.asanyarray(nib.load(self.inputs.in_mask).dataobj) > 0
+        else:
+            mask = np.ones(dwi.shape[:3], dtype=bool)
+        bvecs, bvals = load_fsl_gradients(self.inputs.bvecs_file,
+                                          self.inputs.bvals_file)
+        maps = fit_noddi_image(
+            dwi, mask, bvecs, bvals, nthreads=self.inputs.nthreads,
+            max_memory=self.inputs.max_memory,
+            b0_threshold=self.inputs.b0_threshold)
+        outputs = self._list_outputs()
+        for i, axis in enumerate('xyz'):
+            maps['fibredirs_{}vec'.format(axis)] = maps['fibredirs'][..., i]
+        del maps['fibredirs']
+        for name, values in maps.items():
+            header = image.header.copy()
+            header.set_data_dtype(values.dtype)
+            nib.save(nib.Nifti1Image(values, image.affine, header),
+                     outputs[name])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for name in self.param_names + tuple(
+                'fibredirs_{}vec'.format(a) for a in 'xyz'):
+            outputs[name] = os.path.join(
+                os.getcwd(), name + self.inputs.out_ext)
+        return outputs
+
+
+class ExtractB0InputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True, desc="DWI series (4D)")
+    bvals_file = File(mandatory=True, exists=True,
+                      desc="b-values in FSL format")
+    operation = traits.Enum('mean', 'first', usedefault=True,
+                            desc="Whether the mean or first b0 is extracted")
+    b0_threshold = traits.Float(
+        B0_THRESHOLD, usedefault=True,
+        desc="Volumes with b-values at or below this are treated as b0s")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output image")
+
+
+class ExtractB0OutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The mean or first b0 image")
+
+
+class ExtractB0(BaseInterface):
+    """
+    Extracts the mean or first b0 volume of a DWI series in a single pass,
+    in place of 'dwiextract -bzero' followed by 'mrmath mean' or
+    'mrconvert -coord 3 0'
+    """
+
+    input_spec = ExtractB0InputSpec
+    output_spec = ExtractB0OutputSpec
+
+    def _run_interface(self, runtime):
+        image = nib.load(self.inputs.in_file)
+        bvals = np.ravel(np.loadtxt(self.inputs.bvals_file))
+        b0 = extract_b0(image, bvals, operation=self.inputs.operation,
+                        threshold=self.inputs.b0_threshold)
+        header = image.header.copy()
+        header.set_data_dtype(b0.dtype)
+        nib.save(nib.Nifti1Image(b0, image.affine, header),
+                 self._list_outputs()['out_file'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        base = split_extension(os.path.basename(self.inputs.in_file))[0]
+        outputs['out_file'] = os.path.join(
+            os.getcwd(), '{}_b0{}'.format(base, self.inputs.out_ext))
+        return outputs
+
+
+class PrepareTBSSFAInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True, desc="FA map")
+
+
+class PrepareTBSSFAOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="FA map prepared for registration")
+    mask_file = File(exists=True, desc="Mask for the registration")
+
+
+class PrepareTBSSFA(BaseInterface):
+    """
+    Prepares a single FA map for TBSS in-process (see 'prepare_tbss_fa'),
+    so subjects can be registered independently of each other
+    """
+
+    input_spec = PrepareTBSSFAInputSpec
+    output_spec = PrepareTBSSFAOutputSpec
+
+    def _run_interface(self, runtime):
+        image, fa = load_image_data(self.inputs.in_file)
+        prepared, mask = prepare_tbss_fa(fa)
+        outputs = self._list_outputs()
+        for data, name in ((prepared, 'out_file'), (mask, 'mask_file')):
+            header = image.header.copy()
+            header.set_data_dtype(data.dtype)
+            nib.save(nib.Nifti1Image(data, image.affine, header),
+                     outputs[name])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        base = split_extension(os.path.basename(self.inputs.in_file))[0]
+        outputs['out_file'] = os.path.join(
+            os.getcwd(), base + '_prep.nii.gz')
+        outputs['mask_file'] = os.path.join(
+            os.getcwd(), base + '_mask.nii.gz')
+        return outputs
+
+
+class AverageResponsesInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc="Response functions to average")
+    subject_ids = traits.List(traits.Str, desc="Subject IDs of the responses")
+    visit_ids = traits.List(traits.Str, desc="Visit IDs of the responses")
+    in_state = File(exists=True,
+                    desc=("Running sum saved by a previous run, which the "
+                          "new responses are added to"))
+    drift_tolerance = traits.Float(
+        0.01, usedefault=True,
+        desc=("Relative change in the average below which the reference "
+              "response used to estimate FODs is left unchanged"))
+
+
+class AverageResponsesOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The averaged response")
+    reference_file = File(exists=True,
+                          desc="The response FODs should be estimated with")
+    state_file = File(exists=True, desc="The updated running sum")
+    drift = traits.Float(desc=("Relative change in the average from the "
+                               "reference response"))
+
+
+class AverageResponses(BaseInterface):
+    """
+    Averages response functions in-process in place of MRtrix's
+    'average_response'. The exact running sum is saved so that responses
+    of new sessions can be added to it without reloading the others, and
+    the average is only adopted as the reference response (for estimating
+    FODs) if it has drifted from the previous reference by more than the
+    tolerance
+    """
+
+    input_spec = AverageResponsesInputSpec
+    output_spec = AverageResponsesOutputSpec
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.in_state):
+            state = ResponseSum.load(self.inputs.in_state)
+        else:
+            state = ResponseSum()
+        if isdefined(self.inputs.subject_ids):
+            ids = ['{}_{}'.format(s, v) for s, v in zip(
+                self.inputs.subject_ids, self.inputs.visit_ids)]
+        else:
+            ids = [os.path.abspath(p) for p in self.inputs.in_files]
+        for id, path in zip(ids, self.inputs.in_files):  # @ReservedAssignment
+            # Responses already in the running sum don't need to be read
+            if id not in state.ids:
+                state.add(id, load_response(path))
+        average = state.mean()
+        self._drift = state.drift(average)
+        if self._drift > self.inputs.drift_tolerance:
+            state.reference = average
+        outputs = self._list_outputs()
+        save_response(outputs['out_file'], average)
+        save_response(outputs['reference_file'], state.reference)
+        state.save(outputs['state_file'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.join(os.getcwd(), 'avg_response.txt')
+        outputs['reference_file'] = os.path.join(os.getcwd(),
+                                                 'fod_response.txt')
+        outputs['state_file'] = os.path.join(os.getcwd(),
+                                             'response_sum.json')
+        if hasattr(self, '_drift'):
+            outputs['drift'] = self._drift
+        return outputs
+
+
+class PrepareSEEPIPairInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True,
+                   desc="Forward phase-encoded DWI series (4D)")
+    bvals_file = File(mandatory=True, exists=True,
+                      desc="b-values of the DWI series in FSL format")
+    reverse_file = File(mandatory=True, exists=True,
+                        desc="Reverse phase-encoded b0 image(s)")
+    pe_dir = traits.Str(mandatory=True,
+                        desc="Phase encoding axis, i.e. 'ROW' or 'COL'")
+    ped_polarity = traits.Str(mandatory=True,
+                              desc="Polarity of the phase encoding")
+    b0_threshold = traits.Float(
+        B0_THRESHOLD, usedefault=True,
+        desc="Volumes with b-values at or below this are treated as b0s")
+    readout_time = traits.Float(
+        mandatory=True, desc="Total readout time of the volumes (s)")
+
+
+class PrepareSEEPIPairOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The spin-echo EPI pair")
+    pe = traits.Str(desc="Phase encoding direction of the DWI series")
+    pe_1 = traits.Str(
+        desc="Phase encoding direction of the reverse phase-encoded image")
+    encoding_file = File(exists=True,
+                         desc="Acquisition parameters of the pair for topup")
+
+
+class PrepareSEEPIPair(BaseInterface):
+    """
+    Prepares the inputs to distortion correction in a single step, writing
+    the spin-echo EPI pair (see 'se_epi_pair') directly and resolving the
+    phase encoding directions as PrepareDWI does, in place of 'dwiextract',
+    'mrconvert -coord 3 0' and 'mrcat' followed by PrepareDWI. The
+    acquisition parameters of the pair are also written for topup
+    """
+
+    input_spec = PrepareSEEPIPairInputSpec
+    output_spec = PrepareSEEPIPairOutputSpec
+
+    def _run_interface(self, runtime):
+        self._pe, self._pe_1 = phase_encoding_directions(
+            self.inputs.pe_dir, self.inputs.ped_polarity)
+        forward = nib.load(self.inputs.in_file)
+        pair = se_epi_pair(
+            forward, np.ravel(np.loadtxt(self.inputs.bvals_file)),
+            nib.load(self.inputs.reverse_file),
+            threshold=self.inputs.b0_threshold)
+        header = forward.header.copy()
+        header.set_data_dtype(pair.dtype)
+        outputs = self._list_outputs()
+        nib.save(nib.Nifti1Image(pair, forward.affine, header),
+                 outputs['out_file'])
+        np.savetxt(outputs['encoding_file'],
+                   topup_encoding(self._pe, self.inputs.readout_time,
+                                  num_reverse=pair.shape[3] - 1),
+                   fmt='%g')
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.join(os.getcwd(), 'se_epi.nii.gz')
+        outputs['encoding_file'] = os.path.join(os.getcwd(),
+                                                'acqparams.txt')
+        if hasattr(self, '_pe'):
+            outputs['pe'] = self._pe
+            outputs['pe_1'] = self._pe_1
+        return outputs
+
+
+class DWIQCInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True,
+                   desc="Preprocessed DWI series (4D)")
+    bvals_file = File(mandatory=True, exists=True,
+                      desc="b-values in FSL format")
+    mask_file = File(mandatory=True, exists=True, desc="Brain mask")
+    fa_file = File(exists=True, desc="FA map")
+    md_file = File(exists=True, desc="Mean diffusivity (ADC) map")
+    eddy_par_file = File(exists=True,
+                         desc="Motion parameters estimated by eddy")
+    b0_threshold = traits.Float(
+        B0_THRESHOLD, usedefault=True,
+        desc="Volumes with b-values at or below this are treated as b0s")
+    outlier_threshold = traits.Float(
+        4.0, usedefault=True,
+        desc=("Number of standard deviations the signal of a slice needs to "
+              "drop by for it to be counted as an outlier"))
+    max_memory = traits.Int(
+        DEFAULT_SLAB_SIZE, usedefault=True, nohash=True,
+        desc="Maximum size of the slabs the series is read in (in bytes)")
+
+
+class DWIQCOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The QC summary statistics (JSON)")
+
+
+class DWIQC(BaseInterface):
+    """
+    Calculates the quality-control summary statistics of a DWI series and
+    its derived maps in a single streaming pass (see 'dwi_qc_summary') and
+    saves them in a JSON record
+    """
+
+    input_spec = DWIQCInputSpec
+    output_spec = DWIQCOutputSpec
+
+    def _run_interface(self, runtime):
+        maps = {}
+        for name in ('mask', 'fa', 'md'):
+            path = getattr(self.inputs, name + '_file')
+            if isdefined(path):
+                maps[name] = np.asanyarray(nib.load(path).dataobj)
+        if isdefined(self.inputs.eddy_par_file):
+            maps['motion_par'] = np.loadtxt(self.inputs.eddy_par_file)
+        summary = dwi_qc_summary(
+            nib.load(self.inputs.in_file),
+            np.ravel(np.loadtxt(self.inputs.bvals_file)),
+            threshold=self.inputs.b0_threshold,
+            outlier_threshold=self.inputs.outlier_threshold,
+            max_size=self.inputs.max_memory, **maps)
+        with open(self._list_outputs()['out_file'], 'w') as f:
+            json.dump(summary, f, indent=2)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.join(os.getcwd(), 'dwi_qc.json')
+        return outputs
+
+
+class CollateQCInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc="QC records of the sessions")
+    subject_ids = traits.List(traits.Str, mandatory=True,
+                              desc="Subject IDs of the records")
+    visit_ids = traits.List(traits.Str, mandatory=True,
+                            desc="Visit IDs of the records")
+
+
+class CollateQCOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Table of the QC records (CSV)")
+
+
+class CollateQC(BaseInterface):
+    """
+    Collates the QC records of each session into a single table with a row
+    per session
+    """
+
+    input_spec = CollateQCInputSpec
+    output_spec = CollateQCOutputSpec
+
+    def _run_interface(self, runtime):
+        rows = []
+        for path, subject_id, visit_id in sorted(zip(
+                self.inputs.in_files, self.inputs.subject_ids,
+                self.inputs.visit_ids), key=lambda r: r[1:]):
+            with open(path) as f:
+                record = json.load(f)
+            rows.append(dict(record, subject_id=subject_id,
+                             visit_id=visit_id))
+        columns = ['subject_id', 'visit_id']
+        for row in rows:
+            columns.extend(c for c in row if c not in columns)
+        with open(self._list_outputs()['out_file'], 'w') as f:
+            writer = csv.DictWriter(f, columns, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.join(os.getcwd(), 'dwi_qc.csv')
+        return outputs
+
+
+class EddyIndexInputSpec(BaseInterfaceInputSpec):
+    bvals_file = File(mandatory=True, exists=True,
+                      desc="b-values of the DWI series in FSL format")
+    row = traits.Int(
+        1, usedefault=True,
+        desc=("Row of the acquisition parameters file (starting at 1) "
+              "that applies to the volumes"))
+
+
+class EddyIndexOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The index file for eddy")
+
+
+class EddyIndex(BaseInterface):
+    """
+    Writes the index file for eddy, assigning every volume of a DWI series
+    acquired with a single phase encoding to the same row of the
+    acquisition parameters
+    """
+
+    input_spec = EddyIndexInputSpec
+    output_spec = EddyIndexOutputSpec
+
+    def _run_interface(self, runtime):
+        num_volumes = len(np.ravel(np.loadtxt(self.inputs.bvals_file)))
+        np.savetxt(self._list_outputs()['out_file'],
+                   np.full((1, num_volumes), self.inputs.row), fmt='%d')
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.join(os.getcwd(), 'index.txt')
+        return outputs
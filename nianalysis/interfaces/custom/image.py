@@ -0,0 +1,628 @@
+import os.path
+import numpy as np
+import nibabel as nib
+from nibabel.orientations import (
+    io_orientation, axcodes2ornt, ornt_transform, inv_ornt_aff,
+    apply_orientation)
+from scipy import ndimage as ndi
+from nipype.interfaces.base import (
+    TraitedSpec, BaseInterface, BaseInterfaceInputSpec, File, traits,
+    isdefined, InputMultiPath, OutputMultiPath)
+from nipype.interfaces.ants.resampling import ApplyTransforms
+from arcana.utils import split_extension
+from nianalysis.utils import load_image_data, DEFAULT_SLAB_SIZE
+
+
+# The orientation of the MNI152 templates distributed with FSL, which
+# 'fslreorient2std' reorients images to
+STANDARD_AXCODES = ('L', 'A', 'S')
+
+
+def downsample(image, resolution, order=1):
+    """
+    Resamples an image onto a coarser grid with the given voxel size (in mm),
+    smoothing it first to avoid aliasing. The field of view is preserved and
+    axes that are already at least as coarse as the target resolution are
+    left untouched
+
+    Parameters
+    ----------
+    image : nibabel.Nifti1Image
+        The image to downsample
+    resolution : float
+        The target voxel size in mm
+    order : int
+        The order of the spline interpolation
+
+    Returns
+    -------
+    downsampled : nibabel.Nifti1Image
+        The downsampled image
+    """
+    data = np.asanyarray(image.dataobj, dtype=np.float32)
+    zooms = np.asarray(image.header.get_zooms()[:3], dtype=float)
+    factors = np.maximum(resolution / zooms, 1.0)
+    if np.all(factors == 1.0):
+        return image
+    # Gaussian matching the FWHM of the coarse voxels
+    sigma = np.sqrt(factors ** 2 - 1) / (2 * np.sqrt(2 * np.log(2)))
+    data = ndi.gaussian_filter(data, sigma)
+    shape = np.maximum(np.round(np.asarray(data.shape) / factors), 1)
+    shape = shape.astype(int)
+    # Align the voxel edges of the two grids so the FOV is preserved
+    factors = np.asarray(data.shape) / shape
+    offset = (factors - 1) / 2
+    resampled = ndi.affine_transform(data, factors, offset=offset,
+                                     output_shape=tuple(shape), order=order,
+                                     mode='nearest')
+    vox2vox = np.eye(4)
+    vox2vox[:3, :3] = np.diag(factors)
+    vox2vox[:3, 3] = offset
+    affine = image.affine.dot(vox2vox)
+    header = image.header.copy()
+    header.set_data_dtype(np.float32)
+    return nib.Nifti1Image(resampled, affine, header)
+
+
+def refine_mask(data, prob_mask, threshold=0.5, bet_fraction=0.1,
+                band_width=3):
+    """
+    Refines a coarse brain mask (e.g. an atlas mask back-projected from a
+    low-resolution registration) with a quick intensity/morphology pass. The
+    mask is thresholded, voxels darker than a BET-style robust threshold are
+    removed from a band around its boundary and the result is reduced to its
+    largest connected component and its holes filled
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The (full-resolution) image the mask is defined on
+    prob_mask : np.ndarray
+        The coarse mask, interpolated onto the grid of the image
+    threshold : float
+        Threshold applied to the coarse mask
+    bet_fraction : float
+        Fraction of the 2-98% intensity range above the 2nd percentile
+        below which voxels are considered background (as in BET)
+    band_width : int
+        Width (in voxels) of the band around the mask boundary that is
+        refined
+    """
+    mask = prob_mask > threshold
+    if not mask.any():
+        return mask
+    p2, p98 = np.percentile(data, (2, 98))
+    background = data < p2 + bet_fraction * (p98 - p2)
+    band = (ndi.binary_dilation(mask, iterations=band_width) &
+            ~ndi.binary_erosion(mask, iterations=band_width))
+    mask = (mask & ~(band & background))
+    mask = ndi.binary_opening(mask)
+    labels, num_labels = ndi.label(mask)
+    if num_labels > 1:
+        sizes = ndi.sum(mask, labels, range(1, num_labels + 1))
+        mask = labels == (np.argmax(sizes) + 1)
+    mask = ndi.binary_closing(mask, iterations=2)
+    return ndi.binary_fill_holes(mask)
+
+
+def reorient_resample(image, resolution=None, axcodes=STANDARD_AXCODES,
+                      order=3):
+    """
+    Reorients an image to the standard orientation (as 'fslreorient2std'
+    does), which only permutes and flips its axes, and optionally resamples
+    it to a new voxel size (as 'mrresize -voxel' does, keeping the corner of
+    the field of view fixed). The reorientation is folded into the
+    resampling so the data are interpolated at most once
+
+    Parameters
+    ----------
+    image : nibabel.Nifti1Image
+        The image to reorient (3D or 4D)
+    resolution : list(float)[3] | None
+        The new voxel size. If None the image is only reoriented
+    axcodes : tuple(str)[3]
+        The orientation to reorient the image to
+    order : int
+        Order of the spline interpolation used when resampling
+
+    Returns
+    -------
+    preprocessed : nibabel.Nifti1Image
+        The reoriented (and resampled) image
+    """
+    shape = image.shape
+    transform = ornt_transform(io_orientation(image.affine),
+                               axcodes2ornt(axcodes))
+    reoriented_affine = image.affine.dot(inv_ornt_aff(transform, shape))
+    # Input axis that each of the output axes is taken from
+    axes = np.argsort(transform[:, 0])
+    reoriented_shape = tuple(int(shape[i]) for i in axes)
+    header = image.header.copy()
+    if resolution is None:
+        data = apply_orientation(np.asanyarray(image.dataobj), transform)
+        new_image = nib.Nifti1Image(data, reoriented_affine, header)
+        new_image.set_qform(reoriented_affine, int(header['qform_code']))
+        new_image.set_sform(reoriented_affine, int(header['sform_code']))
+        return new_image
+    zooms = np.asarray(image.header.get_zooms()[:3], dtype=float)
+    zooms = zooms[axes]
+    factors = np.asarray(resolution, dtype=float) / zooms
+    new_shape = np.maximum(
+        np.round(np.asarray(reoriented_shape) / factors), 1).astype(int)
+    scale = np.eye(4)
+    scale[:3, :3] = np.diag(factors)
+    scale[:3, 3] = (factors - 1) / 2
+    new_affine = reoriented_affine.dot(scale)
+    # Maps voxels of the output grid directly onto the original grid
+    vox2vox = np.linalg.inv(image.affine).dot(new_affine)
+    data = np.asanyarray(image.dataobj)
+    volumes = (data.reshape(shape[:3] + (-1,)) if data.ndim > 3
+               else data[..., None])
+    resampled = np.empty(tuple(new_shape) + (volumes.shape[-1],),
+                         dtype=np.float32)
+    for i in range(volumes.shape[-1]):
+        ndi.affine_transform(
+            volumes[..., i].astype(np.float32), vox2vox[:3, :3],
+            offset=vox2vox[:3, 3], output_shape=tuple(new_shape),
+            output=resampled[..., i], order=order, mode='nearest')
+    resampled = resampled.reshape(tuple(new_shape) + shape[3:])
+    header.set_data_dtype(np.float32)
+    header.set_zooms(tuple(resolution) + header.get_zooms()[3:])
+    new_image = nib.Nifti1Image(resampled, new_affine, header)
+    new_image.set_qform(new_affine, int(header['qform_code']))
+    new_image.set_sform(new_affine, int(header['sform_code']))
+    return new_image
+
+
+def fsl_vox2mm(image):
+    """
+    Returns the matrix mapping voxel indices onto FSL's internal (scaled
+    voxel) coordinates, which have the x-axis flipped for images stored with
+    a positive determinant (as used in FLIRT matrices)
+    """
+    zooms = image.header.get_zooms()[:3]
+    vox2mm = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(image.affine[:3, :3]) > 0:
+        vox2mm[0, 0] = -zooms[0]
+        vox2mm[0, 3] = (image.shape[0] - 1) * zooms[0]
+    return vox2mm
+
+
+def header_transform_matrix(image, reference):
+    """
+    Returns the FLIRT-style matrix that aligns an image with a reference
+    using only the transforms stored in their headers (equivalent to the
+    matrix written by 'flirt -applyxfm -usesqform')
+    """
+    return fsl_vox2mm(reference).dot(np.linalg.inv(reference.affine)).dot(
+        image.affine).dot(np.linalg.inv(fsl_vox2mm(image)))
+
+
+def flirt_world_matrix(matrix, image, reference):
+    """
+    Converts a FLIRT matrix (which maps the scaled mm coordinates of the
+    image onto those of the reference, see 'fsl_vox2mm') into the equivalent
+    transform between their (RAS) world coordinates
+    """
+    return reference.affine.dot(np.linalg.inv(fsl_vox2mm(reference))).dot(
+        matrix).dot(fsl_vox2mm(image)).dot(np.linalg.inv(image.affine))
+
+
+def crop_matrix(image, cropped, start):
+    """
+    Returns the FLIRT matrix that maps an image onto a cropped copy of it,
+    i.e. voxel 'start' of the image onto the first voxel of the cropped
+    image, regardless of the affine stored in the header of the cropped
+    image
+    """
+    shift = np.eye(4)
+    shift[:3, 3] = -np.asarray(start, dtype=float)
+    return fsl_vox2mm(cropped).dot(shift).dot(
+        np.linalg.inv(fsl_vox2mm(image)))
+
+
+def write_itk_affine(world_matrix, path):
+    """
+    Writes a transform between (RAS) world coordinates, which maps the
+    moving image onto the fixed image, as an ITK text transform that can be
+    passed to antsApplyTransforms. ITK transforms map points of the fixed
+    image onto the moving image in LPS coordinates, so the matrix is
+    inverted and converted from RAS
+    """
+    ras2lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+    itk = ras2lps.dot(np.linalg.inv(world_matrix)).dot(ras2lps)
+    params = list(itk[:3, :3].ravel()) + list(itk[:3, 3])
+    with open(path, 'w') as f:
+        f.write('#Insight Transform File V1.0\n'
+                '#Transform 0\n'
+                'Transform: AffineTransform_double_3_3\n'
+                'Parameters: {}\n'
+                'FixedParameters: 0 0 0\n'.format(
+                    ' '.join('{:.10g}'.format(p) for p in params)))
+    return path
+
+
+def resample_to_reference(image, reference, order=1,
+                          max_size=DEFAULT_SLAB_SIZE, transform=None):
+    """
+    Resamples an image onto the grid of a reference image using the
+    transforms stored in their headers (and optionally an additional
+    transform between their world coordinates). The output is interpolated
+    in slabs along its third axis so the coordinates of the whole grid never
+    need to be held in memory at once
+
+    Parameters
+    ----------
+    image : nibabel.Nifti1Image
+        The image to resample (3D or 4D)
+    reference : nibabel.Nifti1Image
+        The image defining the grid to resample onto
+    order : int
+        Order of the spline interpolation (1 = trilinear)
+    max_size : int
+        Maximum size (in bytes) of each output slab
+    transform : np.ndarray | None
+        A 4x4 matrix mapping (RAS) world coordinates of the image onto world
+        coordinates of the reference (e.g. see 'flirt_world_matrix')
+
+    Returns
+    -------
+    resampled : np.ndarray
+        The resampled data (float32)
+    """
+    ref_shape = tuple(int(n) for n in reference.shape[:3])
+    ref_affine = reference.affine
+    if transform is not None:
+        ref_affine = np.linalg.inv(transform).dot(ref_affine)
+    vox2vox = np.linalg.inv(image.affine).dot(ref_affine)
+    data = np.asanyarray(image.dataobj)
+    volumes = (data.reshape(data.shape[:3] + (-1,)) if data.ndim > 3
+               else data[..., None])
+    out = np.empty(ref_shape + (volumes.shape[-1],), dtype=np.float32)
+    slab = max(max_size // (4 * ref_shape[0] * ref_shape[1]), 1)
+    for i in range(volumes.shape[-1]):
+        volume = volumes[..., i].astype(np.float32)
+        if order > 1:
+            # Only calculate the spline coefficients once for all slabs
+            volume = ndi.spline_filter(volume, order=order,
+                                       output=np.float32)
+        for start in range(0, ref_shape[2], slab):
+            stop = min(start + slab, ref_shape[2])
+            ndi.affine_transform(
+                volume, vox2vox[:3, :3],
+                offset=vox2vox[:3, 3] + vox2vox[:3, 2] * start,
+                output_shape=ref_shape[:2] + (stop - start,),
+                output=out[:, :, start:stop, i], order=order,
+                mode='constant', cval=0.0, prefilter=False)
+    return out.reshape(ref_shape + data.shape[3:])
+
+
+class DownsampleInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True, desc="Image to downsample")
+    resolution = traits.Float(mandatory=True,
+                              desc="The target voxel size (mm)")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output image")
+
+
+class DownsampleOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The downsampled image")
+
+
+class Downsample(BaseInterface):
+    """
+    Downsamples an image to a coarser (isotropic) resolution in-process
+    """
+
+    input_spec = DownsampleInputSpec
+    output_spec = DownsampleOutputSpec
+
+    def _run_interface(self, runtime):
+        nib.save(downsample(nib.load(self.inputs.in_file),
+                            self.inputs.resolution),
+                 self._gen_filename())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename()
+        return outputs
+
+    def _gen_filename(self):
+        base, _ = split_extension(os.path.basename(self.inputs.in_file))
+        return os.path.join(os.getcwd(),
+                            base + '_downsampled' + self.inputs.out_ext)
+
+
+class RefineBrainMaskInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True,
+                   desc="Image the brain is extracted from")
+    coarse_mask = File(mandatory=True, exists=True,
+                       desc=("Coarse (linearly interpolated) brain mask on "
+                             "the grid of the input image"))
+    threshold = traits.Float(0.5, usedefault=True,
+                             desc="Threshold applied to the coarse mask")
+    bet_fraction = traits.Float(
+        0.1, usedefault=True,
+        desc=("Fraction of the robust intensity range below which voxels on "
+              "the boundary of the mask are removed"))
+    band_width = traits.Int(3, usedefault=True,
+                            desc="Width of the refined boundary (voxels)")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output images")
+
+
+class RefineBrainMaskOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The extracted brain")
+    mask_file = File(exists=True, desc="The refined brain mask")
+
+
+class RefineBrainMask(BaseInterface):
+    """
+    Refines a coarse brain mask with a quick intensity/morphology pass (see
+    'refine_mask') and applies it to the image
+    """
+
+    input_spec = RefineBrainMaskInputSpec
+    output_spec = RefineBrainMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        img, data = load_image_data(self.inputs.in_file)
+        _, prob_mask = load_image_data(self.inputs.coarse_mask)
+        mask = refine_mask(data, prob_mask,
+                           threshold=self.inputs.threshold,
+                           bet_fraction=self.inputs.bet_fraction,
+                           band_width=self.inputs.band_width)
+        header = img.header.copy()
+        header.set_data_dtype(np.uint8)
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), img.affine, header),
+                 self._gen_filename('mask_file'))
+        nib.save(nib.Nifti1Image(np.where(mask, data, 0).astype(data.dtype),
+                                 img.affine, img.header),
+                 self._gen_filename('out_file'))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        outputs['mask_file'] = self._gen_filename('mask_file')
+        return outputs
+
+    def _gen_filename(self, name):
+        base, _ = split_extension(os.path.basename(self.inputs.in_file))
+        if name == 'out_file':
+            suffix = '_brain'
+        elif name == 'mask_file':
+            suffix = '_brain_mask'
+        else:
+            assert False
+        return os.path.join(os.getcwd(), base + suffix + self.inputs.out_ext)
+
+
+class ReorientResampleInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True, desc="Image to preprocess")
+    resolution = traits.List(
+        traits.Float(), minlen=3, maxlen=3,
+        desc="New voxel size of the image (not resampled if not provided)")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output image")
+
+
+class ReorientResampleOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The reoriented (resampled) image")
+
+
+class ReorientResample(BaseInterface):
+    """
+    Reorients an image to the standard (MNI) orientation and optionally
+    resamples it to a new resolution in a single pass (see
+    'reorient_resample'), in place of 'fslreorient2std' followed by
+    'mrresize'
+    """
+
+    input_spec = ReorientResampleInputSpec
+    output_spec = ReorientResampleOutputSpec
+
+    def _run_interface(self, runtime):
+        resolution = (self.inputs.resolution
+                      if isdefined(self.inputs.resolution) else None)
+        nib.save(reorient_resample(nib.load(self.inputs.in_file),
+                                   resolution=resolution),
+                 self._gen_filename())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename()
+        return outputs
+
+    def _gen_filename(self):
+        base, _ = split_extension(os.path.basename(self.inputs.in_file))
+        return os.path.join(os.getcwd(),
+                            base + '_reoriented' + self.inputs.out_ext)
+
+
+class QformTransformInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(
+        File(exists=True), mandatory=True,
+        desc="Images to resample onto the grid of the reference")
+    reference = File(mandatory=True, exists=True,
+                     desc="Image defining the grid to resample onto")
+    order = traits.Int(1, usedefault=True,
+                       desc="Order of the interpolation (1 = trilinear)")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output images")
+
+
+class QformTransformOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The first resampled image")
+    out_matrix_file = File(
+        exists=True, desc="The FLIRT-style matrix of the first image")
+    out_files = OutputMultiPath(File(exists=True),
+                                desc="The resampled images")
+    out_matrix_files = OutputMultiPath(
+        File(exists=True), desc="The FLIRT-style matrices of the images")
+
+
+class QformTransform(BaseInterface):
+    """
+    Resamples images onto the grid of a reference image using only the
+    transforms stored in their headers (in place of 'flirt -applyxfm
+    -usesqform'). Batches of images sharing the same reference are
+    resampled in a single node. Note that the resampled images are always
+    saved as float32, whereas FLIRT saves them in the data type of the
+    input image unless '-datatype' is given
+    """
+
+    input_spec = QformTransformInputSpec
+    output_spec = QformTransformOutputSpec
+
+    def _run_interface(self, runtime):
+        reference = nib.load(self.inputs.reference)
+        for in_file, out_file, mat_file in zip(
+                self.inputs.in_files, self._gen_filenames('out_files'),
+                self._gen_filenames('out_matrix_files')):
+            image = nib.load(in_file)
+            resampled = resample_to_reference(image, reference,
+                                              order=self.inputs.order)
+            header = reference.header.copy()
+            header.set_data_dtype(np.float32)
+            nib.save(nib.Nifti1Image(resampled, reference.affine, header),
+                     out_file)
+            np.savetxt(mat_file, header_transform_matrix(image, reference),
+                       fmt='%.10f')
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_files'] = self._gen_filenames('out_files')
+        outputs['out_matrix_files'] = self._gen_filenames('out_matrix_files')
+        outputs['out_file'] = outputs['out_files'][0]
+        outputs['out_matrix_file'] = outputs['out_matrix_files'][0]
+        return outputs
+
+    def _gen_filenames(self, name):
+        fnames = []
+        for i, in_file in enumerate(self.inputs.in_files):
+            base, _ = split_extension(os.path.basename(in_file))
+            # Prefix with the index to avoid clashes in batches
+            if len(self.inputs.in_files) > 1:
+                base = '{}_{}'.format(i, base)
+            if name == 'out_files':
+                fname = base + '_qformed' + self.inputs.out_ext
+            elif name == 'out_matrix_files':
+                fname = base + '_qformed.mat'
+            else:
+                assert False
+            fnames.append(os.path.join(os.getcwd(), fname))
+        return fnames
+
+
+class ApplyTransformChainInputSpec(BaseInterfaceInputSpec):
+    in_file = File(mandatory=True, exists=True,
+                   desc="Image (3D or 4D) to transform")
+    reference = File(mandatory=True, exists=True,
+                     desc="Image defining the output grid")
+    flirt_matrices = InputMultiPath(
+        File(exists=True),
+        desc=("FLIRT matrices applied to the image first, in the order they "
+              "are applied (i.e. the first maps the input image onto the "
+              "first of 'flirt_references')"))
+    flirt_references = InputMultiPath(
+        File(exists=True),
+        desc=("The reference image each of the FLIRT matrices was "
+              "calculated against, which define their coordinate systems "
+              "(only their headers are read)"))
+    transforms = InputMultiPath(
+        File(exists=True),
+        desc=("ANTs transforms (affines and warp fields) applied after the "
+              "FLIRT matrices, in the order used by antsApplyTransforms "
+              "(i.e. the last is applied first)"))
+    interpolation = traits.Enum(
+        'Linear', 'NearestNeighbor', 'BSpline', usedefault=True,
+        desc="The interpolation used to resample the image")
+    out_ext = traits.Str('.nii.gz', usedefault=True,
+                         desc="Extension of the output image")
+
+
+class ApplyTransformChainOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The transformed image")
+
+
+class ApplyTransformChain(BaseInterface):
+    """
+    Applies a chain of transforms (e.g. motion correction, alignment to a
+    reference and normalisation to a template) to an image with a single
+    resampling, instead of interpolating the image again at each step. The
+    FLIRT matrices are composed into a single affine, which is resampled
+    in-process if there are no ANTs transforms and otherwise appended to
+    them (as an ITK affine) for a single call to antsApplyTransforms
+    """
+
+    input_spec = ApplyTransformChainInputSpec
+    output_spec = ApplyTransformChainOutputSpec
+
+    interp_orders = {'NearestNeighbor': 0, 'Linear': 1, 'BSpline': 3}
+
+    def _run_interface(self, runtime):
+        image = nib.load(self.inputs.in_file)
+        world_matrix = self._compose_flirt(image)
+        transforms = (list(self.inputs.transforms)
+                      if isdefined(self.inputs.transforms) else [])
+        if not transforms:
+            reference = nib.load(self.inputs.reference)
+            resampled = resample_to_reference(
+                image, reference, transform=world_matrix,
+                order=self.interp_orders[self.inputs.interpolation])
+            header = reference.header.copy()
+            header.set_data_dtype(np.float32)
+            nib.save(nib.Nifti1Image(resampled, reference.affine, header),
+                     self._gen_filename())
+        else:
+            if world_matrix is not None:
+                # The FLIRT matrices are applied to the image first, i.e.
+                # last in antsApplyTransforms order
+                transforms.append(write_itk_affine(
+                    world_matrix, os.path.join(os.getcwd(), 'flirt.txt')))
+            apply_trans = ApplyTransforms()
+            apply_trans.inputs.input_image = self.inputs.in_file
+            apply_trans.inputs.reference_image = self.inputs.reference
+            apply_trans.inputs.transforms = transforms
+            apply_trans.inputs.interpolation = self.inputs.interpolation
+            apply_trans.inputs.input_image_type = 3 if image.ndim > 3 else 0
+            apply_trans.inputs.output_image = self._gen_filename()
+            apply_trans.run()
+        return runtime
+
+    def _compose_flirt(self, image):
+        """
+        Composes the FLIRT matrices into a single transform between the world
+        coordinates of the input image and those of the last reference
+        (None if there aren't any)
+        """
+        if not isdefined(self.inputs.flirt_matrices):
+            return None
+        matrices = self.inputs.flirt_matrices
+        references = (self.inputs.flirt_references
+                      if isdefined(self.inputs.flirt_references) else [])
+        if len(references) != len(matrices):
+            raise Exception(
+                "A reference image is required for each FLIRT matrix ({} "
+                "matrices, {} references)".format(
+                    len(matrices), len(references)))
+        composed = np.eye(4)
+        for mat_file, ref_file in zip(matrices, references):
+            reference = nib.load(ref_file)
+            composed = flirt_world_matrix(
+                np.loadtxt(mat_file), image, reference).dot(composed)
+            image = reference
+        return composed
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename()
+        return outputs
+
+    def _gen_filename(self):
+        base, _ = split_extension(os.path.basename(self.inputs.in_file))
+        return os.path.join(os.getcwd(), base + '_trans' + self.inputs.out_ext)
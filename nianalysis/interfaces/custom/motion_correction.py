@@ -18,8 +18,10 @@ except ImportError:
     pass
 from nipype.interfaces import fsl
 import pydicom
+from pydicom.errors import InvalidDicomError
+from nianalysis.utils import load_image_data
 import math
-import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 
 
 class MotionMatCalculationInputSpec(BaseInterfaceInputSpec):
@@ -148,6 +150,73 @@ class MergeListMotionMat(BaseInterface):
         return outputs
 
 
+def phase_encoding_directions(pe_dir, ped_polarity):
+    """
+    Resolves the phase encoding direction of a scan and of its reverse
+    phase-encoded counterpart from the DICOM phase encoding axis and the
+    sign of its polarity
+
+    Parameters
+    ----------
+    pe_dir : str
+        Phase encoding axis, i.e. 'ROW' or 'COL'
+    ped_polarity : float | str
+        Polarity of the phase encoding (only the sign is used)
+
+    Returns
+    -------
+    pe : str
+        Phase encoding direction of the scan (e.g. 'RL')
+    pe_reverse : str
+        Phase encoding direction of the reverse scan (e.g. 'LR')
+    """
+    directions = {('ROW', 1): 'RL', ('COL', 1): 'AP',
+                  ('ROW', -1): 'LR', ('COL', -1): 'PA'}
+    try:
+        pe = directions[(pe_dir, np.sign(float(ped_polarity)))]
+    except KeyError:
+        raise Exception(
+            "Unrecognised phase encoding direction '{}' with polarity "
+            "'{}'".format(pe_dir, ped_polarity))
+    return pe, pe[::-1]
+
+
+
+# Unit vectors of the phase encoding directions (as resolved by
+# 'phase_encoding_directions') in the convention of the topup encoding file
+PE_VECTORS = {'RL': (-1, 0, 0), 'LR': (1, 0, 0),
+              'AP': (0, -1, 0), 'PA': (0, 1, 0)}
+
+
+def topup_encoding(pe, readout_time, num_forward=1, num_reverse=1):
+    """
+    Creates the acquisition parameters for topup, i.e. one row per volume
+    with the phase encoding vector followed by the total readout time
+
+    Parameters
+    ----------
+    pe : str
+        Phase encoding direction of the forward volumes (e.g. 'RL')
+    readout_time : float
+        Total readout time of the volumes (s), which needs to match the
+        one eddy is given for the field estimated by topup (in Hz) to be
+        scaled correctly
+    num_forward : int
+        Number of forward phase-encoded volumes, which come first
+    num_reverse : int
+        Number of reverse phase-encoded volumes
+
+    Returns
+    -------
+    encoding : np.ndarray
+        The acquisition parameters ((num_forward + num_reverse) x 4)
+    """
+    vector = np.array(PE_VECTORS[pe])
+    return np.vstack(
+        [np.tile(np.append(vector, readout_time), (num_forward, 1)),
+         np.tile(np.append(-vector, readout_time), (num_reverse, 1))])
+
+
 class PrepareDWIInputSpec(BaseInterfaceInputSpec):
 
     pe_dir = traits.Str(mandatory=True, desc='Phase encoding direction, i.e. '
@@ -185,10 +254,9 @@ class PrepareDWI(BaseInterface):
         ped_polarity = float(self.inputs.ped_polarity)
         topup = self.inputs.topup
         if isdefined(self.inputs.dwi) and isdefined(self.inputs.dwi1):
+            # Only the headers are needed to determine the dimensions
             dwi = nib.load(self.inputs.dwi)
-            dwi = dwi.get_data()
             dwi1 = nib.load(self.inputs.dwi1)
-            dwi1 = dwi1.get_data()
             if len(dwi.shape) == 4 and len(dwi1.shape) == 3:
                 self.dict_output['main'] = self.inputs.dwi
                 self.dict_output['secondary'] = self.inputs.dwi1
@@ -199,24 +267,14 @@ class PrepareDWI(BaseInterface):
                 self.dict_output['main'] = self.inputs.dwi
                 self.dict_output['secondary'] = self.inputs.dwi1
             elif topup and len(dwi1.shape) == 4:
-                ref = nib.load(self.inputs.dwi1)
-                dwi1_b0 = dwi1[:, :, :, 0]
-                im2save = nib.Nifti1Image(dwi1_b0, affine=ref.affine)
+                dwi1_b0 = dwi1.dataobj[:, :, :, 0]
+                im2save = nib.Nifti1Image(dwi1_b0, affine=dwi1.affine)
                 nib.save(im2save, 'b0.nii.gz')
                 self.dict_output['main'] = self.inputs.dwi
                 self.dict_output['secondary'] = os.getcwd()+'/b0.nii.gz'
 
-        if np.sign(ped_polarity) == 1:
-            if pe_dir == 'ROW':
-                self.dict_output['pe'] = 'RL'
-            elif pe_dir == 'COL':
-                self.dict_output['pe'] = 'AP'
-        elif np.sign(ped_polarity) == -1:
-            if pe_dir == 'ROW':
-                self.dict_output['pe'] = 'LR'
-            elif pe_dir == 'COL':
-                self.dict_output['pe'] = 'PA'
-        self.dict_output['pe_1'] = self.dict_output['pe'][::-1]
+        self.dict_output['pe'], self.dict_output['pe_1'] = (
+            phase_encoding_directions(pe_dir, ped_polarity))
 
         return runtime
 
@@ -342,6 +400,47 @@ class GenTopupConfigFiles(BaseInterface):
         return outputs
 
 
+def motion_parameters_to_affines(motion_par, centre):
+    """
+    Converts rigid-body motion parameters (translations followed by rotations
+    about the x, y and z axes, as estimated by eddy) into 4x4 affine
+    matrices, with the rotations applied about the given centre. All volumes
+    are converted at once
+
+    Parameters
+    ----------
+    motion_par : np.ndarray
+        The motion parameters of each volume (N x 6)
+    centre : np.ndarray
+        The centre of rotation (in mm)
+
+    Returns
+    -------
+    affines : np.ndarray
+        The affine matrices (N x 4 x 4)
+    """
+    motion_par = np.atleast_2d(motion_par)
+    num_vols = len(motion_par)
+    cos = np.cos(motion_par[:, 3:6])
+    sin = np.sin(motion_par[:, 3:6])
+    rotations = []
+    for axis in range(3):
+        # Each rotation only affects the two axes it is orthogonal to
+        i, j = [a for a in range(3) if a != axis]
+        sign = -1 if axis == 1 else 1
+        rot = np.tile(np.eye(3), (num_vols, 1, 1))
+        rot[:, i, i] = rot[:, j, j] = cos[:, axis]
+        rot[:, i, j] = sign * sin[:, axis]
+        rot[:, j, i] = -sign * sin[:, axis]
+        rotations.append(rot)
+    rotation = np.matmul(np.matmul(rotations[0], rotations[1]), rotations[2])
+    centre = np.asarray(centre, dtype=float)
+    affines = np.tile(np.eye(4), (num_vols, 1, 1))
+    affines[:, :3, :3] = rotation
+    affines[:, :3, 3] = motion_par[:, :3] + centre - rotation.dot(centre)
+    return affines
+
+
 class AffineMatrixGenerationInputSpec(BaseInterfaceInputSpec):
 
     motion_parameters = File(exists=True, desc='File with all the motion '
@@ -371,76 +470,23 @@ class AffineMatrixGeneration(BaseInterface):
         motion_par = np.loadtxt(self.inputs.motion_parameters)
         motion_par = motion_par[:, :6]
         ref = nib.load(self.inputs.reference_image)
-        ref_data = ref.get_data()
-        # centre of mass
-        if len(ref_data.shape) == 4:
-            com = np.asarray(snm.center_of_mass(ref_data[:, :, :, 0]))
+        # centre of mass (only the first volume is read for 4D images)
+        if len(ref.shape) == 4:
+            com = np.asarray(snm.center_of_mass(ref.dataobj[:, :, :, 0]))
         else:
-            com = np.asarray(snm.center_of_mass(ref_data))
+            com = np.asarray(snm.center_of_mass(np.asanyarray(ref.dataobj)))
 
         hdr = ref.header
-        resolution = list(hdr.get_zooms()[:3])
-
-        for i in range(len(motion_par)):
-            mat = self.create_affine_mat(motion_par[i, :], resolution*com)
-            np.savetxt(
-                'affine_mat_{}.mat'.format(str(i).zfill(4)), mat, fmt='%f')
+        resolution = np.asarray(hdr.get_zooms()[:3])
 
-        affines = glob.glob('affine_mat*.mat')
+        affines = motion_parameters_to_affines(motion_par, resolution * com)
         os.mkdir(out_name)
-        for f in affines:
-            shutil.move(f, out_name)
+        for i, mat in enumerate(affines):
+            np.savetxt(os.path.join(out_name, 'affine_mat_{:04}.mat'.format(i)),
+                       mat, fmt='%f')
 
         return runtime
 
-    def create_affine_mat(self, mp, cog):
-
-        T = np.eye(4)
-
-        T[0, -1] = cog[0]
-        T[1, -1] = cog[1]
-        T[2, -1] = cog[2]
-
-        T_1 = np.linalg.inv(T)
-
-        tx = mp[0]
-        ty = mp[1]
-        tz = mp[2]
-        rx = mp[3]
-        ry = mp[4]
-        rz = mp[5]
-
-        Rx = np.eye(3)
-        Rx[1, 1] = np.cos(rx)
-        Rx[1, 2] = np.sin(rx)
-        Rx[2, 1] = -np.sin(rx)
-        Rx[2, 2] = np.cos(rx)
-        Ry = np.eye(3)
-        Ry[0, 0] = np.cos(ry)
-        Ry[0, 2] = -np.sin(ry)
-        Ry[2, 0] = np.sin(ry)
-        Ry[2, 2] = np.cos(ry)
-        Rz = np.eye(3)
-        Rz[0, 0] = np.cos(rz)
-        Rz[0, 1] = np.sin(rz)
-        Rz[1, 0] = -np.sin(rz)
-        Rz[1, 1] = np.cos(rz)
-        R_3x3 = np.dot(np.dot(Rx, Ry), Rz)
-
-        m = np.eye(4)
-        m[:3, :3] = R_3x3
-        m[0, 3] = tx
-        m[1, 3] = ty
-        m[2, 3] = tz
-
-        new_orig = np.dot(T, np.dot(m, T_1))[:, -1]
-
-        m[0, 3] = new_orig[0]
-        m[1, 3] = new_orig[1]
-        m[2, 3] = new_orig[2]
-
-        return m
-
     def _list_outputs(self):
         outputs = self._outputs().get()
 
@@ -507,8 +553,7 @@ class MeanDisplacementCalculation(BaseInterface):
             self.inputs.motion_mats, self.inputs.start_times,
             self.inputs.real_durations, self.inputs.trs,
             self.inputs.input_names))
-        ref = nib.load(self.inputs.reference)
-        ref_data = ref.get_data()
+        ref, ref_data = load_image_data(self.inputs.reference)
         # centre of gravity
         ref_cog = np.asarray(snm.center_of_mass(ref_data))
         list_inputs = sorted(list_inputs, key=lambda k: k[1])
@@ -1524,6 +1569,8 @@ class ReorientUmapInputSpec(BaseInterfaceInputSpec):
 
     umap = Directory(exists=True)
     niftis = traits.List()
+    num_threads = traits.Int(
+        4, usedefault=True, desc='Number of umaps reoriented in parallel')
 
 
 class ReorientUmapOutputSpec(TraitedSpec):
@@ -1531,33 +1578,79 @@ class ReorientUmapOutputSpec(TraitedSpec):
     reoriented_umaps = traits.List()
 
 
+def dicom_orientation(dicom_dir):
+    """
+    Returns the nibabel orientation (see nibabel.orientations) of the voxel
+    axes of the DICOM series in the directory, i.e. the axis ordering
+    MRtrix's -strides option would reproduce
+    """
+    dcms = sorted(f for f in os.listdir(dicom_dir) if not f.startswith('.'))
+    hdr = None
+    for dcm in dcms:
+        try:
+            hdr = pydicom.dcmread(os.path.join(dicom_dir, dcm),
+                                  stop_before_pixels=True)
+            break
+        except InvalidDicomError:
+            continue
+    if hdr is None:
+        raise Exception('No DICOM files found in {}'.format(dicom_dir))
+    try:
+        iop = hdr.ImageOrientationPatient
+    except AttributeError:
+        # Enhanced (multi-frame) DICOM
+        iop = (hdr.SharedFunctionalGroupsSequence[0]
+               .PlaneOrientationSequence[0].ImageOrientationPatient)
+    row_cos = np.array(iop[:3], dtype=float)
+    col_cos = np.array(iop[3:], dtype=float)
+    # Voxel axes in DICOM's LPS patient coords, flipped into RAS
+    axes = np.column_stack((row_cos, col_cos, np.cross(row_cos, col_cos)))
+    axes[:2, :] *= -1
+    affine = np.eye(4)
+    affine[:3, :3] = axes
+    return nib.orientations.io_orientation(affine)
+
+
 class ReorientUmap(BaseInterface):
     """Had to write this pipeline because I found out that sometimes the
     reoriented umaps (in nifti format) had different orientation with respect
-    to the original umap (dicom). This pipeline uses mrconvert to extract the
-    strides from the dicom umap and to apply them to each of the nifti umaps.
+    to the original umap (dicom). The axis ordering of the dicom umap is
+    computed once from its header and each of the nifti umaps is then
+    transposed/flipped (not resampled) to match it.
     """
     input_spec = ReorientUmapInputSpec
     output_spec = ReorientUmapOutputSpec
 
     def _run_interface(self, runtime):
 
-        niftis = self.inputs.niftis
-        umap = self.inputs.umap
-
-        for nifti in niftis:
-            _, base, ext = split_filename(nifti)
-            outname = base+'_reorient'+ext
-            cmd = ('mrconvert -strides {0} {1} {2}'
-                   .format(umap, nifti, outname))
-            sp.check_output(cmd, shell=True)
+        target = dicom_orientation(self.inputs.umap)
+        with ThreadPoolExecutor(
+                max_workers=max(self.inputs.num_threads, 1)) as executor:
+            list(executor.map(lambda n: self._reorient(n, target),
+                              self.inputs.niftis))
 
         return runtime
 
+    def _reorient(self, nifti, target):
+        outname = self._gen_outname(nifti)
+        img = nib.load(nifti)
+        transform = nib.orientations.ornt_transform(
+            nib.orientations.io_orientation(img.affine), target)
+        if (transform == [[0, 1], [1, 1], [2, 1]]).all():
+            # Already in the right orientation so no need to rewrite it
+            shutil.copyfile(nifti, outname)
+        else:
+            nib.save(img.as_reoriented(transform), outname)
+        return outname
+
+    def _gen_outname(self, nifti):
+        _, base, ext = split_filename(nifti)
+        return os.path.join(os.getcwd(), base+'_reorient'+ext)
+
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["reoriented_umaps"] = sorted(glob.glob(
-            os.getcwd()+'/*_reorient.*'))
+        outputs["reoriented_umaps"] = sorted(
+            self._gen_outname(n) for n in self.inputs.niftis)
 
         return outputs
@@ -13,6 +13,8 @@ import shutil
 import glob
 import pydicom
 from nipype.interfaces import fsl
+from nianalysis.utils import load_image_data
+from nianalysis.interfaces.custom.image import crop_matrix
 
 
 list_mode_framing_path = os.path.abspath(
@@ -59,10 +61,8 @@ class PETdr(BaseInterface):
         _, base, _ = split_filename(fname)
         _, base_map, _ = split_filename(mapname)
 
-        img = nib.load(fname)
-        data = np.array(img.get_data())
-        spatial_regressor = nib.load(mapname)
-        spatial_regressor = np.array(spatial_regressor.get_data())
+        img, data = load_image_data(fname)
+        _, spatial_regressor = load_image_data(mapname)
 
         n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
         ts = data.reshape(n_voxels, data.shape[3])
@@ -136,8 +136,7 @@ class GlobalTrendRemoval(BaseInterface):
         fname = self.inputs.volume
         _, base, _ = split_filename(fname)
 
-        img = nib.load(fname)
-        data = np.array(img.get_data())
+        img, data = load_image_data(fname)
 
         n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
         ts = data.reshape(n_voxels, data.shape[3])
@@ -190,14 +189,10 @@ class SUVRCalculation(BaseInterface):
         maskname = self.inputs.base_mask
         _, base, _ = split_filename(fname)
 
-        img = nib.load(fname)
-        data = np.array(img.get_data())
-        mask = nib.load(maskname)
-        mask = np.array(mask.get_data())
+        img, data = load_image_data(fname)
+        _, mask = load_image_data(maskname)
 
-        [x, y, z] = np.where(mask > 0)
-        ii = np.arange(x.shape[0])
-        mean_uptake = np.mean(data[x[ii], y[ii], z[ii]])
+        mean_uptake = np.mean(data[mask > 0])
         new_data = data / mean_uptake
         im2save = nib.Nifti1Image(new_data, affine=img.affine)
         nib.save(im2save, '{}_SUVR.nii.gz'.format(base))
@@ -523,6 +518,8 @@ class PETFovCroppingInputSpec(BaseInterfaceInputSpec):
 class PETFovCroppingOutputSpec(TraitedSpec):
 
     pet_cropped = File(exists=True, desc='Cropped PET')
+    crop_mat = File(exists=True, desc=('FLIRT matrix mapping the PET image '
+                                       'onto the cropped PET'))
 
 
 class PETFovCropping(BaseInterface):
@@ -547,13 +544,13 @@ class PETFovCropping(BaseInterface):
         new_affine[:3, -1] = (pet.affine[:3, -1]-np.multiply(
             pet.header.get_zooms()[:3], (x_min, y_min, z_min)) *
             np.sign(pet.affine[:3, -1]))
-        pet = pet.get_data()
+        # Only the cropped region is read from the image
         if len(pet.shape) == 3:
-            pet_cropped = pet[x_min:x_min+x_size, y_min:y_min+y_size,
-                              z_min:z_min+z_size]
+            pet_cropped = pet.dataobj[x_min:x_min+x_size, y_min:y_min+y_size,
+                                      z_min:z_min+z_size]
         elif len(pet.shape) == 4:
-            pet_cropped = pet[x_min:x_min+x_size, y_min:y_min+y_size,
-                              z_min:z_min+z_size, :]
+            pet_cropped = pet.dataobj[x_min:x_min+x_size, y_min:y_min+y_size,
+                                      z_min:z_min+z_size, :]
 #         cmd = 'fslroi {} ref_roi 100 130 100 130 20 100'.format(im)
 #         sp.check_output(cmd, shell=True)
 #         ref = nib.load(ref)
@@ -561,6 +558,8 @@ class PETFovCropping(BaseInterface):
         im2save.set_qform(new_affine, code='scanner')
         im2save.set_sform(new_affine, code='scanner')
         nib.save(im2save, outname)
+        np.savetxt('crop.mat', crop_matrix(pet, im2save,
+                                           (x_min, y_min, z_min)))
 
         return runtime
 
@@ -571,6 +570,7 @@ class PETFovCropping(BaseInterface):
         outname = basename+'_crop'+ext
 
         outputs["pet_cropped"] = os.getcwd()+'/'+outname
+        outputs["crop_mat"] = os.getcwd()+'/crop.mat'
 
         return outputs
 
@@ -688,6 +688,8 @@ class PetImageMotionCorrectionOutputSpec(TraitedSpec):
 
     pet_mc_image = File(desc='Motin corrected static PET results.')
     pet_no_mc_image = File(desc='Motin corrected static PET results.')
+    transformation_mat = File(desc='FLIRT matrix used to motion correct the '
+                              'PET image.')
 
 
 class PetImageMotionCorrection(BaseInterface):
@@ -778,6 +780,7 @@ class PetImageMotionCorrection(BaseInterface):
             .format(self.out_basename))[0]
         outputs["pet_no_mc_image"] = glob.glob(
             os.getcwd()+'/*no_mc_corr.nii.gz')[0]
+        outputs["transformation_mat"] = os.getcwd()+'/transformation.mat'
         return outputs
 
 
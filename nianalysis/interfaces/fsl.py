@@ -8,6 +8,10 @@ from nipype.interfaces.base import (
     Directory)
 from glob import glob
 from nipype.interfaces.fsl.base import (FSLCommand, FSLCommandInputSpec)
+from nipype.interfaces.fsl.preprocess import (
+    FLIRT as BaseFLIRT, FLIRTInputSpec as BaseFLIRTInputSpec)
+from nipype.interfaces.fsl.epi import Eddy as BaseEddy
+from arcana.utils import split_extension
 import logging
 from nipype.interfaces.base import isdefined
 import nibabel as nib
@@ -17,6 +21,7 @@ import subprocess as sp
 import scipy
 from random import shuffle
 import shutil
+from nianalysis.cache import cached_registration
 
 
 warn = warnings.warn
@@ -459,3 +464,55 @@ class PrepareFIXTraining(BaseInterface):
         # print self.inputs.feat_dir+'./filtered_func_data_clean.nii*'
         outputs['prepared_dirs'] = self.out_dirs
         return outputs
+
+
+class FLIRTInputSpec(BaseFLIRTInputSpec):
+
+    cache_dir = traits.Str(
+        nohash=True, desc=("Shared directory in which registration results "
+                           "are cached (keyed by the contents of the input "
+                           "images and the registration parameters)"))
+    cache_max_size = traits.Int(
+        nohash=True, desc="Maximum size (in bytes) of the registration cache")
+
+
+class FLIRT(BaseFLIRT):
+    """
+    FSL's FLIRT with the option to cache its results in a shared
+    registration cache
+    """
+
+    input_spec = FLIRTInputSpec
+
+    def _run_interface(self, runtime):
+        return cached_registration(
+            self, runtime, super(FLIRT, self)._run_interface, 'flirt')
+
+
+class Eddy(BaseEddy):
+    """
+    FSL's eddy, linking the field coefficients and movement parameters
+    estimated by topup under a common prefix (as eddy expects) so they can
+    be passed from where they are stored separately as derived datasets
+    """
+
+    # Prefix the topup files are linked to in the working directory
+    TOPUP_PREFIX = 'topup'
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.in_topup_fieldcoef):
+            for in_file, suffix in ((self.inputs.in_topup_fieldcoef,
+                                     '_fieldcoef'),
+                                    (self.inputs.in_topup_movpar,
+                                     '_movpar')):
+                link = os.path.abspath(
+                    self.TOPUP_PREFIX + suffix + split_extension(in_file)[1])
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(os.path.abspath(in_file), link)
+        return super(Eddy, self)._run_interface(runtime)
+
+    def _format_arg(self, name, spec, value):
+        if name == 'in_topup_fieldcoef':
+            return spec.argstr % os.path.abspath(self.TOPUP_PREFIX)
+        return super(Eddy, self)._format_arg(name, spec, value)
@@ -5,6 +5,7 @@ from nipype.interfaces.base import (
 from nipype.interfaces.mrtrix3.reconst import (
     MRTrix3Base, MRTrix3BaseInputSpec)
 from arcana.utils import split_extension
+from nianalysis.cache import conversion_cache, retrieve
 
 
 # =============================================================================
@@ -82,6 +83,13 @@ class MRConvertInputSpec(MRTrix3BaseInputSpec):
     quiet = traits.Bool(
         mandatory=False, argstr="-quiet",
         desc="Don't display output during conversion")
+    cache_dir = traits.Str(
+        nohash=True, desc=("Shared directory in which converted DICOM series "
+                           "are cached (keyed by SeriesInstanceUID) so "
+                           "repeated conversions of the same series are "
+                           "skipped"))
+    cache_max_size = traits.Int(
+        nohash=True, desc="Maximum size (in bytes) of the conversion cache")
 
 
 class MRConvertOutputSpec(TraitedSpec):
@@ -91,9 +99,38 @@ class MRConvertOutputSpec(TraitedSpec):
 class MRConvert(MRTrix3Base):
 
     _cmd = 'mrconvert'
+    _cache_input = 'in_file'
     input_spec = MRConvertInputSpec
     output_spec = MRConvertOutputSpec
 
+    def _run_interface(self, runtime):
+        out_file = self._gen_outfilename()
+        cache, key = conversion_cache(
+            self, 'mrconvert', split_extension(out_file)[1],
+            exclude=('out_file',))
+        # The exported gradient tables are cached along with the image
+        out_files = [out_file] + self._exported_files()
+        if cache is not None:
+            cached = cache.fetch(key)
+            if cached is not None and len(cached) == len(out_files):
+                for path, dst in zip(cached, out_files):
+                    retrieve(path, dst)
+                return runtime
+        runtime = super(MRConvert, self)._run_interface(runtime)
+        if cache is not None:
+            cache.store(key, out_files,
+                        names=['{}_{}'.format(i, os.path.basename(p))
+                               for i, p in enumerate(out_files)])
+        return runtime
+
+    def _exported_files(self):
+        exported = []
+        if isdefined(self.inputs.export_grad_mrtrix):
+            exported.append(self.inputs.export_grad_mrtrix)
+        if isdefined(self.inputs.export_grad_fsl):
+            exported.extend(self.inputs.export_grad_fsl.split())
+        return [os.path.abspath(p) for p in exported]
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
         outputs['out_file'] = self._gen_outfilename()
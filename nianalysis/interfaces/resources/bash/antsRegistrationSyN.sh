@@ -88,6 +88,11 @@ Optional arguments:
         0: false
         1: true
 
+     -q:  use a reduced ("quick") iteration schedule that skips the finest
+          resolution level of each stage (default = 0)
+        0: false
+        1: true
+
      NB:  Multiple image pairs can be specified for registration during the SyN stage.
           Specify additional images using the '-m' and '-f' options.  Note that image
           pair correspondence is given by the order specified on the command line.
@@ -161,6 +166,11 @@ Optional arguments:
         0: false
         1: true
 
+     -q:  use a reduced ("quick") iteration schedule that skips the finest
+          resolution level of each stage (default = 0)
+        0: false
+        1: true
+
      NB:  Multiple image pairs can be specified for registration during the SyN stage.
           Specify additional images using the '-m' and '-f' options.  Note that image
           pair correspondence is given by the order specified on the command line.
@@ -213,6 +223,7 @@ function reportMappingParameters {
  CC radius:                $CCRADIUS
  Precision:                $PRECISIONTYPE
  Use histogram matching    $USEHISTOGRAMMATCHING
+ Quick schedule            $QUICK
 ======================================================================================
 REPORTMAPPINGPARAMETERS
 }
@@ -264,9 +275,10 @@ PRECISIONTYPE='d'
 CCRADIUS=4
 MASK=0
 USEHISTOGRAMMATCHING=0
+QUICK=0
 
 # reading command line arguments
-while getopts "d:f:h:m:j:n:o:p:r:s:t:x:" OPT
+while getopts "d:f:h:m:j:n:o:p:q:r:s:t:x:" OPT
   do
   case $OPT in
       h) #help
@@ -296,6 +308,9 @@ while getopts "d:f:h:m:j:n:o:p:r:s:t:x:" OPT
    ;;
       p)  # precision type
    PRECISIONTYPE=$OPTARG
+   ;;
+      q)  # quick iteration schedule
+   QUICK=$OPTARG
    ;;
       r)  # cc radius
    CCRADIUS=$OPTARG
@@ -429,6 +444,13 @@ if [[ $ISLARGEIMAGE -eq 1 ]];
     SYNSMOOTHINGSIGMAS="5x3x2x1x0vox"
   fi
 
+if [[ $QUICK -eq 1 ]];
+  then
+    RIGIDCONVERGENCE="[1000x500x250x0,1e-6,10]"
+    AFFINECONVERGENCE="[1000x500x250x0,1e-6,10]"
+    SYNCONVERGENCE="[100x70x50x0,1e-6,10]"
+  fi
+
 tx=Rigid
 if [[ $TRANSFORMTYPE == 't' ]] ; then
   tx=Translation
@@ -10,6 +10,7 @@ from nipype.interfaces.base import (OutputMultiPath, TraitedSpec, isdefined,
 from nipype.interfaces.spm.base import (SPMCommand, scans_for_fnames,
                                         SPMCommandInputSpec)
 from nipype.utils.filemanip import split_filename
+from nianalysis.cache import cached_version
 
 
 class MultiChannelSegmentInputSpec(SPMCommandInputSpec):
@@ -110,7 +111,8 @@ class MultiChannelSegment(SPMCommand):
     output_spec = MultiChannelSegmentOutputSpec
 
     def __init__(self, **inputs):
-        _local_version = SPMCommand().version
+        _local_version = cached_version('spm', lambda: SPMCommand().version,
+                                        'matlab')
         if _local_version and '12.' in _local_version:
             self._jobtype = 'spatial'
             self._jobname = 'preproc'
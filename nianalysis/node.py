@@ -0,0 +1,103 @@
+import os
+import subprocess as sp
+from collections import defaultdict
+from nipype.pipeline.engine import (
+    Node as NipypeNode, MapNode as NipypeMapNode)
+from arcana.node import ArcanaNodeMixin
+from arcana.pipeline import Pipeline as ArcanaPipeline
+from arcana.exception import ArcanaError, ArcanaModulesNotInstalledException
+from nianalysis.cache import requirement_cache, cached_which
+
+
+def _module_dirs(module_path):
+    "Directories of the module path and the tool directories within them"
+    dirs = []
+    for dname in module_path.split(os.pathsep):
+        if not dname:
+            continue
+        dirs.append(dname)
+        try:
+            subdirs = sorted(os.listdir(dname))
+        except OSError:
+            continue
+        dirs.extend(os.path.join(dname, d) for d in subdirs
+                    if os.path.isdir(os.path.join(dname, d)))
+    return dirs
+
+
+class CachedModulesMixin(ArcanaNodeMixin):
+    """
+    Environment modules are resolved by arcana separately for every node it
+    runs, which lists the available modules and searches for 'modulecmd' each
+    time. Nodes with this mixin reuse the results (for as long as the module
+    directories and PATH are unchanged) across nodes and, if
+    NIANALYSIS_REQUIREMENT_CACHE is set, processes.
+    """
+
+    @classmethod
+    def available_modules(cls):
+        if 'MODULESHOME' not in os.environ:
+            raise ArcanaModulesNotInstalledException('MODULESHOME')
+        module_path = os.environ.get('MODULEPATH', '')
+        available = requirement_cache.get(
+            'modules:{}'.format(module_path),
+            lambda: dict(super(CachedModulesMixin, cls).available_modules()),
+            depends_on=_module_dirs(module_path))
+        return defaultdict(list, available)
+
+    @classmethod
+    def _run_module_cmd(cls, *args):
+        if 'MODULESHOME' not in os.environ:
+            raise ArcanaModulesNotInstalledException('MODULESHOME')
+        modulecmd = cached_which('modulecmd')
+        if modulecmd is None:
+            modulecmd = '{}/bin/modulecmd'.format(os.environ['MODULESHOME'])
+            if not os.path.exists(modulecmd):
+                raise ArcanaError(
+                    "Cannot find 'modulecmd' on path or in MODULESHOME.")
+        cmd = [modulecmd, 'python'] + list(args)
+        try:
+            output, error = sp.Popen(cmd, stdout=sp.PIPE,
+                                     stderr=sp.PIPE).communicate()
+        except (sp.CalledProcessError, OSError) as e:
+            raise ArcanaError("Call to subprocess `{}` threw an error: {}"
+                              .format(' '.join(cmd), e))
+        exec(output)
+        return error.decode('utf-8')
+
+
+class Node(CachedModulesMixin, NipypeNode):
+
+    nipype_cls = NipypeNode
+
+
+class MapNode(CachedModulesMixin, NipypeMapNode):
+
+    nipype_cls = NipypeMapNode
+
+
+class Pipeline(ArcanaPipeline):
+    """
+    Creates its nodes (and map nodes) with CachedModulesMixin, so that the
+    environment modules required by them are only probed once. Join nodes
+    are left to arcana as they don't have any requirements
+    """
+
+    def create_node(self, interface, name, **kwargs):
+        node = Node(interface, name="{}_{}".format(self._name, name),
+                    **kwargs)
+        self._workflow.add_nodes([node])
+        return node
+
+    def create_map_node(self, interface, name, **kwargs):
+        node = MapNode(interface, name="{}_{}".format(self._name, name),
+                       **kwargs)
+        self._workflow.add_nodes([node])
+        return node
+
+
+class PipelineMixin(object):
+    "Mixin for studies so their pipelines are created with Pipeline"
+
+    def create_pipeline(self, *args, **kwargs):
+        return Pipeline(self, *args, **kwargs)
@@ -3,20 +3,23 @@ from nipype.interfaces.spm.preprocess import Coregister
 from nianalysis.requirement import spm12_req
 from nianalysis.citation import spm_cite
 from nianalysis.file_format import nifti_format, motion_mats_format,\
-    directory_format, nifti_gz_format
+    directory_format, nifti_gz_format, mrtrix_format
 from arcana.dataset import DatasetSpec, FieldSpec
 from arcana.study.base import Study, StudyMetaClass
+from nianalysis.node import PipelineMixin
 from nianalysis.citation import fsl_cite, bet_cite, bet2_cite
 from nianalysis.file_format import (
     dicom_format, text_format, gif_format)
-from nianalysis.requirement import fsl5_req, mrtrix3_req, fsl509_req, ants2_req
-from nipype.interfaces.fsl import (FLIRT, FNIRT, Reorient2Std)
-from nianalysis.utils import get_atlas_path
+from nianalysis.requirement import fsl5_req, fsl509_req, ants2_req
+from nipype.interfaces.fsl import (FNIRT, Reorient2Std)
+from nianalysis.utils import get_atlas_path, set_node_threads
 from arcana.exception import ArcanaUsageError
-from nianalysis.interfaces.mrtrix.transform import MRResize
 from nianalysis.interfaces.custom.dicom import (DicomHeaderInfoExtraction)
+from nianalysis.interfaces.custom.image import (
+    Downsample, RefineBrainMask, ReorientResample, QformTransform)
 from nipype.interfaces.utility import Split, Merge
-from nianalysis.interfaces.fsl import FSLSlices
+from nianalysis.interfaces.fsl import FSLSlices, FLIRT
+from nianalysis.cache import set_registration_cache
 from nianalysis.file_format import text_matrix_format
 import os
 import logging
@@ -31,8 +34,14 @@ logger = logging.getLogger('arcana')
 atlas_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..', '..', 'atlases'))
 
+# The formats intermediate images can be stored in (see the
+# 'intermediate_format' switch)
+INTERMEDIATE_FORMATS = {'nifti_gz': nifti_gz_format,
+                        'nifti': nifti_format,
+                        'mrtrix': mrtrix_format}
 
-class MRIStudy(Study, metaclass=StudyMetaClass):
+
+class MRIStudy(PipelineMixin, Study, metaclass=StudyMetaClass):
 
     add_data_specs = [
         DatasetSpec('primary', dicom_format),
@@ -91,6 +100,9 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         ParameterSpec('MNI_template_mask', os.path.join(
             atlas_path, 'MNI152_T1_2mm_brain_mask.nii.gz')),
         ParameterSpec('optibet_gen_report', False),
+        ParameterSpec('optibet_fast_resolution', 3.0, desc=(
+            "The resolution (mm) the subject and template are downsampled "
+            "to before registration in the 'fast' optiBET mode")),
         ParameterSpec('fnirt_atlas', 'MNI152'),
         ParameterSpec('fnirt_resolution', '2mm'),
         ParameterSpec('fnirt_intensity_model', 'global_non_linear_with_bias'),
@@ -115,7 +127,86 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         SwitchSpec('atlas_coreg_tool', 'ants',
                       choices=('fnirt', 'ants')),
         SwitchSpec('bet_method', 'fsl_bet',
-                      choices=('fsl_bet', 'optibet'))]
+                      choices=('fsl_bet', 'optibet')),
+        SwitchSpec('optibet_mode', 'full', choices=('full', 'fast'),
+                   desc=("Whether optiBET registers the subject to the "
+                         "template at full resolution or at a coarse "
+                         "resolution with a reduced iteration schedule, "
+                         "refining the back-projected mask afterwards")),
+        SwitchSpec('intermediate_format', 'nifti_gz',
+                   choices=('nifti_gz', 'nifti', 'mrtrix'),
+                   desc=("The format the intermediate images (see "
+                         "'intermediate_data_specs') are stored in. Using an "
+                         "uncompressed format avoids the zlib compression "
+                         "and decompression at every step of the "
+                         "preprocessing, while final outputs are still "
+                         "stored gzipped. Images produced or consumed by "
+                         "FSL (see 'fsl_data_specs') are stored in "
+                         "uncompressed NIfTI when 'mrtrix' is selected"))]
+
+    # Derived images that are primarily consumed by other pipelines of the
+    # study, which are stored in the format selected by the
+    # 'intermediate_format' switch instead of zipped NIfTI
+    intermediate_data_specs = ('preproc', 'brain', 'brain_mask')
+
+    # Intermediate images that are produced or consumed by FSL (or other
+    # tools that can't handle MRtrix format), which are never stored in
+    # MRtrix format as it would only add conversions at both ends
+    fsl_data_specs = ('preproc', 'brain', 'brain_mask')
+
+    def spec(self, name):
+        """
+        Returns the spec of a dataset as in Study.spec, except that the
+        derived images stored in zipped NIfTI by default are stored in the
+        format returned by 'image_format' instead (Arcana inserts the
+        required converters when a pipeline reads/writes them in a different
+        format)
+        """
+        spec = super(MRIStudy, self).spec(name)
+        if (isinstance(spec, DatasetSpec) and spec.derived and
+                spec.format == nifti_gz_format):
+            fmt = self.image_format(spec.name)
+            if fmt != spec.format:
+                spec = DatasetSpec(
+                    spec.name, fmt, spec.pipeline_name,
+                    frequency=spec.frequency, desc=spec.desc,
+                    optional=spec.optional).bind(self)
+        return spec
+
+    def image_format(self, name, fsl=False):
+        """
+        Returns the format a pipeline should read/write an image in, i.e.
+        the format selected by the 'intermediate_format' switch for
+        intermediate images and zipped NIfTI otherwise
+
+        Parameters
+        ----------
+        name : str
+            Name of the image data spec
+        fsl : bool
+            Whether the image is read/written by an FSL (or other tool
+            that can't handle MRtrix format) in which case uncompressed
+            NIfTI is returned in place of MRtrix format. Always the case
+            for images for which 'is_fsl_data' is True
+        """
+        if name not in self.intermediate_data_specs:
+            return nifti_gz_format
+        fmt = self.switch('intermediate_format')
+        if fmt == 'mrtrix' and (fsl or self.is_fsl_data(name)):
+            fmt = 'nifti'
+        return INTERMEDIATE_FORMATS[fmt]
+
+    def is_fsl_data(self, name):
+        "Whether the image is produced or consumed by FSL in this study"
+        return name in self.fsl_data_specs
+
+    def fsl_output_type(self, name):
+        "Returns the FSL output type to write the given image in"
+        if self.image_format(name, fsl=True) == nifti_gz_format:
+            output_type = 'NIFTI_GZ'
+        else:
+            output_type = 'NIFTI'
+        return output_type
 
     @property
     def coreg_brain_spec(self):
@@ -170,8 +261,8 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
 
         pipeline = self.create_pipeline(
             name=name,
-            inputs=[DatasetSpec(to_reg, nifti_gz_format),
-                    DatasetSpec(ref, nifti_gz_format)],
+            inputs=[DatasetSpec(to_reg, self.image_format(to_reg, fsl=True)),
+                    DatasetSpec(ref, self.image_format(ref, fsl=True))],
             outputs=[DatasetSpec(reg, nifti_gz_format),
                      DatasetSpec(matrix, text_matrix_format)],
             desc="Registers a MR scan against a reference image using FLIRT",
@@ -181,6 +272,7 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         flirt = pipeline.create_node(interface=FLIRT(), name='flirt',
                                      requirements=[fsl5_req],
                                      wall_time=5)
+        set_registration_cache(flirt)
 
         # Set registration parameters
         flirt.inputs.dof = self.parameter('flirt_degrees_of_freedom')
@@ -200,25 +292,25 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
                                  qformed_mat, **kwargs):
         pipeline = self.create_pipeline(
             name=name,
-            inputs=[DatasetSpec(to_reg, nifti_gz_format),
-                    DatasetSpec(ref, nifti_gz_format)],
+            inputs=[DatasetSpec(to_reg, self.image_format(to_reg, fsl=True)),
+                    DatasetSpec(ref, self.image_format(ref, fsl=True))],
             outputs=[DatasetSpec(qformed, nifti_gz_format),
                      DatasetSpec(qformed_mat, text_matrix_format)],
             desc="Registers a MR scan against a reference image",
             version=1,
             citations=[fsl_cite],
             **kwargs)
-        flirt = pipeline.create_node(interface=FLIRT(), name='flirt',
-                                     requirements=[fsl5_req],
-                                     wall_time=5)
-        flirt.inputs.uses_qform = True
-        flirt.inputs.apply_xfm = True
+        # Resample in-process using the header transforms (equivalent to
+        # 'flirt -applyxfm -usesqform')
+        qform = pipeline.create_node(interface=QformTransform(),
+                                     name='qform_transform', wall_time=5)
+        qform.inputs.out_ext = nifti_gz_format.extension
         # Connect inputs
-        pipeline.connect_input(to_reg, flirt, 'in_file')
-        pipeline.connect_input(ref, flirt, 'reference')
+        pipeline.connect_input(to_reg, qform, 'in_files')
+        pipeline.connect_input(ref, qform, 'reference')
         # Connect outputs
-        pipeline.connect_output(qformed, flirt, 'out_file')
-        pipeline.connect_output(qformed_mat, flirt, 'out_matrix_file')
+        pipeline.connect_output(qformed, qform, 'out_file')
+        pipeline.connect_output(qformed_mat, qform, 'out_matrix_file')
         return pipeline
 
     def _spm_coreg_pipeline(self, **kwargs):  # @UnusedVariable
@@ -262,8 +354,8 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
 
         pipeline = self.create_pipeline(
             name=name,
-            inputs=[DatasetSpec(to_reg, nifti_gz_format),
-                    DatasetSpec(ref, nifti_gz_format)],
+            inputs=[DatasetSpec(to_reg, self.image_format(to_reg, fsl=True)),
+                    DatasetSpec(ref, self.image_format(ref, fsl=True))],
             outputs=[DatasetSpec(reg, nifti_gz_format),
                      DatasetSpec(matrix, text_matrix_format)],
             desc="Registers a MR scan against a reference image using ANTs",
@@ -275,6 +367,8 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
             AntsRegSyn(num_dimensions=3, transformation='r',
                        out_prefix='reg2hires'), name='ANTs_linear_Reg',
             wall_time=10, requirements=[ants2_req])
+        set_registration_cache(ants_linear)
+        set_node_threads(ants_linear, 4, self.runner)
         pipeline.connect_input(ref, ants_linear, 'ref_file')
         pipeline.connect_input(to_reg, ants_linear, 'input_file')
 
@@ -298,9 +392,12 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         """
         pipeline = self.create_pipeline(
             name='brain_extraction',
-            inputs=[DatasetSpec(in_file, nifti_gz_format)],
-            outputs=[DatasetSpec('brain', nifti_gz_format),
-                     DatasetSpec('brain_mask', nifti_gz_format)],
+            inputs=[DatasetSpec(in_file, self.image_format(in_file,
+                                                           fsl=True))],
+            outputs=[DatasetSpec('brain', self.image_format('brain',
+                                                            fsl=True)),
+                     DatasetSpec('brain_mask',
+                                 self.image_format('brain_mask', fsl=True))],
             desc="Generate brain mask from mr_scan",
             version=1,
             citations=[fsl_cite, bet_cite, bet2_cite],
@@ -309,7 +406,7 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         bet = pipeline.create_node(interface=fsl.BET(), name="bet",
                                    requirements=[fsl509_req])
         bet.inputs.mask = True
-        bet.inputs.output_type = 'NIFTI_GZ'
+        bet.inputs.output_type = self.fsl_output_type('brain')
         if self.parameter('bet_robust'):
             bet.inputs.robust = True
         if self.parameter('bet_reduce_bias'):
@@ -328,13 +425,15 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         Generates a whole brain mask using a modified optiBET approach.
         """
 
-        outputs = [DatasetSpec('brain', nifti_gz_format),
-                   DatasetSpec('brain_mask', nifti_gz_format)]
+        outputs = [DatasetSpec('brain', self.image_format('brain', fsl=True)),
+                   DatasetSpec('brain_mask', self.image_format('brain_mask',
+                                                               fsl=True))]
         if self.parameter('optibet_gen_report'):
             outputs.append(DatasetSpec('optiBET_report', gif_format))
         pipeline = self.create_pipeline(
             name='brain_extraction',
-            inputs=[DatasetSpec(in_file, nifti_gz_format)],
+            inputs=[DatasetSpec(in_file, self.image_format(in_file,
+                                                           fsl=True))],
             outputs=outputs,
             desc=("Modified implementation of optiBET.sh"),
             version=1,
@@ -343,10 +442,28 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
 
         mni_reg = pipeline.create_node(
             AntsRegSyn(num_dimensions=3, transformation='s',
-                       out_prefix='T12MNI', num_threads=4), name='T1_reg',
+                       out_prefix='T12MNI'), name='T1_reg',
             wall_time=25, requirements=[ants2_req])
-        mni_reg.inputs.ref_file = self.parameter('MNI_template')
-        pipeline.connect_input(in_file, mni_reg, 'input_file')
+        set_registration_cache(mni_reg)
+        set_node_threads(mni_reg, 4, self.runner)
+        if self.branch('optibet_mode', 'fast'):
+            # Register downsampled copies of the image and template
+            downsample = pipeline.create_node(
+                Downsample(), name='downsample', wall_time=5)
+            downsample.inputs.resolution = self.parameter(
+                'optibet_fast_resolution')
+            pipeline.connect_input(in_file, downsample, 'in_file')
+            downsample_ref = pipeline.create_node(
+                Downsample(), name='downsample_ref', wall_time=5)
+            downsample_ref.inputs.resolution = self.parameter(
+                'optibet_fast_resolution')
+            downsample_ref.inputs.in_file = self.parameter('MNI_template')
+            mni_reg.inputs.quick = True
+            pipeline.connect(downsample, 'out_file', mni_reg, 'input_file')
+            pipeline.connect(downsample_ref, 'out_file', mni_reg, 'ref_file')
+        else:
+            mni_reg.inputs.ref_file = self.parameter('MNI_template')
+            pipeline.connect_input(in_file, mni_reg, 'input_file')
 
         merge_trans = pipeline.create_node(Merge(2), name='merge_transforms',
                                            wall_time=1)
@@ -361,34 +478,54 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         apply_trans = pipeline.create_node(
             ApplyTransforms(), name='ApplyTransform', wall_time=7,
             memory=24000, requirements=[ants2_req])
+        set_node_threads(apply_trans, 4, self.runner)
         apply_trans.inputs.input_image = self.parameter('MNI_template_mask')
-        apply_trans.inputs.interpolation = 'NearestNeighbor'
         apply_trans.inputs.input_image_type = 3
         pipeline.connect(merge_trans, 'out', apply_trans, 'transforms')
         pipeline.connect(trans_flags, 'out', apply_trans,
                          'invert_transform_flags')
+        # The mask is projected onto the full-resolution grid of the image
         pipeline.connect_input(in_file, apply_trans, 'reference_image')
 
-        maths1 = pipeline.create_node(
-            fsl.ImageMaths(suffix='_optiBET_brain_mask', op_string='-bin'),
-            name='binarize', wall_time=5, requirements=[fsl5_req])
-        pipeline.connect(apply_trans, 'output_image', maths1, 'in_file')
-        maths2 = pipeline.create_node(
-            fsl.ImageMaths(suffix='_optiBET_brain', op_string='-mas'),
-            name='mask', wall_time=5, requirements=[fsl5_req])
-        pipeline.connect_input(in_file, maths2, 'in_file')
-        pipeline.connect(maths1, 'out_file', maths2, 'in_file2')
+        if self.branch('optibet_mode', 'fast'):
+            # Interpolate the mask linearly so it can be refined against the
+            # full-resolution image
+            apply_trans.inputs.interpolation = 'Linear'
+            refine = pipeline.create_node(
+                RefineBrainMask(), name='refine_mask', wall_time=5)
+            refine.inputs.out_ext = self.image_format(
+                'brain', fsl=True).extension
+            pipeline.connect_input(in_file, refine, 'in_file')
+            pipeline.connect(apply_trans, 'output_image', refine,
+                             'coarse_mask')
+            mask_node, mask_field = refine, 'mask_file'
+            brain_node, brain_field = refine, 'out_file'
+        else:
+            apply_trans.inputs.interpolation = 'NearestNeighbor'
+            maths1 = pipeline.create_node(
+                fsl.ImageMaths(suffix='_optiBET_brain_mask', op_string='-bin',
+                               output_type=self.fsl_output_type('brain')),
+                name='binarize', wall_time=5, requirements=[fsl5_req])
+            pipeline.connect(apply_trans, 'output_image', maths1, 'in_file')
+            maths2 = pipeline.create_node(
+                fsl.ImageMaths(suffix='_optiBET_brain', op_string='-mas',
+                               output_type=self.fsl_output_type('brain')),
+                name='mask', wall_time=5, requirements=[fsl5_req])
+            pipeline.connect_input(in_file, maths2, 'in_file')
+            pipeline.connect(maths1, 'out_file', maths2, 'in_file2')
+            mask_node, mask_field = maths1, 'out_file'
+            brain_node, brain_field = maths2, 'out_file'
         if self.parameter('optibet_gen_report'):
             slices = pipeline.create_node(
                 FSLSlices(), name='slices', wall_time=5,
                 requirements=[fsl5_req])
             slices.inputs.outname = 'optiBET_report'
             pipeline.connect_input(in_file, slices, 'im1')
-            pipeline.connect(maths2, 'out_file', slices, 'im2')
+            pipeline.connect(brain_node, brain_field, slices, 'im2')
             pipeline.connect_output('optiBET_report', slices, 'report')
 
-        pipeline.connect_output('brain_mask', maths1, 'out_file')
-        pipeline.connect_output('brain', maths2, 'out_file')
+        pipeline.connect_output('brain_mask', mask_node, mask_field)
+        pipeline.connect_output('brain', brain_node, brain_field)
 
         return pipeline
 
@@ -413,9 +550,12 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         """
         pipeline = self.create_pipeline(
             name='coregister_to_atlas',
-            inputs=[DatasetSpec('preproc', nifti_gz_format),
-                    DatasetSpec('brain_mask', nifti_gz_format),
-                    DatasetSpec('brain', nifti_gz_format)],
+            inputs=[DatasetSpec('preproc', self.image_format('preproc',
+                                                             fsl=True)),
+                    DatasetSpec('brain_mask', self.image_format('brain_mask',
+                                                                fsl=True)),
+                    DatasetSpec('brain', self.image_format('brain',
+                                                           fsl=True))],
             outputs=[DatasetSpec('coreg_to_atlas', nifti_gz_format),
                      DatasetSpec('coreg_to_atlas_coeff', nifti_gz_format)],
             desc=("Nonlinearly registers a MR scan to a standard space,"
@@ -505,8 +645,10 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
             **kwargs)
         ants_reg = pipeline.create_node(
             AntsRegSyn(num_dimensions=3, transformation='s',
-                       out_prefix='Struct2MNI', num_threads=4),
+                       out_prefix='Struct2MNI'),
             name='Struct2MNI_reg', wall_time=25, requirements=[ants2_req])
+        set_registration_cache(ants_reg)
+        set_node_threads(ants_reg, 4, self.runner)
 
         ref_brain = self.parameter('MNI_template_brain')
         ants_reg.inputs.ref_file = ref_brain
@@ -528,7 +670,8 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
     def segmentation_pipeline(self, img_type=2, **kwargs):
         pipeline = self.create_pipeline(
             name='FAST_segmentation',
-            inputs=[DatasetSpec('brain', nifti_gz_format)],
+            inputs=[DatasetSpec('brain', self.image_format('brain',
+                                                           fsl=True))],
             outputs=[DatasetSpec('wm_seg', nifti_gz_format)],
             desc="White matter segmentation of the reference image",
             version=1,
@@ -572,26 +715,25 @@ class MRIStudy(Study, metaclass=StudyMetaClass):
         """
         pipeline = self.create_pipeline(
             name='preproc_pipeline',
-            inputs=[DatasetSpec(in_file_name, nifti_gz_format)],
-            outputs=[DatasetSpec('preproc', nifti_gz_format)],
+            inputs=[DatasetSpec(in_file_name, self.image_format('preproc',
+                                                                fsl=True))],
+            outputs=[DatasetSpec('preproc', self.image_format('preproc',
+                                                              fsl=True))],
             desc=("Dimensions swapping to ensure that all the images "
                   "have the same orientations."),
             version=1,
             citations=[fsl_cite],
             **kwargs)
-        swap = pipeline.create_node(fsl.utils.Reorient2Std(),
-                                    name='fslreorient2std',
-                                    requirements=[fsl509_req])
-#         swap.inputs.new_dims = self.parameter('preproc_new_dims')
-        pipeline.connect_input(in_file_name, swap, 'in_file')
+        # Reorientation and resampling are performed in a single pass,
+        # equivalent to fslreorient2std followed by mrresize
+        preproc = pipeline.create_node(ReorientResample(), name='preproc',
+                                       wall_time=5)
+        preproc.inputs.out_ext = self.image_format('preproc',
+                                                   fsl=True).extension
         if self.parameter('preproc_resolution') is not None:
-            resample = pipeline.create_node(MRResize(), name="resample",
-                                            requirements=[mrtrix3_req])
-            resample.inputs.voxel = self.parameter('preproc_resolution')
-            pipeline.connect(swap, 'out_file', resample, 'in_file')
-            pipeline.connect_output('preproc', resample, 'out_file')
-        else:
-            pipeline.connect_output('preproc', swap, 'out_file')
+            preproc.inputs.resolution = self.parameter('preproc_resolution')
+        pipeline.connect_input(in_file_name, preproc, 'in_file')
+        pipeline.connect_output('preproc', preproc, 'out_file')
 
         return pipeline
 
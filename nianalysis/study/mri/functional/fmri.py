@@ -21,6 +21,7 @@ from nipype.interfaces.ants.resampling import ApplyTransforms
 from nianalysis.study.mri.structural.t1 import T1Study
 from arcana.study.multi import (
     MultiStudy, SubStudySpec, MultiStudyMetaClass)
+from nianalysis.node import PipelineMixin
 from arcana.dataset import DatasetMatch
 from nipype.interfaces.afni.preprocess import BlurToFWHM
 from nianalysis.interfaces.custom.fmri import PrepareFIX
@@ -339,7 +340,8 @@ class FunctionalMRIStudy(EPIStudy, metaclass=StudyMetaClass):
         return pipeline
 
 
-class FunctionalMRIMixin(MultiStudy, metaclass=MultiStudyMetaClass):
+class FunctionalMRIMixin(PipelineMixin, MultiStudy,
+                         metaclass=MultiStudyMetaClass):
 
     add_data_specs = [
         DatasetSpec('train_data', rfile_format, 'fix_training_pipeline',
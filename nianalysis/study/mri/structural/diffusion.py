@@ -3,9 +3,8 @@ from nipype.interfaces.mrtrix3 import ResponseSD
 from nipype.interfaces.mrtrix3.utils import BrainMask, TensorMetrics
 from nipype.interfaces.mrtrix3.reconst import FitTensor, EstimateFOD
 from nianalysis.interfaces.mrtrix import (
-    DWIPreproc, MRCat, ExtractDWIorB0, MRMath, DWIBiasCorrect, DWIDenoise,
-    MRCalc, DWIIntensityNorm, AverageResponse)
-from nipype.workflows.dmri.fsl.tbss import create_tbss_all
+    DWIPreproc, MRCat, DWIBiasCorrect, DWIDenoise, MRCalc, DWIIntensityNorm)
+from nipype.workflows.dmri.fsl.tbss import create_tbss_4_prestats
 from nianalysis.interfaces.noddi import (
     CreateROI, BatchNODDIFitting, SaveParamsAsNIfTI)
 from nianalysis.interfaces.mrtrix import MRConvert, ExtractFSLGradients
@@ -16,7 +15,8 @@ from nianalysis.citation import (
     noddi_cite, fast_cite, n4_cite, tbss_cite, dwidenoise_cites)
 from nianalysis.file_format import (
     mrtrix_format, nifti_gz_format, fsl_bvecs_format, fsl_bvals_format,
-    nifti_format, text_format, dicom_format, eddy_par_format, directory_format)
+    nifti_format, text_format, dicom_format, eddy_par_format, directory_format,
+    json_format, csv_format)
 from nianalysis.requirement import (
     fsl509_req, mrtrix3_req, ants2_req, matlab2015_req, noddi_req, fsl510_req)
 from arcana.study.base import StudyMetaClass
@@ -24,9 +24,16 @@ from arcana.dataset import DatasetSpec, FieldSpec
 from arcana.interfaces.iterators import SelectSession
 from arcana.parameter import ParameterSpec, SwitchSpec
 from nianalysis.study.mri.epi import EPIStudy
+from nianalysis.utils import set_node_threads
 from nipype.interfaces import fsl
+from nipype.interfaces.fsl import TOPUP
 from nianalysis.interfaces.custom.motion_correction import (
-    PrepareDWI, AffineMatrixGeneration)
+    AffineMatrixGeneration)
+from nianalysis.interfaces.custom.dicom import TotalReadoutTime
+from nianalysis.interfaces.fsl import Eddy
+from nianalysis.interfaces.custom.diffusion import (
+    TensorFit, NODDIFit, ExtractB0, PrepareTBSSFA, AverageResponses,
+    PrepareSEEPIPair, DWIQC, CollateQC, EddyIndex)
 
 
 class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
@@ -40,10 +47,29 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         DatasetSpec('tensor', nifti_gz_format, 'tensor_pipeline'),
         DatasetSpec('fa', nifti_gz_format, 'tensor_pipeline'),
         DatasetSpec('adc', nifti_gz_format, 'tensor_pipeline'),
+        DatasetSpec('ad', nifti_gz_format, 'tensor_pipeline'),
+        DatasetSpec('rd', nifti_gz_format, 'tensor_pipeline'),
         DatasetSpec('wm_response', text_format, 'response_pipeline'),
         DatasetSpec('gm_response', text_format, 'response_pipeline'),
         DatasetSpec('csf_response', text_format, 'response_pipeline'),
-        DatasetSpec('avg_response', text_format, 'average_response_pipeline'),
+        DatasetSpec('avg_response', text_format, 'average_response_pipeline',
+                    frequency='per_project'),
+        DatasetSpec('avg_response_state', json_format,
+                    'average_response_pipeline', frequency='per_project',
+                    desc=("Exact running sum of the responses included in "
+                          "the average")),
+        DatasetSpec('avg_response_prev_state', json_format, optional=True,
+                    frequency='per_project',
+                    desc=("Running sum saved by a previous average, which "
+                          "the responses of new sessions are added to")),
+        DatasetSpec('fod_response', text_format, 'average_response_pipeline',
+                    frequency='per_project',
+                    desc=("Average response that FODs are estimated with, "
+                          "only updated when the average drifts by more "
+                          "than 'response_drift_tolerance'")),
+        FieldSpec('avg_response_drift', dtype=float,
+                  pipeline_name='average_response_pipeline',
+                  frequency='per_project'),
         DatasetSpec('wm_odf', mrtrix_format, 'fod_pipeline'),
         DatasetSpec('gm_odf', mrtrix_format, 'fod_pipeline'),
         DatasetSpec('csf_odf', mrtrix_format, 'fod_pipeline'),
@@ -51,8 +77,24 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         DatasetSpec('grad_dirs', fsl_bvecs_format, 'preproc_pipeline'),
         DatasetSpec('bvalues', fsl_bvals_format, 'preproc_pipeline'),
         DatasetSpec('eddy_par', eddy_par_format, 'preproc_pipeline'),
+        DatasetSpec('topup_fieldcoef', nifti_gz_format, 'topup_pipeline',
+                    desc=("Susceptibility-induced field estimated by topup, "
+                          "which eddy reuses when the preprocessing is "
+                          "rerun")),
+        DatasetSpec('topup_movpar', text_format, 'topup_pipeline',
+                    desc="Movement parameters estimated by topup"),
+        DatasetSpec('topup_acqp', text_format, 'topup_pipeline',
+                    desc=("Acquisition parameters (phase encoding and total "
+                          "readout time) the field was estimated with, "
+                          "which are also passed to eddy")),
         DatasetSpec('align_mats', directory_format,
                     'intrascan_alignment_pipeline'),
+        DatasetSpec('tbss_fa_std', nifti_gz_format,
+                    'tbss_registration_pipeline',
+                    desc="FA map registered to the TBSS target"),
+        DatasetSpec('tbss_fa_warp', nifti_gz_format,
+                    'tbss_registration_pipeline',
+                    desc="Warp coefficients from the FA map to the target"),
         DatasetSpec('tbss_mean_fa', nifti_gz_format, 'tbss_pipeline',
                     frequency='per_project'),
         DatasetSpec('tbss_proj_fa', nifti_gz_format, 'tbss_pipeline',
@@ -61,6 +103,11 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
                     frequency='per_project'),
         DatasetSpec('tbss_skeleton_mask', nifti_gz_format, 'tbss_pipeline',
                     frequency='per_project'),
+        DatasetSpec('dwi_qc', json_format, 'qc_pipeline',
+                    desc="QC summary statistics of the session"),
+        DatasetSpec('dwi_qc_table', csv_format, 'qc_summary_pipeline',
+                    frequency='per_project',
+                    desc="QC summary statistics of every session"),
         DatasetSpec('brain', nifti_gz_format, 'brain_extraction_pipeline'),
         DatasetSpec('brain_mask', nifti_gz_format, 'brain_extraction_pipeline'),
         DatasetSpec('norm_intensity', mrtrix_format,
@@ -79,7 +126,26 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         ParameterSpec('fsl_mask_f', 0.25),
         ParameterSpec('bet_robust', True),
         ParameterSpec('bet_f_threshold', 0.2),
-        ParameterSpec('bet_reduce_bias', False)]
+        ParameterSpec('bet_reduce_bias', False),
+        ParameterSpec('tensor_fit_memory', 1024,
+                      desc=("Approximate limit on the memory (in MB) used "
+                            "when fitting the tensors natively")),
+        ParameterSpec('response_drift_tolerance', 0.01,
+                      desc=("Relative change in the average response below "
+                            "which the response used to estimate FODs is "
+                            "left unchanged")),
+        ParameterSpec('qc_outlier_threshold', 4.0,
+                      desc=("Number of standard deviations the signal of a "
+                            "slice needs to drop by for it to be counted as "
+                            "an outlier in the QC summary")),
+        ParameterSpec('topup_config', 'b02b0.cnf',
+                      desc="Configuration file passed to topup"),
+        ParameterSpec('total_readout_time', 0.1,
+                      desc=("Total readout time (s) of the DWI series used "
+                            "when it cannot be read from the DICOM header")),
+        ParameterSpec('b0_threshold', 10.0,
+                      desc=("b-value at or below which volumes are treated "
+                            "as b0s when extracting them"))]
 
     add_switch_specs = [
         SwitchSpec('preproc_denoise', False),
@@ -89,13 +155,80 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         SwitchSpec('brain_extract_method', 'mrtrix',
                    ('mrtrix', 'fsl')),
         SwitchSpec('bias_correct_method', 'ants',
-                   choices=('ants', 'fsl'))]
+                   choices=('ants', 'fsl')),
+        SwitchSpec('fod_response', 'subject', ('subject', 'group'),
+                   desc=("Whether the white matter FODs are estimated with "
+                         "the response of each subject or the group "
+                         "average")),
+        SwitchSpec('tensor_fit_method', 'native', ('native', 'mrtrix'),
+                   desc=("Whether the tensor is fitted (by weighted least "
+                         "squares) in-process or with MRtrix's 'dwi2tensor' "
+                         "and 'tensor2metric'")),
+        SwitchSpec('dwi_gradients', 'fsl', choices=('fsl', 'header'),
+                   desc=("Whether the diffusion gradient table is passed "
+                         "between pipelines as separate FSL bvec/bval files "
+                         "or embedded in the headers of the (uncompressed "
+                         "MRtrix format) DWI images, in which case it is "
+                         "only converted to FSL format for the tools that "
+                         "require it"))]
+
+    # Derived DWI images that carry the gradient table in their headers when
+    # the 'dwi_gradients' switch is set to 'header'
+    gradient_data_specs = ('preproc', 'bias_correct')
+
+    intermediate_data_specs = (EPIStudy.intermediate_data_specs +
+                               ('bias_correct',))
 
     @property
     def multi_tissue(self):
         return self.branch('response_algorithm',
                            ('msmt_5tt', 'dhollander'))
 
+    @property
+    def distortion_correction(self):
+        return ('dwi_reference' in self.input_names or
+                'reverse_phase' in self.input_names)
+
+    @property
+    def embedded_gradients(self):
+        return self.branch('dwi_gradients', 'header')
+
+    def image_format(self, name, fsl=False):
+        if name in self.gradient_data_specs and self.embedded_gradients:
+            # Tools that can't read the MRtrix images are given uncompressed
+            # NIfTI so the conversion is cheap
+            return nifti_format if fsl else mrtrix_format
+        return super(DiffusionStudy, self).image_format(name, fsl=fsl)
+
+    def is_fsl_data(self, name):
+        if name == 'brain_mask' and self.branch('brain_extract_method',
+                                                'mrtrix'):
+            # Produced by dwi2mask and primarily consumed by MRtrix tools
+            return False
+        return super(DiffusionStudy, self).is_fsl_data(name)
+
+    def gradient_inputs(self):
+        """
+        The datasets pipelines read the gradient table from, which are not
+        required when it is embedded in the headers of the images
+        """
+        if self.embedded_gradients:
+            return []
+        return [DatasetSpec('grad_dirs', fsl_bvecs_format),
+                DatasetSpec('bvalues', fsl_bvals_format)]
+
+    def connect_gradients(self, pipeline, node, field='grad_fsl'):
+        """
+        Passes the FSL gradient files to the given node unless the gradient
+        table is embedded in the headers of the images
+        """
+        if self.embedded_gradients:
+            return
+        fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
+        pipeline.connect_input('grad_dirs', fsl_grads, 'in1')
+        pipeline.connect_input('bvalues', fsl_grads, 'in2')
+        pipeline.connect(fsl_grads, 'out', node, field)
+
     def preproc_pipeline(self, **kwargs):  # @UnusedVariable @IgnorePep8
         """
         Performs a series of FSL preprocessing steps, including Eddy and Topup
@@ -106,7 +239,8 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
             The phase encode direction
         """
 
-        outputs = [DatasetSpec('preproc', nifti_gz_format),
+        outputs = [DatasetSpec('preproc', self.image_format(
+                       'preproc', fsl=not self.embedded_gradients)),
                    DatasetSpec('grad_dirs', fsl_bvecs_format),
                    DatasetSpec('bvalues', fsl_bvals_format),
                    DatasetSpec('eddy_par', eddy_par_format)]
@@ -116,18 +250,13 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
             outputs.append(DatasetSpec('noise_residual', mrtrix_format))
             citations.extend(dwidenoise_cites)
 
-        if 'dwi_reference' in self.input_names or 'reverse_phase' in self.input_names:
+        if self.distortion_correction:
             inputs = [DatasetSpec('primary', dicom_format),
-                      FieldSpec('ped', dtype=str),
-                      FieldSpec('pe_angle', dtype=str)]
-            if 'dwi_reference' in self.input_names:
-                inputs.append(DatasetSpec('dwi_reference', nifti_gz_format))
-            if 'reverse_phase' in self.input_names:
-                inputs.append(DatasetSpec('reverse_phase', nifti_gz_format))
-            distortion_correction = True
+                      DatasetSpec('topup_fieldcoef', nifti_gz_format),
+                      DatasetSpec('topup_movpar', text_format),
+                      DatasetSpec('topup_acqp', text_format)]
         else:
             inputs = [DatasetSpec('primary', dicom_format)]
-            distortion_correction = False
 
         pipeline = self.create_pipeline(
             name='preprocess',
@@ -144,6 +273,7 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
             denoise = pipeline.create_node(DWIDenoise(), name='denoise',
                                            requirements=[mrtrix3_req])
             denoise.inputs.out_file_ext = '.mif'
+            set_node_threads(denoise, 4, self.runner)
             # Calculate residual noise
             subtract_operands = pipeline.create_node(Merge(2),
                                                      name='subtract_operands')
@@ -151,78 +281,188 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
                                             requirements=[mrtrix3_req])
             subtract.inputs.out_ext = '.mif'
             subtract.inputs.operation = 'subtract'
-        dwipreproc = pipeline.create_node(
-            DWIPreproc(), name='dwipreproc',
-            requirements=[mrtrix3_req, fsl510_req], wall_time=60)
-        dwipreproc.inputs.eddy_parameters = '--data_is_shelled '
-        dwipreproc.inputs.no_clean_up = True
-        dwipreproc.inputs.out_file_ext = '.nii.gz'
-        dwipreproc.inputs.temp_dir = 'dwipreproc_tempdir'
+        if self.distortion_correction:
+            # Run eddy directly with the susceptibility field estimated by
+            # topup_pipeline instead of estimating it again
+            eddy = pipeline.create_node(
+                Eddy(), name='eddy', requirements=[fsl510_req],
+                wall_time=60)
+            eddy.inputs.num_threads = set_node_threads(eddy, 4, self.runner)
+            eddy.inputs.is_shelled = True
+            eddy.inputs.output_type = 'NIFTI_GZ'
+            corrector = eddy
+            corrected_field, eddy_par_field = 'out_corrected', 'out_parameter'
+        else:
+            dwipreproc = pipeline.create_node(
+                DWIPreproc(), name='dwipreproc',
+                requirements=[mrtrix3_req, fsl510_req], wall_time=60)
+            set_node_threads(dwipreproc, 4, self.runner)
+            dwipreproc.inputs.eddy_parameters = '--data_is_shelled '
+            dwipreproc.inputs.no_clean_up = True
+            dwipreproc.inputs.out_file_ext = '.nii.gz'
+            dwipreproc.inputs.temp_dir = 'dwipreproc_tempdir'
+            if self.parameter('preproc_pe_dir') is not None:
+                dwipreproc.inputs.pe_dir = self.parameter('preproc_pe_dir')
+            corrector = dwipreproc
+            corrected_field, eddy_par_field = 'out_file', 'eddy_parameters'
         # Create node to reorient preproc out_file
         swap = pipeline.create_node(
             fsl.utils.Reorient2Std(), name='fslreorient2std',
             requirements=[fsl509_req])
-        if distortion_correction:
-            # Extract b=0 volumes
-            dwiextract = pipeline.create_node(
-                ExtractDWIorB0(), name='dwiextract',
-                requirements=[mrtrix3_req])
-            dwiextract.inputs.bzero = True
-            dwiextract.inputs.out_ext = '.nii.gz'
-            # Get first b=0 from dwi b=0 volumes
-            mrconvert = pipeline.create_node(MRConvert(), name="mrconvert",
-                                             requirements=[mrtrix3_req])
-            mrconvert.inputs.coord = (3, 0)
-            # Concatenate extracted forward rpe with reverse rpe
-            mrcat = pipeline.create_node(
-                MRCat(), name='mrcat', requirements=[mrtrix3_req])
-            # Create node to assign the right PED to the diffusion
-            prep_dwi = pipeline.create_node(PrepareDWI(), name='prepare_dwi')
-            # Create preprocessing node
-            dwipreproc.inputs.rpe_pair = True
-            if self.parameter('preproc_pe_dir') is not None:
-                dwipreproc.inputs.pe_dir = self.parameter('preproc_pe_dir')
-            # Create nodes to gradients to FSL format
-            extract_grad = pipeline.create_node(
-                ExtractFSLGradients(), name="extract_grad",
+        swap.inputs.output_type = self.fsl_output_type('preproc')
+        # Create nodes to gradients to FSL format
+        extract_grad = pipeline.create_node(
+            ExtractFSLGradients(), name="extract_grad",
+            requirements=[mrtrix3_req])
+        if self.embedded_gradients:
+            # Embed the gradient table in the header of the preprocessed
+            # image so downstream MRtrix tools don't need the FSL files
+            embed_grads = pipeline.create_node(
+                MRConvert(), name='embed_gradients',
                 requirements=[mrtrix3_req])
-            # Connect inputs
-            if 'dwi_reference' in self.input_names:
-                pipeline.connect_input('dwi_reference', mrcat, 'second_scan')
-            elif 'reverse_phase' in self.input_names:
-                pipeline.connect_input('reverse_phase', mrcat, 'second_scan')
-            else:
-                assert False
-            pipeline.connect_input('primary', dwiextract, 'in_file')
+            embed_grads.inputs.out_ext = '.mif'
+            embed_grads.inputs.quiet = True
+            fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
+        if self.distortion_correction:
+            # Convert the DWI series to the NIfTI format eddy requires
+            eddy_in = pipeline.create_node(
+                MRConvert(), name='eddy_in', requirements=[mrtrix3_req])
+            eddy_in.inputs.out_ext = '.nii.gz'
+            eddy_in.inputs.quiet = True
+            # Mask eddy with the brain extracted from the first b=0 volume
+            eddy_b0 = pipeline.create_node(ExtractB0(), name='eddy_b0')
+            eddy_b0.inputs.operation = 'first'
+            eddy_b0.inputs.b0_threshold = self.parameter('b0_threshold')
+            eddy_mask = pipeline.create_node(
+                fsl.BET(), name='eddy_mask', requirements=[fsl509_req])
+            eddy_mask.inputs.mask = True
+            eddy_mask.inputs.frac = self.parameter('fsl_mask_f')
+            # All volumes are acquired with the forward phase encoding,
+            # i.e. the first row of the acquisition parameters given to
+            # topup
+            eddy_index = pipeline.create_node(EddyIndex(), name='eddy_index')
+            pipeline.connect_input('topup_fieldcoef', eddy,
+                                   'in_topup_fieldcoef')
+            pipeline.connect_input('topup_movpar', eddy, 'in_topup_movpar')
+            pipeline.connect_input('topup_acqp', eddy, 'in_acqp')
+            pipeline.connect(eddy_in, 'out_file', eddy, 'in_file')
+            pipeline.connect(eddy_in, 'out_file', eddy_b0, 'in_file')
+            pipeline.connect(extract_grad, 'bvals_file', eddy_b0,
+                             'bvals_file')
+            pipeline.connect(eddy_b0, 'out_file', eddy_mask, 'in_file')
+            pipeline.connect(eddy_mask, 'mask_file', eddy, 'in_mask')
+            pipeline.connect(extract_grad, 'bvals_file', eddy_index,
+                             'bvals_file')
+            pipeline.connect(eddy_index, 'out_file', eddy, 'in_index')
+            pipeline.connect(extract_grad, 'bvecs_file', eddy, 'in_bvec')
+            pipeline.connect(extract_grad, 'bvals_file', eddy, 'in_bval')
+            dwi_in = eddy_in
+        else:
+            dwi_in = dwipreproc
         # Connect inter-nodes
         if self.switch('preproc_denoise'):
             pipeline.connect_input('primary', denoise, 'in_file')
             pipeline.connect_input('primary', subtract_operands, 'in1')
-            pipeline.connect(denoise, 'out_file', dwipreproc, 'in_file')
+            pipeline.connect(denoise, 'out_file', dwi_in, 'in_file')
             pipeline.connect(denoise, 'noise', subtract_operands, 'in2')
             pipeline.connect(subtract_operands, 'out', subtract, 'operands')
         else:
-            pipeline.connect_input('primary', dwipreproc, 'in_file')
-        if distortion_correction:
-            pipeline.connect_input('ped', prep_dwi, 'pe_dir')
-            pipeline.connect_input('pe_angle', prep_dwi, 'ped_polarity')
-            pipeline.connect(prep_dwi, 'pe', dwipreproc, 'pe_dir')
-            pipeline.connect(mrcat, 'out_file', dwipreproc, 'se_epi')
-            pipeline.connect(dwiextract, 'out_file', mrconvert, 'in_file')
-            pipeline.connect(mrconvert, 'out_file', mrcat, 'first_scan')
+            pipeline.connect_input('primary', dwi_in, 'in_file')
         pipeline.connect_input('primary', extract_grad, 'in_file')
-        pipeline.connect(dwipreproc, 'out_file', swap, 'in_file')
+        pipeline.connect(corrector, corrected_field, swap, 'in_file')
+        if self.embedded_gradients:
+            pipeline.connect(extract_grad, 'bvecs_file', fsl_grads, 'in1')
+            pipeline.connect(extract_grad, 'bvals_file', fsl_grads, 'in2')
+            pipeline.connect(fsl_grads, 'out', embed_grads, 'grad_fsl')
+            pipeline.connect(swap, 'out_file', embed_grads, 'in_file')
+            preproc_node = embed_grads
+        else:
+            preproc_node = swap
         # Connect outputs
-        pipeline.connect_output('preproc', swap, 'out_file')
+        pipeline.connect_output('preproc', preproc_node, 'out_file')
         pipeline.connect_output('grad_dirs', extract_grad,
                                 'bvecs_file')
         pipeline.connect_output('bvalues', extract_grad, 'bvals_file')
-        pipeline.connect_output('eddy_par', dwipreproc, 'eddy_parameters')
+        pipeline.connect_output('eddy_par', corrector, eddy_par_field)
         if self.switch('preproc_denoise'):
             pipeline.connect_output('noise_residual', subtract, 'out_file')
         # Check inputs/outputs are connected
         return pipeline
 
+    def topup_pipeline(self, **kwargs):  # @UnusedVariable @IgnorePep8
+        """
+        Estimates the susceptibility-induced field with topup from the first
+        b=0 volume of the DWI series and the reverse phase-encoded image(s),
+        so that the field can be reused by eddy each time the preprocessing
+        is rerun
+        """
+        inputs = [DatasetSpec('primary', dicom_format),
+                  FieldSpec('ped', dtype=str),
+                  FieldSpec('pe_angle', dtype=str)]
+        if 'dwi_reference' in self.input_names:
+            reverse_name = 'dwi_reference'
+        else:
+            reverse_name = 'reverse_phase'
+        inputs.append(DatasetSpec(reverse_name, nifti_gz_format))
+        pipeline = self.create_pipeline(
+            name='topup',
+            inputs=inputs,
+            outputs=[DatasetSpec('topup_fieldcoef', nifti_gz_format),
+                     DatasetSpec('topup_movpar', text_format),
+                     DatasetSpec('topup_acqp', text_format)],
+            desc=("Estimates the susceptibility-induced field from the "
+                  "b=0 volumes acquired with opposite phase encoding"),
+            version=1,
+            citations=[fsl_cite, topup_cite],
+            **kwargs)
+        extract_grad = pipeline.create_node(
+            ExtractFSLGradients(), name="extract_grad",
+            requirements=[mrtrix3_req])
+        # Convert the DICOMs to uncompressed NIfTI so the first b=0
+        # volume can be sliced from it in-process
+        primary_nifti = pipeline.create_node(
+            MRConvert(), name='primary_nifti',
+            requirements=[mrtrix3_req])
+        primary_nifti.inputs.out_ext = '.nii'
+        primary_nifti.inputs.quiet = True
+        # Slice the first b=0 volume, concatenate it with the reverse
+        # phase-encode volume(s) and resolve the phase-encoding
+        # direction in a single step
+        prep_se_epi = pipeline.create_node(PrepareSEEPIPair(),
+                                           name='prepare_se_epi')
+        prep_se_epi.inputs.b0_threshold = self.parameter('b0_threshold')
+        # The field is estimated in Hz, so eddy needs to be given the same
+        # readout time as topup to convert it into displacements correctly
+        readout_time = pipeline.create_node(TotalReadoutTime(),
+                                            name='readout_time')
+        readout_time.inputs.default = self.parameter('total_readout_time')
+        topup = pipeline.create_node(TOPUP(), name='topup',
+                                     requirements=[fsl510_req],
+                                     wall_time=30)
+        topup.inputs.config = self.parameter('topup_config')
+        topup.inputs.output_type = 'NIFTI_GZ'
+        # Connect inputs
+        pipeline.connect_input('primary', extract_grad, 'in_file')
+        pipeline.connect_input('primary', primary_nifti, 'in_file')
+        pipeline.connect_input('primary', readout_time, 'dicom_folder')
+        pipeline.connect_input(reverse_name, prep_se_epi, 'reverse_file')
+        pipeline.connect_input('ped', prep_se_epi, 'pe_dir')
+        pipeline.connect_input('pe_angle', prep_se_epi, 'ped_polarity')
+        # Connect inter-nodes
+        pipeline.connect(primary_nifti, 'out_file', prep_se_epi, 'in_file')
+        pipeline.connect(extract_grad, 'bvals_file', prep_se_epi,
+                         'bvals_file')
+        pipeline.connect(readout_time, 'readout_time', prep_se_epi,
+                         'readout_time')
+        pipeline.connect(prep_se_epi, 'out_file', topup, 'in_file')
+        pipeline.connect(prep_se_epi, 'encoding_file', topup,
+                         'encoding_file')
+        # Connect outputs
+        pipeline.connect_output('topup_fieldcoef', topup, 'out_fieldcoef')
+        pipeline.connect_output('topup_movpar', topup, 'out_movpar')
+        pipeline.connect_output('topup_acqp', prep_se_epi, 'encoding_file')
+        return pipeline
+
     def brain_extraction_pipeline(self, **kwargs):  # @UnusedVariable @IgnorePep8
         """
         Generates a whole brain mask using MRtrix's 'dwi2mask' command
@@ -236,10 +476,10 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         if self.branch('brain_extract_method', 'mrtrix'):
             pipeline = self.create_pipeline(
                 'brain_extraction',
-                inputs=[DatasetSpec('preproc', nifti_gz_format),
-                        DatasetSpec('grad_dirs', fsl_bvecs_format),
-                        DatasetSpec('bvalues', fsl_bvals_format)],
-                outputs=[DatasetSpec('brain_mask', nifti_gz_format)],
+                inputs=([DatasetSpec('preproc', self.image_format('preproc'))] +
+                        self.gradient_inputs()),
+                outputs=[DatasetSpec('brain_mask',
+                                     self.image_format('brain_mask'))],
                 desc="Generate brain mask from b0 images",
                 version=1,
                 citations=[mrtrix_cite],
@@ -247,14 +487,10 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
             # Create mask node
             dwi2mask = pipeline.create_node(BrainMask(), name='dwi2mask',
                                             requirements=[mrtrix3_req])
-            dwi2mask.inputs.out_file = 'brain_mask.nii.gz'
-            # Gradient merge node
-            grad_fsl = pipeline.create_node(MergeTuple(2), name="grad_fsl")
-            # Connect nodes
-            pipeline.connect(grad_fsl, 'out', dwi2mask, 'grad_fsl')
+            dwi2mask.inputs.out_file = (
+                'brain_mask' + self.image_format('brain_mask').extension)
             # Connect inputs
-            pipeline.connect_input('grad_dirs', grad_fsl, 'in1')
-            pipeline.connect_input('bvalues', grad_fsl, 'in2')
+            self.connect_gradients(pipeline, dwi2mask)
             pipeline.connect_input('preproc', dwi2mask, 'in_file')
             # Connect outputs
             pipeline.connect_output('brain_mask', dwi2mask, 'out_file')
@@ -272,11 +508,14 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         bias_method = self.switch('bias_correct_method')
         pipeline = self.create_pipeline(
             name='bias_correct',
-            inputs=[DatasetSpec('preproc', nifti_gz_format),
-                    DatasetSpec('brain_mask', nifti_gz_format),
-                    DatasetSpec('grad_dirs', fsl_bvecs_format),
-                    DatasetSpec('bvalues', fsl_bvals_format)],
-            outputs=[DatasetSpec('bias_correct', nifti_gz_format)],
+            inputs=([DatasetSpec('preproc', self.image_format('preproc')),
+                     DatasetSpec('brain_mask',
+                                 self.image_format('brain_mask'))] +
+                    self.gradient_inputs()),
+            # The bias corrected image is written in the same format as the
+            # input
+            outputs=[DatasetSpec('bias_correct',
+                                 self.image_format('preproc'))],
             desc="Corrects for B1 field inhomogeneity",
             version=1,
             citations=[fast_cite,
@@ -289,13 +528,9 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
                 [mrtrix3_req] +
                 [ants2_req if bias_method == 'ants' else fsl509_req]))
         bias_correct.inputs.method = bias_method
-        # Gradient merge node
-        fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
-        # Connect nodes
-        pipeline.connect(fsl_grads, 'out', bias_correct, 'grad_fsl')
+        set_node_threads(bias_correct, 2, self.runner)
         # Connect to inputs
-        pipeline.connect_input('grad_dirs', fsl_grads, 'in1')
-        pipeline.connect_input('bvalues', fsl_grads, 'in2')
+        self.connect_gradients(pipeline, bias_correct)
         pipeline.connect_input('preproc', bias_correct, 'in_file')
         pipeline.connect_input('brain_mask', bias_correct, 'mask')
         # Connect to outputs
@@ -306,10 +541,11 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
     def intensity_normalisation_pipeline(self, **kwargs):
         pipeline = self.create_pipeline(
             name='intensity_normalization',
-            inputs=[DatasetSpec('bias_correct', nifti_gz_format),
-                    DatasetSpec('brain_mask', nifti_gz_format),
-                    DatasetSpec('grad_dirs', fsl_bvecs_format),
-                    DatasetSpec('bvalues', fsl_bvals_format)],
+            inputs=([DatasetSpec('bias_correct',
+                                 self.image_format('bias_correct')),
+                     DatasetSpec('brain_mask',
+                                 self.image_format('brain_mask'))] +
+                    self.gradient_inputs()),
             outputs=[DatasetSpec('norm_intensity', mrtrix_format),
                      DatasetSpec('norm_intens_fa_template', mrtrix_format,
                                  frequency='per_project'),
@@ -319,10 +555,10 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
             version=1,
             citations=[mrtrix3_req],
             **kwargs)
-        # Convert from nifti to mrtrix format
-        grad_merge = pipeline.create_node(MergeTuple(2), name="grad_merge")
-        mrconvert = pipeline.create_node(MRConvert(), name='mrconvert')
-        mrconvert.inputs.out_ext = '.mif'
+        if not self.embedded_gradients:
+            # Convert from nifti to mrtrix format
+            mrconvert = pipeline.create_node(MRConvert(), name='mrconvert')
+            mrconvert.inputs.out_ext = '.mif'
         # Set up join nodes
         fields = ['dwis', 'masks', 'subject_ids', 'visit_ids']
         join_subjects = pipeline.create_join_subjects_node(
@@ -338,17 +574,18 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         intensity_norm = pipeline.create_node(
             DWIIntensityNorm(), name='dwiintensitynorm')
         # Connect inputs
-        pipeline.connect_input('bias_correct', mrconvert, 'in_file')
-        pipeline.connect_input('grad_dirs', grad_merge, 'in1')
-        pipeline.connect_input('bvalues', grad_merge, 'in2')
+        if self.embedded_gradients:
+            pipeline.connect_input('bias_correct', join_subjects, 'dwis')
+        else:
+            pipeline.connect_input('bias_correct', mrconvert, 'in_file')
+            self.connect_gradients(pipeline, mrconvert)
+            pipeline.connect(mrconvert, 'out_file', join_subjects, 'dwis')
         pipeline.connect_subject_id(join_subjects, 'subject_ids')
         pipeline.connect_visit_id(join_subjects, 'visit_ids')
         pipeline.connect_subject_id(select, 'subject_id')
         pipeline.connect_visit_id(select, 'visit_id')
         pipeline.connect_input('brain_mask', join_subjects, 'masks')
         # Internal connections
-        pipeline.connect(grad_merge, 'out', mrconvert, 'grad_fsl')
-        pipeline.connect(mrconvert, 'out_file', join_subjects, 'dwis')
         pipeline.connect(join_subjects, 'dwis', join_visits, 'dwis')
         pipeline.connect(join_subjects, 'masks', join_visits, 'masks')
         pipeline.connect(join_subjects, 'subject_ids', join_visits,
@@ -371,33 +608,75 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
     def tensor_pipeline(self, **kwargs):  # @UnusedVariable
         """
         Fits the apparrent diffusion tensor (DT) to each voxel of the image
+        and calculates the FA and diffusivity maps from it
         """
+        outputs = [DatasetSpec('tensor', nifti_gz_format),
+                   DatasetSpec('fa', nifti_gz_format),
+                   DatasetSpec('adc', nifti_gz_format)]
+        if self.branch('tensor_fit_method', 'native'):
+            # Read uncompressed so the fit can memory-map slabs of the image
+            inputs = [DatasetSpec('bias_correct', nifti_format),
+                      DatasetSpec('brain_mask',
+                                  self.image_format('brain_mask')),
+                      DatasetSpec('grad_dirs', fsl_bvecs_format),
+                      DatasetSpec('bvalues', fsl_bvals_format)]
+            outputs.extend([DatasetSpec('ad', nifti_gz_format),
+                            DatasetSpec('rd', nifti_gz_format)])
+        else:
+            inputs = ([DatasetSpec('bias_correct',
+                                   self.image_format('bias_correct')),
+                       DatasetSpec('brain_mask',
+                                   self.image_format('brain_mask'))] +
+                      self.gradient_inputs())
         pipeline = self.create_pipeline(
             name='tensor',
-            inputs=[DatasetSpec('bias_correct', nifti_gz_format),
-                    DatasetSpec('grad_dirs', fsl_bvecs_format),
-                    DatasetSpec('bvalues', fsl_bvals_format),
-                    DatasetSpec('brain_mask', nifti_gz_format)],
-            outputs=[DatasetSpec('tensor', nifti_gz_format)],
+            inputs=inputs,
+            outputs=outputs,
             desc=("Estimates the apparent diffusion tensor in each "
                   "voxel"),
             version=1,
             citations=[],
             **kwargs)
-        # Create tensor fit node
-        dwi2tensor = pipeline.create_node(FitTensor(), name='dwi2tensor')
-        dwi2tensor.inputs.out_file = 'dti.nii.gz'
-        # Gradient merge node
-        fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
-        # Connect nodes
-        pipeline.connect(fsl_grads, 'out', dwi2tensor, 'grad_fsl')
-        # Connect to inputs
-        pipeline.connect_input('grad_dirs', fsl_grads, 'in1')
-        pipeline.connect_input('bvalues', fsl_grads, 'in2')
-        pipeline.connect_input('bias_correct', dwi2tensor, 'in_file')
-        pipeline.connect_input('brain_mask', dwi2tensor, 'in_mask')
-        # Connect to outputs
-        pipeline.connect_output('tensor', dwi2tensor, 'out_file')
+        if self.branch('tensor_fit_method', 'native'):
+            # Create tensor fit node
+            fit_memory = self.parameter('tensor_fit_memory')
+            tensor_fit = pipeline.create_node(
+                TensorFit(), name='tensor_fit', wall_time=20,
+                memory=fit_memory + 2000)
+            tensor_fit.inputs.max_memory = int(fit_memory * 1024 ** 2)
+            set_node_threads(tensor_fit, 4, self.runner)
+            # Connect to inputs
+            pipeline.connect_input('bias_correct', tensor_fit, 'in_file')
+            pipeline.connect_input('brain_mask', tensor_fit, 'in_mask')
+            pipeline.connect_input('grad_dirs', tensor_fit, 'bvecs_file')
+            pipeline.connect_input('bvalues', tensor_fit, 'bvals_file')
+            # Connect to outputs
+            pipeline.connect_output('tensor', tensor_fit, 'out_file')
+            pipeline.connect_output('fa', tensor_fit, 'fa')
+            pipeline.connect_output('adc', tensor_fit, 'md')
+            pipeline.connect_output('ad', tensor_fit, 'ad')
+            pipeline.connect_output('rd', tensor_fit, 'rd')
+        else:
+            # Create tensor fit node
+            dwi2tensor = pipeline.create_node(FitTensor(), name='dwi2tensor',
+                                              requirements=[mrtrix3_req])
+            dwi2tensor.inputs.out_file = 'dti.nii.gz'
+            set_node_threads(dwi2tensor, 2, self.runner)
+            # Create tensor metrics node
+            metrics = pipeline.create_node(TensorMetrics(), name='metrics',
+                                           requirements=[mrtrix3_req])
+            metrics.inputs.out_fa = 'fa.nii.gz'
+            metrics.inputs.out_adc = 'adc.nii.gz'
+            # Connect to inputs
+            self.connect_gradients(pipeline, dwi2tensor)
+            pipeline.connect_input('bias_correct', dwi2tensor, 'in_file')
+            pipeline.connect_input('brain_mask', dwi2tensor, 'in_mask')
+            pipeline.connect_input('brain_mask', metrics, 'in_mask')
+            pipeline.connect(dwi2tensor, 'out_file', metrics, 'in_file')
+            # Connect to outputs
+            pipeline.connect_output('tensor', dwi2tensor, 'out_file')
+            pipeline.connect_output('fa', metrics, 'out_fa')
+            pipeline.connect_output('adc', metrics, 'out_adc')
         # Check inputs/output are connected
         return pipeline
 
@@ -408,7 +687,8 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         pipeline = self.create_pipeline(
             name='fa',
             inputs=[DatasetSpec('tensor', nifti_gz_format),
-                    DatasetSpec('brain_mask', nifti_gz_format)],
+                    DatasetSpec('brain_mask',
+                                self.image_format('brain_mask'))],
             outputs=[DatasetSpec('fa', nifti_gz_format),
                      DatasetSpec('adc', nifti_gz_format)],
             desc=("Calculates the FA and ADC from a tensor image"),
@@ -445,10 +725,11 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
             outputs.append(DatasetSpec('csf_response', text_format))
         pipeline = self.create_pipeline(
             name='response',
-            inputs=[DatasetSpec('bias_correct', nifti_gz_format),
-                    DatasetSpec('grad_dirs', fsl_bvecs_format),
-                    DatasetSpec('bvalues', fsl_bvals_format),
-                    DatasetSpec('brain_mask', nifti_gz_format)],
+            inputs=([DatasetSpec('bias_correct',
+                                 self.image_format('bias_correct')),
+                     DatasetSpec('brain_mask',
+                                 self.image_format('brain_mask'))] +
+                    self.gradient_inputs()),
             outputs=outputs,
             desc=("Estimates the fibre response function"),
             version=1,
@@ -458,13 +739,9 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         response = pipeline.create_node(ResponseSD(), name='response',
                                         requirements=[mrtrix3_req])
         response.inputs.algorithm = self.switch('response_algorithm')
-        # Gradient merge node
-        fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
-        # Connect nodes
-        pipeline.connect(fsl_grads, 'out', response, 'grad_fsl')
+        set_node_threads(response, 2, self.runner)
         # Connect to inputs
-        pipeline.connect_input('grad_dirs', fsl_grads, 'in1')
-        pipeline.connect_input('bvalues', fsl_grads, 'in2')
+        self.connect_gradients(pipeline, response)
         pipeline.connect_input('bias_correct', response, 'in_file')
         pipeline.connect_input('brain_mask', response, 'in_mask')
         # Connect to outputs
@@ -480,32 +757,74 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
     def average_response_pipeline(self, **kwargs):
         """
         Averages the estimate response function over all subjects in the
-        project
+        project. If the running sum of a previous average is provided the
+        responses of new sessions are added to it, and the average is only
+        passed on to the FOD estimation if it has drifted from the previous
+        one by more than 'response_drift_tolerance'
+
+        Note that the pipeline still joins the responses of all sessions
+        (only those not already in the running sum are read), and that
+        Arcana doesn't rerun it while the per-project outputs exist. To
+        add new sessions to a previous average:
+
+            1. copy the 'avg_response_state' derived from the previous run
+               and match it as the 'avg_response_prev_state' input
+            2. delete the per-project outputs of the previous run
+               ('avg_response', 'avg_response_state', 'fod_response' and
+               'avg_response_drift')
+            3. request 'fod_response' (or any data derived from it) again
         """
+        inputs = [DatasetSpec('wm_response', text_format)]
+        if 'avg_response_prev_state' in self.input_names:
+            inputs.append(DatasetSpec('avg_response_prev_state', json_format,
+                                      frequency='per_project'))
         pipeline = self.create_pipeline(
             name='average_response',
-            inputs=[DatasetSpec('wm_response', text_format)],
+            inputs=inputs,
             outputs=[DatasetSpec('avg_response', text_format,
-                                 frequency='per_project')],
+                                 frequency='per_project'),
+                     DatasetSpec('avg_response_state', json_format,
+                                 frequency='per_project'),
+                     DatasetSpec('fod_response', text_format,
+                                 frequency='per_project'),
+                     FieldSpec('avg_response_drift', dtype=float,
+                               frequency='per_project')],
             desc=(
                 "Averages the fibre response function over the project"),
             version=1,
             citations=[mrtrix_cite],
             **kwargs)
+        fields = ['responses', 'subject_ids', 'visit_ids']
         join_subjects = pipeline.create_join_subjects_node(
-            IdentityInterface(['responses']), name='join_subjects',
-            joinfield=['responses'])
+            IdentityInterface(fields), name='join_subjects',
+            joinfield=fields)
         join_visits = pipeline.create_join_visits_node(
-            Chain(['responses']), name='join_visits', joinfield=['responses'])
-        avg_response = pipeline.create_node(AverageResponse(),
+            Chain(fields), name='join_visits', joinfield=fields)
+        avg_response = pipeline.create_node(AverageResponses(),
                                             name='avg_response')
+        avg_response.inputs.drift_tolerance = self.parameter(
+            'response_drift_tolerance')
         # Connect inputs
         pipeline.connect_input('wm_response', join_subjects, 'responses')
+        pipeline.connect_subject_id(join_subjects, 'subject_ids')
+        pipeline.connect_visit_id(join_subjects, 'visit_ids')
+        if 'avg_response_prev_state' in self.input_names:
+            pipeline.connect_input('avg_response_prev_state', avg_response,
+                                   'in_state')
         # Connect inter-nodes
-        pipeline.connect(join_subjects, 'responses', join_visits, 'responses')
+        for field in fields:
+            pipeline.connect(join_subjects, field, join_visits, field)
         pipeline.connect(join_visits, 'responses', avg_response, 'in_files')
+        pipeline.connect(join_visits, 'subject_ids', avg_response,
+                         'subject_ids')
+        pipeline.connect(join_visits, 'visit_ids', avg_response, 'visit_ids')
         # Connect outputs
         pipeline.connect_output('avg_response', avg_response, 'out_file')
+        pipeline.connect_output('avg_response_state', avg_response,
+                                'state_file')
+        pipeline.connect_output('fod_response', avg_response,
+                                'reference_file')
+        pipeline.connect_output('avg_response_drift', avg_response, 'drift')
         # Check inputs/output are connected
         return pipeline
 # 
@@ -547,11 +866,20 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         Parameters
         ----------
         """
-        inputs = [DatasetSpec('bias_correct', nifti_gz_format),
-                  DatasetSpec('grad_dirs', fsl_bvecs_format),
-                  DatasetSpec('bvalues', fsl_bvals_format),
-                  DatasetSpec('wm_response', text_format),
-                  DatasetSpec('brain_mask', nifti_gz_format)]
+        if self.branch('fod_response', 'group'):
+            # The group average is only updated when it drifts beyond the
+            # tolerance, so the FODs don't need to be re-estimated each time
+            # a subject is added
+            response = DatasetSpec('fod_response', text_format,
+                                   frequency='per_project')
+        else:
+            response = DatasetSpec('wm_response', text_format)
+        inputs = ([DatasetSpec('bias_correct',
+                               self.image_format('bias_correct')),
+                   response,
+                   DatasetSpec('brain_mask',
+                               self.image_format('brain_mask'))] +
+                  self.gradient_inputs())
         outputs = [DatasetSpec('wm_odf', mrtrix_format)]
         if self.multi_tissue:
             inputs.append(DatasetSpec('gm_response', text_format))
@@ -575,15 +903,11 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         dwi2fod = pipeline.create_node(EstimateFOD(), name='dwi2fod',
                                        requirements=[mrtrix3_req])
         dwi2fod.inputs.algorithm = algorithm
-        # Gradient merge node
-        fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
-        # Connect nodes
-        pipeline.connect(fsl_grads, 'out', dwi2fod, 'grad_fsl')
+        set_node_threads(dwi2fod, 4, self.runner)
         # Connect to inputs
-        pipeline.connect_input('grad_dirs', fsl_grads, 'in1')
-        pipeline.connect_input('bvalues', fsl_grads, 'in2')
+        self.connect_gradients(pipeline, dwi2fod)
         pipeline.connect_input('bias_correct', dwi2fod, 'in_file')
-        pipeline.connect_input('wm_response', dwi2fod, 'wm_txt')
+        pipeline.connect_input(response.name, dwi2fod, 'wm_txt')
         pipeline.connect_input('brain_mask', dwi2fod, 'mask_file')
         # Connect to outputs
         pipeline.connect_output('wm_odf', dwi2fod, 'wm_odf')
@@ -598,32 +922,142 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         # Check inputs/output are connected
         return pipeline
 
+    def tbss_registration_pipeline(self, **kwargs):  # @UnusedVariable
+        """
+        Registers the FA map of each session to the FMRIB58 FA template, as
+        in the first two stages of TBSS. Run per-session so that the
+        registrations of existing subjects are reused when subjects are
+        added to the project
+        """
+        pipeline = self.create_pipeline(
+            name='tbss_registration',
+            inputs=[DatasetSpec('fa', nifti_gz_format)],
+            outputs=[DatasetSpec('tbss_fa_std', nifti_gz_format),
+                     DatasetSpec('tbss_fa_warp', nifti_gz_format)],
+            desc="Registers the FA map to the TBSS target",
+            version=1,
+            citations=[tbss_cite, fsl_cite],
+            **kwargs)
+        target = fsl.Info.standard_image('FMRIB58_FA_1mm.nii.gz')
+        # Erode the FA map and create the registration mask
+        prep = pipeline.create_node(PrepareTBSSFA(), name='prepare_fa')
+        # Affine initialisation of the nonlinear registration
+        flirt = pipeline.create_node(
+            fsl.FLIRT(), name='flirt', requirements=[fsl509_req],
+            wall_time=5)
+        flirt.inputs.reference = target
+        flirt.inputs.dof = 12
+        flirt.inputs.output_type = 'NIFTI_GZ'
+        # Register to the target
+        fnirt = pipeline.create_node(
+            fsl.FNIRT(), name='fnirt', requirements=[fsl509_req],
+            wall_time=60)
+        fnirt.inputs.ref_file = target
+        fnirt.inputs.config_file = 'FA_2_FMRIB58_1mm'
+        fnirt.inputs.fieldcoeff_file = True
+        # Apply the warp
+        applywarp = pipeline.create_node(
+            fsl.ApplyWarp(), name='applywarp', requirements=[fsl509_req])
+        applywarp.inputs.ref_file = target
+        # Connect inputs
+        pipeline.connect_input('fa', prep, 'in_file')
+        # Connect between nodes
+        pipeline.connect(prep, 'out_file', flirt, 'in_file')
+        pipeline.connect(prep, 'mask_file', flirt, 'in_weight')
+        pipeline.connect(prep, 'out_file', fnirt, 'in_file')
+        pipeline.connect(prep, 'mask_file', fnirt, 'inmask_file')
+        pipeline.connect(flirt, 'out_matrix_file', fnirt, 'affine_file')
+        pipeline.connect(prep, 'out_file', applywarp, 'in_file')
+        pipeline.connect(fnirt, 'fieldcoeff_file', applywarp, 'field_file')
+        # Connect outputs
+        pipeline.connect_output('tbss_fa_std', applywarp, 'out_file')
+        pipeline.connect_output('tbss_fa_warp', fnirt, 'fieldcoeff_file')
+        # Check inputs/output are connected
+        return pipeline
+
     def tbss_pipeline(self, **kwargs):  # @UnusedVariable
+        """
+        Creates the mean FA map and its skeleton from the registered FA maps
+        of all sessions, and projects them onto it, as in the last two
+        stages of TBSS. Only these steps need to be rerun when subjects are
+        added to the project
+
+        Parameters
+        ----------
+        tbss_skel_thresh : float
+            FA threshold applied to the mean skeleton
+        """
         pipeline = self.create_pipeline(
             name='tbss',
-            inputs=[DatasetSpec('fa', nifti_gz_format)],
-            outputs=[DatasetSpec('tbss_mean_fa', nifti_gz_format),
+            inputs=[DatasetSpec('tbss_fa_std', nifti_gz_format)],
+            outputs=[DatasetSpec('tbss_mean_fa', nifti_gz_format,
+                                 frequency='per_project'),
                      DatasetSpec('tbss_proj_fa', nifti_gz_format,
                                  frequency='per_project'),
                      DatasetSpec('tbss_skeleton', nifti_gz_format,
                                  frequency='per_project'),
                      DatasetSpec('tbss_skeleton_mask', nifti_gz_format,
                                  frequency='per_project')],
+            desc=("Creates the mean FA skeleton and projects the registered "
+                  "FA maps onto it"),
             version=1,
             citations=[tbss_cite, fsl_cite],
             **kwargs)
-        # Create TBSS workflow
-        tbss = create_tbss_all(name='tbss')
+        # Set up join nodes
+        join_subjects = pipeline.create_join_subjects_node(
+            IdentityInterface(['fas']), joinfield=['fas'],
+            name='join_subjects')
+        join_visits = pipeline.create_join_visits_node(
+            Chain(['fas']), joinfield=['fas'], name='join_visits')
+        # Merge the registered FA maps and mask them by their intersection
+        merge = pipeline.create_node(fsl.Merge(), name='merge_fa',
+                                     requirements=[fsl509_req])
+        merge.inputs.dimension = 't'
+        group_mask = pipeline.create_node(
+            fsl.ImageMaths(), name='group_mask', requirements=[fsl509_req])
+        group_mask.inputs.op_string = '-max 0 -Tmin -bin'
+        group_mask.inputs.out_data_type = 'char'
+        group_mask.inputs.suffix = '_mask'
+        mask_group = pipeline.create_node(
+            fsl.ImageMaths(), name='mask_group', requirements=[fsl509_req])
+        mask_group.inputs.op_string = '-mas'
+        mask_group.inputs.suffix = '_masked'
+        # Create the mean FA and its skeleton
+        mean_fa = pipeline.create_node(
+            fsl.ImageMaths(), name='mean_fa', requirements=[fsl509_req])
+        mean_fa.inputs.op_string = '-Tmean'
+        mean_fa.inputs.suffix = '_mean'
+        skeleton = pipeline.create_node(
+            fsl.TractSkeleton(), name='skeleton', requirements=[fsl509_req])
+        skeleton.inputs.skeleton_file = True
+        # Threshold the skeleton and project the FA maps onto it
+        tbss4 = create_tbss_4_prestats(name='tbss4')
+        tbss4.inputs.inputnode.skeleton_thresh = self.parameter(
+            'tbss_skel_thresh')
         # Connect inputs
-        pipeline.connect_input('fa', tbss, 'inputnode.fa_list')
+        pipeline.connect_input('tbss_fa_std', join_subjects, 'fas')
+        # Connect between nodes
+        pipeline.connect(join_subjects, 'fas', join_visits, 'fas')
+        pipeline.connect(join_visits, 'fas', merge, 'in_files')
+        pipeline.connect(merge, 'merged_file', group_mask, 'in_file')
+        pipeline.connect(merge, 'merged_file', mask_group, 'in_file')
+        pipeline.connect(group_mask, 'out_file', mask_group, 'in_file2')
+        pipeline.connect(mask_group, 'out_file', mean_fa, 'in_file')
+        pipeline.connect(mean_fa, 'out_file', skeleton, 'in_file')
+        pipeline.connect(group_mask, 'out_file', tbss4,
+                         'inputnode.groupmask')
+        pipeline.connect(skeleton, 'skeleton_file', tbss4,
+                         'inputnode.skeleton_file')
+        pipeline.connect(mean_fa, 'out_file', tbss4, 'inputnode.meanfa_file')
+        pipeline.connect(mask_group, 'out_file', tbss4,
+                         'inputnode.all_FA_file')
         # Connect outputs
-        pipeline.connect_output('tbss_mean_fa', tbss,
-                                'outputnode.meanfa_file')
-        pipeline.connect_output('tbss_proj_fa', tbss,
+        pipeline.connect_output('tbss_mean_fa', mean_fa, 'out_file')
+        pipeline.connect_output('tbss_proj_fa', tbss4,
                                 'outputnode.projectedfa_file')
-        pipeline.connect_output('tbss_skeleton', tbss,
+        pipeline.connect_output('tbss_skeleton', tbss4,
                                 'outputnode.skeleton_file')
-        pipeline.connect_output('tbss_skeleton_mask', tbss,
+        pipeline.connect_output('tbss_skeleton_mask', tbss4,
                                 'outputnode.skeleton_mask')
         # Check inputs/output are connected
         return pipeline
@@ -634,44 +1068,24 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         """
         pipeline = self.create_pipeline(
             name='extract_b0',
-            inputs=[DatasetSpec('bias_correct', nifti_gz_format),
-                    DatasetSpec('grad_dirs', fsl_bvecs_format),
+            # Read uncompressed so only the b0 volumes are read from disk
+            inputs=[DatasetSpec('bias_correct', nifti_format),
                     DatasetSpec('bvalues', fsl_bvals_format)],
             outputs=[DatasetSpec('b0', nifti_gz_format)],
             desc="Extract b0 image from a DWI study",
             version=1,
-            citations=[mrtrix_cite],
+            citations=[],
             **kwargs)
-        # Gradient merge node
-        fsl_grads = pipeline.create_node(MergeTuple(2), name="fsl_grads")
         # Extraction node
-        extract_b0s = pipeline.create_node(
-            ExtractDWIorB0(), name='extract_b0s',
-            requirements=[mrtrix3_req])
-        extract_b0s.inputs.bzero = True
-        extract_b0s.inputs.quiet = True
         # FIXME: Need a registration step before the mean
-        # Mean calculation node
-        mean = pipeline.create_node(MRMath(), name="mean",
-                                    requirements=[mrtrix3_req])
-        mean.inputs.axis = 3
-        mean.inputs.operation = 'mean'
-        mean.inputs.quiet = True
-        # Convert to Nifti
-        mrconvert = pipeline.create_node(MRConvert(), name="output_conversion",
-                                         requirements=[mrtrix3_req])
-        mrconvert.inputs.out_ext = '.nii.gz'
-        mrconvert.inputs.quiet = True
+        extract_b0 = pipeline.create_node(ExtractB0(), name='extract_b0')
+        extract_b0.inputs.operation = 'mean'
+        extract_b0.inputs.b0_threshold = self.parameter('b0_threshold')
         # Connect inputs
-        pipeline.connect_input('bias_correct', extract_b0s, 'in_file')
-        pipeline.connect_input('grad_dirs', fsl_grads, 'in1')
-        pipeline.connect_input('bvalues', fsl_grads, 'in2')
-        # Connect between nodes
-        pipeline.connect(extract_b0s, 'out_file', mean, 'in_files')
-        pipeline.connect(fsl_grads, 'out', extract_b0s, 'grad_fsl')
-        pipeline.connect(mean, 'out_file', mrconvert, 'in_file')
+        pipeline.connect_input('bias_correct', extract_b0, 'in_file')
+        pipeline.connect_input('bvalues', extract_b0, 'bvals_file')
         # Connect outputs
-        pipeline.connect_output('b0', mrconvert, 'out_file')
+        pipeline.connect_output('b0', extract_b0, 'out_file')
         pipeline.assert_connected()
         # Check inputs/outputs are connected
         return pipeline
@@ -692,7 +1106,8 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
 
         pipeline = self.create_pipeline(
             name='affine_mat_generation',
-            inputs=[DatasetSpec('preproc', nifti_gz_format),
+            inputs=[DatasetSpec('preproc',
+                                self.image_format('preproc', fsl=True)),
                     DatasetSpec('eddy_par', eddy_par_format)],
             outputs=[
                 DatasetSpec('align_mats', directory_format)],
@@ -712,6 +1127,77 @@ class DiffusionStudy(EPIStudy, metaclass=StudyMetaClass):
         return pipeline
 
 
+    def qc_pipeline(self, **kwargs):  # @UnusedVariable
+        """
+        Calculates quality-control summary statistics of the preprocessed
+        DWI series and the derived tensor metrics (e.g. mean FA in the brain
+        mask, b0 SNR, number of outlier slices, peak motion) in a single
+        streaming pass and saves them in a compact record for the session
+        """
+        pipeline = self.create_pipeline(
+            name='qc',
+            inputs=[DatasetSpec('preproc',
+                                self.image_format('preproc', fsl=True)),
+                    DatasetSpec('bvalues', fsl_bvals_format),
+                    DatasetSpec('brain_mask',
+                                self.image_format('brain_mask', fsl=True)),
+                    DatasetSpec('fa', nifti_gz_format),
+                    DatasetSpec('adc', nifti_gz_format),
+                    DatasetSpec('eddy_par', eddy_par_format)],
+            outputs=[DatasetSpec('dwi_qc', json_format)],
+            desc="Summary statistics of the DWI series for QC",
+            version=1,
+            citations=[],
+            **kwargs)
+        qc = pipeline.create_node(DWIQC(), name='qc')
+        qc.inputs.b0_threshold = self.parameter('b0_threshold')
+        qc.inputs.outlier_threshold = self.parameter('qc_outlier_threshold')
+        # Connect inputs
+        pipeline.connect_input('preproc', qc, 'in_file')
+        pipeline.connect_input('bvalues', qc, 'bvals_file')
+        pipeline.connect_input('brain_mask', qc, 'mask_file')
+        pipeline.connect_input('fa', qc, 'fa_file')
+        pipeline.connect_input('adc', qc, 'md_file')
+        pipeline.connect_input('eddy_par', qc, 'eddy_par_file')
+        # Connect outputs
+        pipeline.connect_output('dwi_qc', qc, 'out_file')
+        return pipeline
+
+    def qc_summary_pipeline(self, **kwargs):  # @UnusedVariable
+        """
+        Collates the QC records of every session in the project into a
+        single table
+        """
+        pipeline = self.create_pipeline(
+            name='qc_summary',
+            inputs=[DatasetSpec('dwi_qc', json_format)],
+            outputs=[DatasetSpec('dwi_qc_table', csv_format,
+                                 frequency='per_project')],
+            desc="Collates the DWI QC records of the project",
+            version=1,
+            citations=[],
+            **kwargs)
+        fields = ['records', 'subject_ids', 'visit_ids']
+        join_subjects = pipeline.create_join_subjects_node(
+            IdentityInterface(fields), name='join_subjects',
+            joinfield=fields)
+        join_visits = pipeline.create_join_visits_node(
+            Chain(fields), name='join_visits', joinfield=fields)
+        collate = pipeline.create_node(CollateQC(), name='collate')
+        # Connect inputs
+        pipeline.connect_input('dwi_qc', join_subjects, 'records')
+        pipeline.connect_subject_id(join_subjects, 'subject_ids')
+        pipeline.connect_visit_id(join_subjects, 'visit_ids')
+        # Connect inter-nodes
+        for field in fields:
+            pipeline.connect(join_subjects, field, join_visits, field)
+        pipeline.connect(join_visits, 'records', collate, 'in_files')
+        pipeline.connect(join_visits, 'subject_ids', collate, 'subject_ids')
+        pipeline.connect(join_visits, 'visit_ids', collate, 'visit_ids')
+        # Connect outputs
+        pipeline.connect_output('dwi_qc_table', collate, 'out_file')
+        return pipeline
+
 class NODDIStudy(DiffusionStudy, metaclass=StudyMetaClass):
 
     add_data_specs = [
@@ -734,7 +1220,11 @@ class NODDIStudy(DiffusionStudy, metaclass=StudyMetaClass):
                                    'WatsonSHStickTortIsoV_B0')]
 
     add_switch_specs = [
-        SwitchSpec('single_slice', False)]
+        SwitchSpec('single_slice', False),
+        SwitchSpec('noddi_fit_method', 'amico', ('amico', 'matlab'),
+                   desc=("Whether NODDI is fitted in-process by the "
+                         "linearised (AMICO) method or with the NODDI "
+                         "MATLAB toolbox"))]
 
     def concatenate_pipeline(self, **kwargs):  # @UnusedVariable
         """
@@ -766,7 +1256,9 @@ class NODDIStudy(DiffusionStudy, metaclass=StudyMetaClass):
 
     def noddi_fitting_pipeline(self, **kwargs):  # @UnusedVariable
         """
-        Creates a ROI in which the NODDI processing will be performed
+        Fits the NODDI model, either in-process by the linearised AMICO
+        method or with the NODDI MATLAB toolbox (within a ROI created from
+        the brain mask)
 
         Parameters
         ----------
@@ -774,18 +1266,23 @@ class NODDIStudy(DiffusionStudy, metaclass=StudyMetaClass):
             If provided the processing is only performed on a single slice
             (for testing)
         noddi_model: Str
-            Name of the NODDI model to use for the fitting
+            Name of the NODDI model to use for the fitting (MATLAB toolbox
+            only)
         nthreads: Int
             Number of processes to use
         """
         pipeline_name = 'noddi_fitting'
-        inputs = [DatasetSpec('bias_correct', nifti_gz_format),
-                  DatasetSpec('grad_dirs', fsl_bvecs_format),
-                  DatasetSpec('bvalues', fsl_bvals_format)]
-        if self.switch('single_slice'):
-            inputs.append(DatasetSpec('eroded_mask', nifti_gz_format))
+        mask_name = ('eroded_mask' if self.switch('single_slice')
+                     else 'brain_mask')
+        if self.branch('noddi_fit_method', 'amico'):
+            # Read uncompressed so the fit can memory-map slabs of the image
+            inputs = [DatasetSpec('bias_correct', nifti_format),
+                      DatasetSpec(mask_name, nifti_gz_format)]
         else:
-            inputs.append(DatasetSpec('brain_mask', nifti_gz_format))
+            inputs = [DatasetSpec('bias_correct', nifti_gz_format),
+                      DatasetSpec(mask_name, nifti_gz_format)]
+        inputs.extend([DatasetSpec('grad_dirs', fsl_bvecs_format),
+                       DatasetSpec('bvalues', fsl_bvals_format)])
         pipeline = self.create_pipeline(
             name=pipeline_name,
             inputs=inputs,
@@ -799,65 +1296,82 @@ class NODDIStudy(DiffusionStudy, metaclass=StudyMetaClass):
                      DatasetSpec('kappa', nifti_format),
                      DatasetSpec('error_code', nifti_format)],
             desc=(
-                "Creates a ROI in which the NODDI processing will be "
-                "performed"),
+                "Fits the NODDI model to the voxels within the brain "
+                "mask"),
             citations=[noddi_cite],
             **kwargs)
-        # Create node to unzip the nifti files
-        unzip_bias_correct = pipeline.create_node(
-            MRConvert(), name="unzip_bias_correct",
-            requirements=[mrtrix3_req])
-        unzip_bias_correct.inputs.out_ext = 'nii'
-        unzip_bias_correct.inputs.quiet = True
-        unzip_mask = pipeline.create_node(MRConvert(), name="unzip_mask",
-                                          requirements=[mrtrix3_req])
-        unzip_mask.inputs.out_ext = 'nii'
-        unzip_mask.inputs.quiet = True
-        # Create create-roi node
-        create_roi = pipeline.create_node(
-            CreateROI(), name='create_roi',
-            requirements=[noddi_req, matlab2015_req],
-            memory=4000)
-        pipeline.connect(unzip_bias_correct, 'out_file', create_roi, 'in_file')
-        pipeline.connect(unzip_mask, 'out_file', create_roi, 'brain_mask')
-        # Create batch-fitting node
-        batch_fit = pipeline.create_node(
-            BatchNODDIFitting(), name="batch_fit",
-            requirements=[noddi_req, matlab2015_req], wall_time=180,
-            memory=8000)
-        batch_fit.inputs.model = self.parameter('noddi_model')
-        batch_fit.inputs.nthreads = self.runner.num_processes
-        pipeline.connect(create_roi, 'out_file', batch_fit, 'roi_file')
-        # Create output node
-        save_params = pipeline.create_node(
-            SaveParamsAsNIfTI(), name="save_params",
-            requirements=[noddi_req, matlab2015_req],
-            memory=4000)
-        save_params.inputs.output_prefix = 'params'
-        pipeline.connect(batch_fit, 'out_file', save_params, 'params_file')
-        pipeline.connect(create_roi, 'out_file', save_params, 'roi_file')
-        pipeline.connect(unzip_mask, 'out_file', save_params,
-                         'brain_mask_file')
-        # Connect inputs
-        pipeline.connect_input('bias_correct', unzip_bias_correct, 'in_file')
-        if not pipeline.switch('single_slice'):
-            pipeline.connect_input('eroded_mask', unzip_mask, 'in_file')
+        if self.branch('noddi_fit_method', 'amico'):
+            fit = pipeline.create_node(NODDIFit(), name='noddi_fit',
+                                       wall_time=60, memory=4000)
+            fit.inputs.b0_threshold = self.parameter('b0_threshold')
+            set_node_threads(fit, 4, self.runner)
+            pipeline.connect_input('bias_correct', fit, 'in_file')
+            pipeline.connect_input(mask_name, fit, 'in_mask')
+            pipeline.connect_input('grad_dirs', fit, 'bvecs_file')
+            pipeline.connect_input('bvalues', fit, 'bvals_file')
+            for name in ('ficvf', 'odi', 'fiso', 'fibredirs_xvec',
+                         'fibredirs_yvec', 'fibredirs_zvec', 'fmin',
+                         'kappa', 'error_code'):
+                pipeline.connect_output(name, fit, name)
         else:
-            pipeline.connect_input('brain_mask', unzip_mask, 'in_file')
-        pipeline.connect_input('grad_dirs', batch_fit, 'bvecs_file')
-        pipeline.connect_input('bvalues', batch_fit, 'bvals_file')
-        # Connect outputs
-        pipeline.connect_output('ficvf', save_params, 'ficvf')
-        pipeline.connect_output('odi', save_params, 'odi')
-        pipeline.connect_output('fiso', save_params, 'fiso')
-        pipeline.connect_output('fibredirs_xvec', save_params,
-                                'fibredirs_xvec')
-        pipeline.connect_output('fibredirs_yvec', save_params,
-                                'fibredirs_yvec')
-        pipeline.connect_output('fibredirs_zvec', save_params,
-                                'fibredirs_zvec')
-        pipeline.connect_output('fmin', save_params, 'fmin')
-        pipeline.connect_output('kappa', save_params, 'kappa')
-        pipeline.connect_output('error_code', save_params, 'error_code')
+            # Create node to unzip the nifti files
+            unzip_bias_correct = pipeline.create_node(
+                MRConvert(), name="unzip_bias_correct",
+                requirements=[mrtrix3_req])
+            unzip_bias_correct.inputs.out_ext = 'nii'
+            unzip_bias_correct.inputs.quiet = True
+            unzip_mask = pipeline.create_node(
+                MRConvert(), name="unzip_mask", requirements=[mrtrix3_req])
+            unzip_mask.inputs.out_ext = 'nii'
+            unzip_mask.inputs.quiet = True
+            # Create create-roi node
+            create_roi = pipeline.create_node(
+                CreateROI(), name='create_roi',
+                requirements=[noddi_req, matlab2015_req],
+                memory=4000)
+            pipeline.connect(unzip_bias_correct, 'out_file', create_roi,
+                             'in_file')
+            pipeline.connect(unzip_mask, 'out_file', create_roi,
+                             'brain_mask')
+            # Create batch-fitting node
+            batch_fit = pipeline.create_node(
+                BatchNODDIFitting(), name="batch_fit",
+                requirements=[noddi_req, matlab2015_req], wall_time=180,
+                memory=8000)
+            batch_fit.inputs.model = self.parameter('noddi_model')
+            set_node_threads(batch_fit, self.runner.num_processes,
+                             self.runner)
+            pipeline.connect(create_roi, 'out_file', batch_fit, 'roi_file')
+            # Create output node
+            save_params = pipeline.create_node(
+                SaveParamsAsNIfTI(), name="save_params",
+                requirements=[noddi_req, matlab2015_req],
+                memory=4000)
+            save_params.inputs.output_prefix = 'params'
+            pipeline.connect(batch_fit, 'out_file', save_params,
+                             'params_file')
+            pipeline.connect(create_roi, 'out_file', save_params, 'roi_file')
+            pipeline.connect(unzip_mask, 'out_file', save_params,
+                             'brain_mask_file')
+            # Connect inputs
+            pipeline.connect_input('bias_correct', unzip_bias_correct,
+                                   'in_file')
+            pipeline.connect_input(mask_name, unzip_mask, 'in_file')
+            pipeline.connect_input('grad_dirs', batch_fit, 'bvecs_file')
+            pipeline.connect_input('bvalues', batch_fit, 'bvals_file')
+            # Connect outputs
+            pipeline.connect_output('ficvf', save_params, 'ficvf')
+            pipeline.connect_output('odi', save_params, 'odi')
+            pipeline.connect_output('fiso', save_params, 'fiso')
+            pipeline.connect_output('fibredirs_xvec', save_params,
+                                    'fibredirs_xvec')
+            pipeline.connect_output('fibredirs_yvec', save_params,
+                                    'fibredirs_yvec')
+            pipeline.connect_output('fibredirs_zvec', save_params,
+                                    'fibredirs_zvec')
+            pipeline.connect_output('fmin', save_params, 'fmin')
+            pipeline.connect_output('kappa', save_params, 'kappa')
+            pipeline.connect_output('error_code', save_params,
+                                    'error_code')
         # Check inputs/outputs are connected
         return pipeline
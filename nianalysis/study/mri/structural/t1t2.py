@@ -4,6 +4,7 @@ from nianalysis.file_format import (
 from arcana.dataset import DatasetSpec
 from arcana.study.multi import (
     MultiStudy, SubStudySpec, MultiStudyMetaClass)
+from nianalysis.node import PipelineMixin
 from ..coregistered import CoregisteredStudy, CoregisteredToMatrixStudy
 from .t1 import T1Study
 from .t2 import T2Study
@@ -11,7 +12,7 @@ from nianalysis.requirement import fsl5_req
 from nianalysis.citation import fsl_cite
 
 
-class T1T2Study(MultiStudy, metaclass=MultiStudyMetaClass):
+class T1T2Study(PipelineMixin, MultiStudy, metaclass=MultiStudyMetaClass):
     """
     T1 and T2 weighted MR dataset, with the T2-weighted coregistered to the T1.
     """
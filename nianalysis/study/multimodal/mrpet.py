@@ -9,6 +9,7 @@ from nianalysis.interfaces.custom.motion_correction import (
 from nianalysis.citation import fsl_cite
 from arcana.study.multi import (
     MultiStudy, SubStudySpec, MultiStudyMetaClass)
+from nianalysis.node import PipelineMixin
 from nianalysis.study.mri.epi import EPIStudy
 from nianalysis.study.mri.structural.t1 import T1Study
 from nianalysis.study.mri.structural.t2 import T2Study
@@ -26,11 +27,13 @@ from arcana.parameter import ParameterSpec, SwitchSpec
 import os
 from nianalysis.interfaces.converters import Nii2Dicom
 from arcana.interfaces.utils import CopyToDir, ListDir, dicom_fname_sort_key
-from nipype.interfaces.fsl.preprocess import FLIRT
+from nianalysis.interfaces.fsl import FLIRT
+from nianalysis.cache import set_registration_cache
+from nianalysis.utils import set_node_threads
 import nipype.interfaces.fsl as fsl
 from nipype.interfaces.fsl.utils import ImageMaths
 from nianalysis.interfaces.ants import AntsRegSyn
-from nipype.interfaces.ants.resampling import ApplyTransforms
+from nianalysis.interfaces.custom.image import ApplyTransformChain
 
 
 logger = logging.getLogger('Arcana')
@@ -51,7 +54,8 @@ template_path = os.path.abspath(
                  'nianalysis', 'nianalysis', 'templates'))
 
 
-class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
+class MotionDetectionMixin(PipelineMixin, MultiStudy,
+                           metaclass=MultiStudyMetaClass):
 
     add_sub_study_specs = [
         SubStudySpec('pet_mc', PETStudy, {
@@ -401,7 +405,9 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
 
         list_niftis = pipeline.create_node(ListDir(), name='list_niftis')
         reorient_niftis = pipeline.create_node(
-            ReorientUmap(), name='reorient_niftis', requirements=[mrtrix3_req])
+            ReorientUmap(), name='reorient_niftis')
+        set_node_threads(reorient_niftis, self.runner.num_processes,
+                         self.runner)
 
         nii2dicom = pipeline.create_map_node(
             Nii2Dicom(), name='nii2dicom',
@@ -565,6 +571,7 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
         if StructAlignment:
             struct_reg = pipeline.create_node(
                 FLIRT(), requirements=[fsl509_req], name='ref2structural_reg')
+            set_registration_cache(struct_reg)
             pipeline.connect_input('ref_brain', struct_reg, 'reference')
             pipeline.connect_input('struct2align', struct_reg, 'in_file')
             struct_reg.inputs.dof = 6
@@ -663,9 +670,11 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                                      'in_file')
                 reg_tmean2MNI = pipeline.create_node(
                     AntsRegSyn(num_dimensions=3, transformation='s',
-                               out_prefix='reg2MNI', num_threads=4),
+                               out_prefix='reg2MNI'),
                     name='reg2MNI', wall_time=25,
                     requirements=[ants2_req])
+                set_node_threads(reg_tmean2MNI, 4, self.runner)
+                set_registration_cache(reg_tmean2MNI)
                 reg_tmean2MNI.inputs.ref_file = self.parameter(
                     'PET_template_MNI')
                 if dynamic:
@@ -678,18 +687,44 @@ class MotionDetectionMixin(MultiStudy, metaclass=MultiStudyMetaClass):
                                      'in1')
                     pipeline.connect(reg_tmean2MNI, 'regmat', merge_trans,
                                      'in2')
-                    apply_trans = pipeline.create_node(
-                        ApplyTransforms(), name='apply_trans', wall_time=7,
-                        memory=24000, requirements=[ants2_req])
-                    apply_trans.inputs.reference_image = self.parameter(
+                    # Each of the original frames is motion corrected,
+                    # cropped and normalised to MNI space in a single
+                    # resampling (instead of resampling the motion-corrected
+                    # frames again)
+                    frame_mats = pipeline.create_map_node(
+                        Merge(2), name='frame_matrices', iterfield=['in1'],
+                        wall_time=1)
+                    pipeline.connect(pet_mc, 'transformation_mat',
+                                     frame_mats, 'in1')
+                    pipeline.connect(cropping, 'crop_mat', frame_mats, 'in2')
+                    frame_refs = pipeline.create_node(
+                        Merge(2), name='frame_references', wall_time=1)
+                    pipeline.connect(merge_mc, 'merged_file', frame_refs,
+                                     'in1')
+                    pipeline.connect(cropping, 'pet_cropped', frame_refs,
+                                     'in2')
+                    apply_trans = pipeline.create_map_node(
+                        ApplyTransformChain(), name='apply_trans',
+                        iterfield=['in_file', 'flirt_matrices'], wall_time=7,
+                        requirements=[ants2_req])
+                    apply_trans.inputs.reference = self.parameter(
                         'PET_template_MNI')
                     apply_trans.inputs.interpolation = 'Linear'
-                    apply_trans.inputs.input_image_type = 3
-                    pipeline.connect(cropping, 'pet_cropped', apply_trans,
-                                     'input_image')
+                    pipeline.connect(check_pet, 'pet_images', apply_trans,
+                                     'in_file')
+                    pipeline.connect(frame_mats, 'out', apply_trans,
+                                     'flirt_matrices')
+                    pipeline.connect(frame_refs, 'out', apply_trans,
+                                     'flirt_references')
                     pipeline.connect(merge_trans, 'out', apply_trans,
                                      'transforms')
-                    pipeline.connect(apply_trans, 'output_image',
+                    merge_mni = pipeline.create_node(
+                        fsl.Merge(), name='merge_pet_mni',
+                        requirements=[fsl509_req])
+                    merge_mni.inputs.dimension = 't'
+                    pipeline.connect(apply_trans, 'out_file', merge_mni,
+                                     'in_files')
+                    pipeline.connect(merge_mni, 'merged_file',
                                      merge_outputs, 'in2')
                 else:
                     pipeline.connect(cropping, 'pet_cropped', reg_tmean2MNI,
@@ -1,9 +1,12 @@
 from arcana.study.base import Study, StudyMetaClass
+from nianalysis.node import PipelineMixin
 from arcana.dataset import DatasetSpec, FieldSpec
 from nianalysis.file_format import (nifti_gz_format, text_format,
                                     text_matrix_format, directory_format)
 from nianalysis.interfaces.sklearn import FastICA
 from nianalysis.interfaces.ants import AntsRegSyn
+from nianalysis.cache import set_registration_cache, set_list_mode_cache
+from nianalysis.utils import set_node_threads
 import os
 from nianalysis.requirement import fsl509_req, mrtrix3_req
 from nianalysis.interfaces.custom.pet import PreparePetDir
@@ -16,7 +19,7 @@ template_path = os.path.abspath(
                  'arcana', 'reference_data'))
 
 
-class PETStudy(Study, metaclass=StudyMetaClass):
+class PETStudy(PipelineMixin, Study, metaclass=StudyMetaClass):
 
     add_parameter_specs = [ParameterSpec('ica_n_components', 2),
                         ParameterSpec('ica_type', 'spatial'),
@@ -104,8 +107,9 @@ class PETStudy(Study, metaclass=StudyMetaClass):
 
         reg = pipeline.create_node(AntsRegSyn(out_prefix='vol2template'),
                                    name='ANTs')
+        set_registration_cache(reg)
         reg.inputs.num_dimensions = self.parameter('norm_dim')
-        reg.inputs.num_threads = self.runner.num_processes
+        set_node_threads(reg, self.runner.num_processes, self.runner)
         reg.inputs.transformation = self.parameter('norm_transformation')
         reg.inputs.ref_file = self.parameter('norm_template')
         pipeline.connect_input('pet_image', reg, 'input_file')
@@ -151,6 +155,7 @@ class PETStudy(Study, metaclass=StudyMetaClass):
             citations=[],
             **kwargs)
         time_info = pipeline.create_node(PetTimeInfo(), name='PET_time_info')
+        set_list_mode_cache(time_info)
         pipeline.connect_input('pet_data_dir', time_info, 'pet_data_dir')
         pipeline.connect_output('pet_end_time', time_info, 'pet_end_time')
         pipeline.connect_output('pet_start_time', time_info, 'pet_start_time')
@@ -1,7 +1,19 @@
 import os.path
+import numpy as np
+import nibabel as nib
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import Opener
 from arcana.exception import ArcanaError
 
 
+# Default maximum size (in bytes) of the slabs returned by iter_slabs
+DEFAULT_SLAB_SIZE = 64 * 1024 ** 2
+
+# Environment variables used to set the number of threads of OpenMP (FSL,
+# AFNI) and ITK (ANTs) based tools
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+
+
 def nth(i):
     "Returns 1st, 2nd, 3rd, 4th, etc for a given number"
     if i == 1:
@@ -64,3 +76,130 @@ def get_atlas_path(name, dataset='brain', resolution='1mm'):
         raise ArcanaError("Unrecognised atlas name '{}'"
                               .format(name))
     return os.path.abspath(path)
+
+
+def set_node_threads(node, nthreads, runner=None):
+    """
+    Sets the number of threads a node is allocated and passes it on to the
+    tool it runs. The allocation is used by the MultiProc runner when
+    scheduling nodes (so concurrent multi-threaded nodes don't oversubscribe
+    the machine) and for the number of tasks requested from SLURM
+
+    Parameters
+    ----------
+    node : arcana.node.Node
+        The node to set the number of threads of
+    nthreads : int
+        The number of threads the node can make use of
+    runner : arcana.runner.BaseRunner | None
+        The runner the node will be run by. If it runs a fixed number of
+        processes the number of threads is capped at that number
+
+    Returns
+    -------
+    nthreads : int
+        The number of threads allocated to the node
+    """
+    max_threads = getattr(runner, 'num_processes', None)
+    if max_threads:
+        nthreads = min(nthreads, max_threads)
+    nthreads = max(int(nthreads), 1)
+    node.nthreads = nthreads
+    # Also sets the 'num_threads' input of the interface if present
+    node.n_procs = nthreads
+    inputs = node.inputs
+    if hasattr(inputs, 'nthreads'):  # MRtrix (and NODDI) interfaces
+        inputs.nthreads = nthreads
+    if hasattr(inputs, 'environ'):
+        environ = dict(inputs.environ)
+        environ.update((v, str(nthreads)) for v in THREAD_ENV_VARS)
+        inputs.environ = environ
+    return nthreads
+
+
+def load_image_data(path, dtype=None):
+    """
+    Loads an image and its data array without upcasting it (unlike
+    get_data()/get_fdata() calls followed by np.array copies). Uncompressed
+    images are memory-mapped (copy-on-write so in-place operations don't
+    modify the file) so only the parts of the array that are accessed are
+    read into memory.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    dtype : np.dtype | None
+        The data type to cast the array to. If None the stored data type is
+        kept (unless the image has scaling factors, in which case they are
+        applied)
+
+    Returns
+    -------
+    image : nibabel.SpatialImage
+        The loaded image (for its header and affine)
+    data : np.ndarray
+        The (possibly memory-mapped) data array
+    """
+    image = nib.load(path, mmap='c')
+    data = np.asanyarray(image.dataobj)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return image, data
+
+
+def iter_slabs(image, max_size=DEFAULT_SLAB_SIZE, dtype=None):
+    """
+    Iterates over an image in slabs along its last axis (i.e. in volumes for
+    4D images and slices for 3D) so that voxel-wise operations only need to
+    hold one slab in memory at a time. Gzipped images are decompressed as a
+    single stream instead of being re-read from the start for each slab.
+
+    Parameters
+    ----------
+    image : str | nibabel.SpatialImage
+        The image (or path to the image) to iterate over
+    max_size : int
+        The maximum size of each slab in bytes (at least a single slice
+        along the last axis is always returned)
+    dtype : np.dtype | None
+        The data type to cast the slabs to. If None the stored data type is
+        kept (unless the image has scaling factors)
+
+    Yields
+    ------
+    slc : slice
+        The slice along the last axis the slab corresponds to
+    slab : np.ndarray
+        The data of the slab
+    """
+    if not isinstance(image, nib.spatialimages.SpatialImage):
+        image = nib.load(image)
+    shape = image.shape
+    dataobj = image.dataobj
+    raw_dtype = image.get_data_dtype()
+    slice_bytes = int(np.prod(shape[:-1])) * raw_dtype.itemsize
+    step = max(int(max_size // max(slice_bytes, 1)), 1)
+    starts = range(0, shape[-1], step)
+    if (isinstance(dataobj, ArrayProxy) and
+            getattr(dataobj, 'order', 'F') == 'F'):
+        slope, inter = float(dataobj.slope), float(dataobj.inter)
+        with Opener(dataobj.file_like, 'rb') as f:
+            f.seek(dataobj.offset)
+            for start in starts:
+                stop = min(start + step, shape[-1])
+                buff = f.read(slice_bytes * (stop - start))
+                slab = np.ndarray(shape[:-1] + (stop - start,),
+                                  dtype=raw_dtype, buffer=buff, order='F')
+                if slope != 1.0 or inter != 0.0:
+                    slab = slab * slope + inter
+                if dtype is not None:
+                    slab = slab.astype(dtype, copy=False)
+                yield slice(start, stop), slab
+    else:
+        for start in starts:
+            stop = min(start + step, shape[-1])
+            slab = np.asanyarray(dataobj[..., start:stop])
+            if dtype is not None:
+                slab = slab.astype(dtype, copy=False)
+            yield slice(start, stop), slab
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the batch conversion of all the DICOM series in a session
+directory, reporting the time taken to convert each series and the total
+conversion time for a sequential and a concurrent run
+"""
+import os.path
+import shutil
+import tempfile
+import time
+import argparse
+from nianalysis.interfaces.converters import BatchDicomConversion
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('session_dir',
+                    help="Directory containing one sub-directory per series")
+parser.add_argument('--converter', default='dcm2niix',
+                    choices=('dcm2niix', 'mrconvert'))
+parser.add_argument('--num_workers', type=int, default=4,
+                    help="Number of workers used in the concurrent run")
+args = parser.parse_args()
+
+series_dirs = sorted(
+    os.path.join(args.session_dir, d) for d in os.listdir(args.session_dir)
+    if (not d.startswith('.') and
+        os.path.isdir(os.path.join(args.session_dir, d))))
+
+totals = {}
+for num_workers in (1, args.num_workers):
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        start = time.time()
+        result = BatchDicomConversion(
+            series_dirs=series_dirs, converter=args.converter,
+            num_workers=num_workers).run()
+        totals[num_workers] = time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+    print("\n{} worker(s):".format(num_workers))
+    for name, duration in sorted(result.outputs.conversion_times.items()):
+        print("    {:<40} {:8.2f}s".format(name, duration))
+    print("    {:<40} {:8.2f}s".format('total', totals[num_workers]))
+
+print("\nSpeed-up with {} workers over sequential conversion: {:.2f}x".format(
+    args.num_workers, totals[1] / totals[args.num_workers]))
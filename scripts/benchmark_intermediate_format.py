@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Compares the end-to-end structural preprocessing time (reorientation, brain
+extraction and segmentation) when intermediate images are stored as zipped
+NIfTI against storing them in an uncompressed format (see the
+'intermediate_format' switch of MRIStudy)
+"""
+import os.path
+import shutil
+import time
+import argparse
+from nianalysis.study.mri.structural.t1 import T1Study
+from nianalysis.file_format import dicom_format
+from arcana.repository.local import LocalRepository
+from arcana.runner.linear import LinearRunner
+from arcana.dataset.match import DatasetMatch
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('repository', help="Path to a local repository")
+parser.add_argument('work_dir', help="Working directory")
+parser.add_argument('--primary', default='t1',
+                    help="Name of the T1-weighted DICOM scan to match")
+parser.add_argument('--formats', nargs='+',
+                    default=['nifti_gz', 'nifti', 'mrtrix'],
+                    help="The intermediate formats to compare")
+parser.add_argument('--subject', nargs='+', default=None)
+parser.add_argument('--session', nargs='+', default=None)
+args = parser.parse_args()
+
+times = {}
+for fmt in args.formats:
+    study_name = 'benchmark_{}'.format(fmt)
+    work_dir = os.path.join(args.work_dir, study_name)
+    study = T1Study(
+        name=study_name,
+        repository=LocalRepository(args.repository),
+        runner=LinearRunner(work_dir=work_dir),
+        inputs=[DatasetMatch('primary', dicom_format, args.primary)],
+        subject_ids=args.subject, visit_ids=args.session,
+        switches={'intermediate_format': fmt, 'bet_method': 'fsl_bet'})
+    start = time.time()
+    study.data('wm_seg')
+    times[fmt] = time.time() - start
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print("{:<10} {:8.1f}s".format(fmt, times[fmt]))
+
+if 'nifti_gz' in times:
+    for fmt, duration in times.items():
+        if fmt != 'nifti_gz':
+            print("Speed-up of '{}' over 'nifti_gz': {:.2f}x".format(
+                fmt, times['nifti_gz'] / duration))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Compares the 'fast' optiBET mode (registration of downsampled images with a
+reduced iteration schedule followed by mask refinement) against the 'full'
+mode on synthetic head phantoms, reporting the Dice overlap of the brain
+masks produced by the two modes and the ratio of their wall times.
+
+Requires ANTs (with ANTSPATH set).
+"""
+import os
+import os.path
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import nibabel as nib
+from nipype.interfaces.ants.resampling import ApplyTransforms
+from nianalysis.interfaces.ants import AntsRegSyn
+from nianalysis.interfaces.custom.image import downsample, refine_mask
+from nianalysis.study.mri.base import atlas_path
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_phantoms', type=int, default=3,
+                    help="Number of synthetic phantoms to generate")
+parser.add_argument('--resolution', type=float, default=3.0,
+                    help="Resolution used in the fast mode (mm)")
+parser.add_argument('--num_threads', type=int, default=4)
+parser.add_argument('--work_dir', default=None,
+                    help="Working directory (temporary if not provided)")
+args = parser.parse_args()
+
+template = os.path.join(atlas_path, 'MNI152_T1_2mm.nii.gz')
+template_mask = os.path.join(atlas_path, 'MNI152_T1_2mm_brain_mask.nii.gz')
+
+
+def head_phantom(path, seed, shape=(176, 216, 176)):
+    """
+    Generates a 1 mm head phantom made up of ellipsoidal shells of scalp,
+    skull, CSF and brain (with a darker grey-matter rim) that is randomly
+    scaled, rotated and shifted. Returns the true brain mask
+    """
+    rng = np.random.RandomState(seed)
+    radii = np.array([68., 84., 72.]) * rng.uniform(0.92, 1.08, 3)
+    angle = np.deg2rad(rng.uniform(-10, 10))
+    rot = np.array([[1, 0, 0],
+                    [0, np.cos(angle), -np.sin(angle)],
+                    [0, np.sin(angle), np.cos(angle)]])
+    centre = np.array(shape) / 2 + rng.uniform(-5, 5, 3)
+    coords = np.indices(shape).reshape(3, -1).T - centre
+    r = np.sqrt(((coords.dot(rot.T) / radii) ** 2).sum(axis=1))
+    r = r.reshape(shape)
+    data = np.zeros(shape, dtype=np.float32)
+    data[r < 1.0] = 80.   # scalp
+    data[r < 0.93] = 10.  # skull
+    data[r < 0.87] = 30.  # CSF
+    data[r < 0.84] = 70.  # grey matter
+    data[r < 0.75] = 100.  # white matter
+    data += rng.normal(0, 3, shape).astype(np.float32)
+    affine = np.eye(4)
+    affine[:3, 3] = -np.array(shape) / 2
+    nib.save(nib.Nifti1Image(data, affine), path)
+    return r < 0.84
+
+
+def register(moving, fixed, prefix, quick):
+    reg = AntsRegSyn(input_file=moving, ref_file=fixed, num_dimensions=3,
+                     transformation='s', out_prefix=prefix,
+                     num_threads=args.num_threads, quick=quick)
+    outputs = reg.run().outputs
+    apply_trans = ApplyTransforms(
+        input_image=template_mask, reference_image=phantom,
+        transforms=[outputs.inv_warp, outputs.regmat],
+        invert_transform_flags=[False, True], input_image_type=3,
+        interpolation=('Linear' if quick else 'NearestNeighbor'),
+        num_threads=args.num_threads)
+    return apply_trans.run().outputs.output_image
+
+
+def dice(a, b):
+    return 2.0 * (a & b).sum() / (a.sum() + b.sum())
+
+
+work_dir = (args.work_dir if args.work_dir is not None
+            else tempfile.mkdtemp())
+orig_dir = os.getcwd()
+results = []
+for i in range(args.num_phantoms):
+    phantom_dir = os.path.join(work_dir, 'phantom{}'.format(i))
+    os.makedirs(phantom_dir)
+    os.chdir(phantom_dir)
+    phantom = os.path.join(phantom_dir, 'phantom.nii.gz')
+    true_mask = head_phantom(phantom, seed=i)
+    image = nib.load(phantom)
+    # Full mode
+    start = time.time()
+    full_mask = np.asanyarray(nib.load(
+        register(phantom, template, 'full', False)).dataobj) > 0
+    full_time = time.time() - start
+    # Fast mode
+    start = time.time()
+    nib.save(downsample(image, args.resolution), 'phantom_ds.nii.gz')
+    nib.save(downsample(nib.load(template), args.resolution),
+             'template_ds.nii.gz')
+    coarse = register('phantom_ds.nii.gz', 'template_ds.nii.gz', 'fast',
+                      True)
+    fast_mask = refine_mask(np.asanyarray(image.dataobj),
+                            np.asanyarray(nib.load(coarse).dataobj))
+    fast_time = time.time() - start
+    results.append((dice(full_mask, fast_mask), full_time / fast_time,
+                    dice(full_mask, true_mask), dice(fast_mask, true_mask)))
+    print("phantom {}: Dice(fast, full)={:.3f}, speed-up={:.2f}x "
+          "(full {:.1f}s, fast {:.1f}s), Dice vs truth: full={:.3f} "
+          "fast={:.3f}".format(i, results[-1][0], results[-1][1], full_time,
+                               fast_time, results[-1][2], results[-1][3]))
+os.chdir(orig_dir)
+if args.work_dir is None:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+results = np.array(results)
+print("Mean Dice(fast, full): {:.3f}".format(results[:, 0].mean()))
+print("Mean wall-time ratio (full / fast): {:.2f}x".format(
+    results[:, 1].mean()))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the native weighted-least-squares tensor fit on a synthetic
+phantom of randomly oriented tensors, reporting the agreement of the fitted
+tensors and FA/MD maps with the known values and the throughput (in voxels
+per second) for different numbers of threads. If MRtrix is installed the
+same phantom is also fitted with 'dwi2tensor' and 'tensor2metric' for
+comparison.
+"""
+import os
+import os.path
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess as sp
+import numpy as np
+import nibabel as nib
+from nianalysis.interfaces.custom.diffusion import (
+    fit_tensor_image, TENSOR_ELEMENTS)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--shape', type=int, nargs=3, default=(96, 96, 60),
+                    help="Dimensions of the phantom")
+parser.add_argument('--num_dirs', type=int, default=64,
+                    help="Number of gradient directions per shell")
+parser.add_argument('--bvalues', type=float, nargs='+',
+                    default=(1000.0, 2000.0), help="b-values of the shells")
+parser.add_argument('--snr', type=float, default=30.0,
+                    help="SNR of the b=0 signal (no noise if 0)")
+parser.add_argument('--threads', type=int, nargs='+', default=(1, 2, 4, 8))
+parser.add_argument('--max_memory', type=int, default=256,
+                    help="Memory cap of the fit (MB)")
+args = parser.parse_args()
+
+rng = np.random.RandomState(0)
+shape = tuple(args.shape)
+num_voxels = int(np.prod(shape))
+
+# Gradient scheme
+dirs = rng.randn(args.num_dirs, 3)
+dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+bvecs = np.vstack([np.zeros((6, 3))] + [dirs] * len(args.bvalues))
+bvals = np.concatenate([np.zeros(6)] + [np.full(args.num_dirs, b)
+                                        for b in args.bvalues])
+
+# Randomly oriented prolate tensors
+evals = np.column_stack([rng.uniform(1.2e-3, 2.0e-3, num_voxels),
+                         rng.uniform(0.2e-3, 0.6e-3, num_voxels),
+                         rng.uniform(0.2e-3, 0.6e-3, num_voxels)])
+rotations = np.linalg.qr(rng.randn(num_voxels, 3, 3))[0]
+tensors = np.einsum('vij,vj,vkj->vik', rotations, evals, rotations)
+dwi = np.empty(shape + (len(bvals),), dtype=np.float32)
+flat = dwi.reshape(-1, len(bvals))
+for start in range(0, num_voxels, 100000):
+    chunk = slice(start, start + 100000)
+    flat[chunk] = 1000.0 * np.exp(
+        -bvals * np.einsum('ni,vij,nj->vn', bvecs, tensors[chunk], bvecs))
+if args.snr:
+    sigma = 1000.0 / args.snr
+    dwi[:] = np.sqrt((dwi + rng.normal(0, sigma, dwi.shape)) ** 2 +
+                     rng.normal(0, sigma, dwi.shape) ** 2)
+mask = np.ones(shape, dtype=bool)
+
+sorted_evals = np.sort(evals, axis=1)[:, ::-1]
+true_md = sorted_evals.mean(axis=1)
+true_fa = (np.sqrt(1.5 * ((sorted_evals - true_md[:, None]) ** 2).sum(1)) /
+           np.sqrt((sorted_evals ** 2).sum(1)))
+true_tensors = np.stack([tensors[:, i, j] for i, j in TENSOR_ELEMENTS],
+                        axis=1)
+
+
+def report(name, fitted, fa, md, elapsed):
+    print("{}: {:.0f} voxels/s ({:.1f}s), tensor RMSE={:.2e}, "
+          "FA MAE={:.4f}, MD MAE={:.2e}".format(
+              name, num_voxels / elapsed, elapsed,
+              np.sqrt(((fitted.reshape(-1, 6) - true_tensors) ** 2).mean()),
+              np.abs(fa.ravel() - true_fa).mean(),
+              np.abs(md.ravel() - true_md).mean()))
+
+
+for nthreads in args.threads:
+    start = time.time()
+    fitted, (fa, md, _, _) = fit_tensor_image(
+        dwi, mask, bvecs, bvals, nthreads=nthreads,
+        max_memory=args.max_memory * 1024 ** 2)
+    report('native ({} threads)'.format(nthreads), fitted, fa, md,
+           time.time() - start)
+
+if shutil.which('dwi2tensor'):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dwi_path = os.path.join(tmp_dir, 'dwi.nii')
+        grad_path = os.path.join(tmp_dir, 'grad.b')
+        nib.save(nib.Nifti1Image(dwi, np.eye(4)), dwi_path)
+        np.savetxt(grad_path, np.column_stack([bvecs, bvals]))
+        start = time.time()
+        sp.check_call(['dwi2tensor', '-quiet', '-grad', grad_path, dwi_path,
+                       os.path.join(tmp_dir, 'dt.nii')])
+        sp.check_call(['tensor2metric', '-quiet', '-fa',
+                       os.path.join(tmp_dir, 'fa.nii'), '-adc',
+                       os.path.join(tmp_dir, 'adc.nii'),
+                       os.path.join(tmp_dir, 'dt.nii')])
+        elapsed = time.time() - start
+        report('dwi2tensor + tensor2metric',
+               np.asanyarray(nib.load(
+                   os.path.join(tmp_dir, 'dt.nii')).dataobj),
+               np.asanyarray(nib.load(
+                   os.path.join(tmp_dir, 'fa.nii')).dataobj),
+               np.asanyarray(nib.load(
+                   os.path.join(tmp_dir, 'adc.nii')).dataobj),
+               elapsed)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
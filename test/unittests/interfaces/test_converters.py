@@ -0,0 +1,171 @@
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nipype.interfaces.base import (
+    BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, Directory)
+from arcana.exception import ArcanaError
+from nianalysis.interfaces.converters import (
+    BatchDicomConversion, Dcm2niix, concatenate_echoes)
+
+
+class FakeConverterInputSpec(BaseInterfaceInputSpec):
+    input_dir = Directory(exists=True)
+    out_file = File()
+
+
+class FakeConverterOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class FakeConverter(BaseInterface):
+    "Stands in for a DICOM converter, listing the files of the series"
+
+    input_spec = FakeConverterInputSpec
+    output_spec = FakeConverterOutputSpec
+
+    def _run_interface(self, runtime):
+        with open(self.inputs.out_file, 'w') as f:
+            f.write('\n'.join(sorted(os.listdir(self.inputs.input_dir))))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self.inputs.out_file
+        return outputs
+
+
+class FakeBatchDicomConversion(BatchDicomConversion):
+
+    def _converter_interface(self, series_dir, out_dir, name):
+        return (FakeConverter(input_dir=series_dir,
+                              out_file=os.path.join(out_dir, name + '.txt')),
+                'out_file')
+
+
+class TestBatchDicomConversion(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.session_dir = os.path.join(self.tmp_dir, 'session')
+        self.work_dir = os.path.join(self.tmp_dir, 'work')
+        os.mkdir(self.work_dir)
+        self.series_dirs = []
+        for i, name in enumerate(('t1', 'dwi', 'fmri')):
+            series_dir = os.path.join(self.session_dir, name)
+            os.makedirs(series_dir)
+            for j in range(i + 1):
+                open(os.path.join(series_dir, '{}.dcm'.format(j)),
+                     'w').close()
+            self.series_dirs.append(series_dir)
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_batch_conversion(self):
+        for _ in range(2):
+            # The second run reuses the existing output directories
+            result = FakeBatchDicomConversion(
+                series_dirs=self.series_dirs, num_workers=2).run()
+        outputs = result.outputs
+        self.assertEqual([os.path.basename(f) for f in outputs.converted],
+                         ['t1.txt', 'dwi.txt', 'fmri.txt'])
+        self.assertEqual(sorted(outputs.conversion_map),
+                         ['dwi', 'fmri', 't1'])
+        self.assertEqual(sorted(outputs.conversion_times),
+                         ['dwi', 'fmri', 't1'])
+        for i, path in enumerate(outputs.converted):
+            with open(path) as f:
+                self.assertEqual(f.read().split(),
+                                 ['{}.dcm'.format(j) for j in range(i + 1)])
+
+    def test_duplicate_names(self):
+        other = os.path.join(self.tmp_dir, 'other', 't1')
+        os.makedirs(other)
+        with self.assertRaises(Exception):
+            FakeBatchDicomConversion(
+                series_dirs=self.series_dirs + [other]).run()
+
+
+class TestConcatenateEchoes(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.affine = np.diag([1.2, 0.8, 2.5, 1.0])
+        self.affine[:3, 3] = [-10.0, 5.0, 3.0]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _echo(self, name, data, dtype=None):
+        image = nib.Nifti1Image(data, self.affine)
+        if dtype is not None:
+            image.set_data_dtype(dtype)
+        path = os.path.join(self.tmp_dir, name)
+        nib.save(image, path)
+        return path
+
+    def test_native_dtype(self):
+        rng = np.random.RandomState(0)
+        echoes = [rng.randint(0, 4000, (6, 5, 4)).astype(np.int16)
+                  for _ in range(3)]
+        in_files = [self._echo('e{}.nii.gz'.format(i), e)
+                    for i, e in enumerate(echoes)]
+        out_file = concatenate_echoes(
+            in_files, os.path.join(self.tmp_dir, 'concat.nii.gz'))
+        concat = nib.load(out_file)
+        self.assertEqual(concat.get_data_dtype(), np.int16)
+        self.assertEqual(concat.shape, (6, 5, 4, 3))
+        self.assertTrue(np.allclose(concat.affine, self.affine))
+        self.assertTrue(np.array_equal(np.asanyarray(concat.dataobj),
+                                       np.stack(echoes, axis=-1)))
+
+    def test_differing_scaling(self):
+        # Echoes with different ranges are given different scale factors
+        # when saved as int16, so they are concatenated as float32
+        rng = np.random.RandomState(1)
+        echoes = [rng.rand(6, 5, 4) * s for s in (10.0, 1000.0)]
+        in_files = [self._echo('e{}.nii.gz'.format(i), e, np.int16)
+                    for i, e in enumerate(echoes)]
+        out_file = concatenate_echoes(
+            in_files, os.path.join(self.tmp_dir, 'concat.nii.gz'))
+        concat = nib.load(out_file)
+        self.assertEqual(concat.get_data_dtype(), np.float32)
+        expected = np.stack([nib.load(f).get_fdata() for f in in_files],
+                            axis=-1)
+        self.assertTrue(np.allclose(concat.get_fdata(), expected, rtol=1e-6))
+
+    def test_differing_shapes(self):
+        in_files = [self._echo('e0.nii.gz', np.zeros((6, 5, 4))),
+                    self._echo('e1.nii.gz', np.zeros((6, 5, 3)))]
+        with self.assertRaises(ArcanaError):
+            concatenate_echoes(
+                in_files, os.path.join(self.tmp_dir, 'concat.nii.gz'))
+
+
+class TestOrderEchoes(TestCase):
+
+    products = ['/out/series_e2.nii.gz', '/out/series_e10.nii.gz',
+                '/out/series_e1.nii.gz']
+
+    def test_ascending(self):
+        self.assertEqual(
+            Dcm2niix()._order_echoes(self.products),
+            ['/out/series_e1.nii.gz', '/out/series_e2.nii.gz',
+             '/out/series_e10.nii.gz'])
+
+    def test_echo_order(self):
+        self.assertEqual(
+            Dcm2niix(echo_order=[10, 1, 2])._order_echoes(self.products),
+            ['/out/series_e10.nii.gz', '/out/series_e1.nii.gz',
+             '/out/series_e2.nii.gz'])
+
+    def test_missing_echo(self):
+        with self.assertRaises(ArcanaError):
+            Dcm2niix(echo_order=[1, 3])._order_echoes(self.products)
@@ -0,0 +1,70 @@
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+from pydicom.dataset import Dataset
+from nianalysis.interfaces.custom.dicom import (
+    total_readout_time, probe_interfile_header, list_mode_time_info)
+
+
+class TestTotalReadoutTime(TestCase):
+
+    def test_readout_time(self):
+        dcm = Dataset()
+        dcm.Rows = 100
+        dcm.Columns = 128
+        dcm.InPlanePhaseEncodingDirection = 'COL'
+        self.assertIsNone(total_readout_time(dcm))
+        # Bandwidth per pixel in the phase encoding direction (Siemens)
+        dcm.add_new(0x00191028, 'FD', 20.0)
+        self.assertAlmostEqual(total_readout_time(dcm),
+                               99 / (20.0 * 100))
+        dcm.InPlanePhaseEncodingDirection = 'ROW'
+        self.assertAlmostEqual(total_readout_time(dcm),
+                               127 / (20.0 * 128))
+
+
+# Interfile header in which the image duration is given twice, the last of
+# which is the one that applies
+INTERFILE_HEADER = b"""!INTERFILE:=
+%image duration (sec):=10
+!image duration (sec):=3600
+"""
+
+
+class TestListModeTimeInfo(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pet_dir = os.path.join(self.tmp_dir, 'pet')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.mkdir(self.pet_dir)
+        self.list_mode = os.path.join(self.pet_dir, 'listmode.bf')
+        self.header = os.path.join(self.pet_dir, 'listmode.dcm')
+        with open(self.list_mode, 'wb') as f:
+            f.write(b'\0' * 1024)
+        with open(self.header, 'wb') as f:
+            f.write(INTERFILE_HEADER)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_probe(self):
+        self.assertEqual(probe_interfile_header(self.header),
+                         {'image duration': '3600'})
+
+    def test_cache(self):
+        info = list_mode_time_info(self.pet_dir, cache_dir=self.cache_dir)
+        self.assertEqual(info, [(self.list_mode, 1024, None, 3600)])
+        # The cached result is returned while the list-mode file is
+        # unchanged, so the header is not read again
+        os.remove(self.header)
+        self.assertEqual(
+            list_mode_time_info(self.pet_dir, cache_dir=self.cache_dir),
+            info)
+        mtime = os.stat(self.list_mode).st_mtime + 10
+        os.utime(self.list_mode, (mtime, mtime))
+        self.assertEqual(
+            list_mode_time_info(self.pet_dir, cache_dir=self.cache_dir),
+            [(self.list_mode, 1024, None, None)])
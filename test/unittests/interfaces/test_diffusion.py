@@ -0,0 +1,317 @@
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nianalysis.interfaces.custom.diffusion import (
+    fit_tensor_image, load_fsl_gradients, TENSOR_ELEMENTS, fit_noddi_image,
+    noddi_atoms, kappa_to_odi, extract_b0, prepare_tbss_fa, ResponseSum,
+    se_epi_pair, dwi_qc_summary)
+
+
+def gradient_scheme(num_dirs=30, bvalues=(1000.0, 2500.0), num_b0=4,
+                    seed=0):
+    "Random gradient directions on each of the given shells"
+    rng = np.random.RandomState(seed)
+    dirs = rng.randn(num_dirs, 3)
+    dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+    bvecs = np.vstack([np.zeros((num_b0, 3))] + [dirs] * len(bvalues))
+    bvals = np.concatenate([np.zeros(num_b0)] +
+                           [np.full(num_dirs, b) for b in bvalues])
+    return bvecs, bvals
+
+
+def tensor_phantom(shape, seed=0):
+    "Tensors with random orientations and prolate eigenvalues"
+    rng = np.random.RandomState(seed)
+    num_voxels = int(np.prod(shape))
+    evals = np.column_stack([rng.uniform(1.2e-3, 2.0e-3, num_voxels),
+                             rng.uniform(0.2e-3, 0.6e-3, num_voxels),
+                             rng.uniform(0.2e-3, 0.6e-3, num_voxels)])
+    rotations = np.linalg.qr(rng.randn(num_voxels, 3, 3))[0]
+    tensors = np.einsum('vij,vj,vkj->vik', rotations, evals, rotations)
+    return tensors, evals
+
+
+class TestTensorFit(TestCase):
+
+    def test_known_tensors(self):
+        shape = (8, 9, 10)
+        bvecs, bvals = gradient_scheme()
+        tensors, evals = tensor_phantom(shape)
+        signal = 1000.0 * np.exp(
+            -bvals * np.einsum('ni,vij,nj->vn', bvecs, tensors, bvecs))
+        dwi = signal.reshape(shape + (len(bvals),)).astype(np.float32)
+        mask = np.ones(shape, dtype=bool)
+        mask[:2] = False
+        # Small memory cap and several threads so multiple slabs are used
+        fitted, (fa, md, ad, rd) = fit_tensor_image(
+            dwi, mask, bvecs, bvals, nthreads=3, max_memory=2 ** 16)
+        inside = mask.ravel()
+        expected = np.stack([tensors[:, i, j] for i, j in TENSOR_ELEMENTS],
+                            axis=1)
+        self.assertTrue(np.allclose(fitted.reshape(-1, 6)[inside],
+                                    expected[inside], atol=1e-7))
+        evals = np.sort(evals, axis=1)[:, ::-1]
+        mean = evals.mean(axis=1)
+        expected_fa = (np.sqrt(1.5 * ((evals - mean[:, None]) ** 2).sum(1)) /
+                       np.sqrt((evals ** 2).sum(1)))
+        self.assertTrue(np.allclose(fa.ravel()[inside], expected_fa[inside],
+                                    atol=1e-5))
+        self.assertTrue(np.allclose(md.ravel()[inside], mean[inside],
+                                    atol=1e-8))
+        self.assertTrue(np.allclose(ad.ravel()[inside], evals[inside, 0],
+                                    atol=1e-8))
+        self.assertTrue(np.allclose(rd.ravel()[inside],
+                                    evals[inside, 1:].mean(axis=1),
+                                    atol=1e-8))
+        self.assertFalse(fa[:2].any())
+
+    def test_gradient_orientation(self):
+        # FSL bvecs are defined relative to the voxel axes of the image as if
+        # it were stored in radiological order, so they should map onto the
+        # same world directions whichever order the image is stored in
+        bvecs, bvals = gradient_scheme(num_dirs=5, bvalues=(1000.0,))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            bvecs_file = os.path.join(tmp_dir, 'bvecs')
+            bvals_file = os.path.join(tmp_dir, 'bvals')
+            np.savetxt(bvecs_file, bvecs.T)
+            np.savetxt(bvals_file, bvals[None, :])
+            for affine in (np.diag([-2.0, 2.0, 2.0, 1.0]),
+                           np.diag([2.0, 2.0, 2.0, 1.0])):
+                loaded, loaded_bvals = load_fsl_gradients(
+                    bvecs_file, bvals_file, affine=affine)
+                self.assertTrue(np.allclose(loaded,
+                                            bvecs * (-1.0, 1.0, 1.0)))
+                self.assertTrue(np.allclose(loaded_bvals, bvals))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class TestNODDIFit(TestCase):
+
+    def test_known_parameters(self):
+        shape = (4, 4, 3)
+        num_voxels = int(np.prod(shape))
+        bvecs, bvals = gradient_scheme(num_dirs=45)
+        rng = np.random.RandomState(1)
+        # Parameters between those sampled by the dictionary
+        icvf = rng.uniform(0.2, 0.8, num_voxels)
+        odi = rng.uniform(0.05, 0.6, num_voxels)
+        fiso = rng.uniform(0.0, 0.4, num_voxels)
+        dirs = rng.randn(num_voxels, 3)
+        dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+        signal = np.empty((num_voxels, len(bvals)))
+        for v in range(num_voxels):
+            cos_angles = np.abs(bvecs.dot(dirs[v]))
+            # Signals of a single-atom dictionary with the exact parameters
+            atoms = np.array([
+                noddi_atoms([b], [c], [odi[v]], [icvf[v]])[0, 0]
+                for b, c in zip(bvals, cos_angles)])
+            signal[v] = 1000.0 * ((1 - fiso[v]) * atoms[:, 0] +
+                                  fiso[v] * atoms[:, 1])
+        dwi = signal.reshape(shape + (len(bvals),))
+        mask = np.ones(shape, dtype=bool)
+        mask[0, 0] = False
+        inside = mask.ravel()
+        maps = fit_noddi_image(dwi, mask, bvecs, bvals, nthreads=2,
+                               max_memory=2 ** 14)
+        self.assertTrue(np.allclose(maps['ficvf'].ravel()[inside],
+                                    icvf[inside], atol=0.02))
+        self.assertTrue(np.allclose(maps['odi'].ravel()[inside],
+                                    odi[inside], atol=0.03))
+        self.assertTrue(np.allclose(maps['fiso'].ravel()[inside],
+                                    fiso[inside], atol=0.05))
+        self.assertTrue(np.allclose(
+            kappa_to_odi(maps['kappa'].ravel()[inside]), odi[inside],
+            atol=0.03))
+        alignment = np.abs((maps['fibredirs'].reshape(-1, 3) *
+                            dirs).sum(axis=1))
+        self.assertTrue(np.all(alignment[inside] > np.cos(np.radians(1))))
+        self.assertFalse(maps['error_code'].any())
+        self.assertFalse(maps['ficvf'][0, 0].any())
+
+
+class TestExtractB0(TestCase):
+
+    def test_extract(self):
+        bvals = np.array([0.0, 1000.0, 5.0, 1000.0, 50.0, 0.0])
+        data = np.random.RandomState(0).rand(4, 5, 6, len(bvals))
+        data = data.astype(np.float32)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'dwi.nii')
+            nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+            image = nib.load(path)
+            self.assertTrue(np.allclose(
+                extract_b0(image, bvals),
+                data[..., [0, 2, 5]].mean(axis=3)))
+            self.assertTrue(np.allclose(
+                extract_b0(image, bvals, threshold=50.0),
+                data[..., [0, 2, 4, 5]].mean(axis=3)))
+            self.assertTrue(np.array_equal(
+                extract_b0(image, bvals - 1.0, operation='first'),
+                data[..., 0]))
+            # First volume only counts as a b0 with the larger threshold
+            bvals[0] = 20.0
+            self.assertTrue(np.array_equal(
+                extract_b0(image, bvals, operation='first'), data[..., 2]))
+            self.assertTrue(np.array_equal(
+                extract_b0(image, bvals, operation='first', threshold=50.0),
+                data[..., 0]))
+            self.assertRaises(Exception, extract_b0, image, bvals + 100.0)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class TestSEEPIPair(TestCase):
+
+    def test_pair(self):
+        bvals = np.array([1000.0, 0.0, 1000.0, 0.0])
+        rng = np.random.RandomState(0)
+        data = rng.rand(4, 5, 6, len(bvals)).astype(np.float32)
+        reverse = rng.rand(4, 5, 6, 2).astype(np.float32)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmp_dir, n + '.nii')
+                     for n in ('dwi', 'reverse', 'reverse3d', 'wrong')]
+            for path, array in zip(paths, (data, reverse, reverse[..., 0],
+                                           reverse[:3])):
+                nib.save(nib.Nifti1Image(array, np.eye(4)), path)
+            forward = nib.load(paths[0])
+            pair = se_epi_pair(forward, bvals, nib.load(paths[1]))
+            self.assertEqual(pair.shape, (4, 5, 6, 3))
+            self.assertTrue(np.array_equal(pair[..., 0], data[..., 1]))
+            self.assertTrue(np.array_equal(pair[..., 1:], reverse))
+            pair = se_epi_pair(forward, bvals, nib.load(paths[2]))
+            self.assertEqual(pair.shape, (4, 5, 6, 2))
+            self.assertTrue(np.array_equal(pair[..., 1], reverse[..., 0]))
+            self.assertRaises(Exception, se_epi_pair, forward, bvals,
+                              nib.load(paths[3]))
+            # Same shape but with the first axis flipped
+            flipped_affine = np.diag([-1.0, 1.0, 1.0, 1.0])
+            flipped_affine[0, 3] = 3.0
+            flipped = os.path.join(tmp_dir, 'flipped.nii')
+            nib.save(nib.Nifti1Image(reverse[::-1], flipped_affine), flipped)
+            self.assertRaises(Exception, se_epi_pair, forward, bvals,
+                              nib.load(flipped))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class TestPrepareTBSSFA(TestCase):
+
+    def test_prepare(self):
+        fa = np.zeros((12, 12, 12))
+        fa[2:10, 2:10, 2:10] = 0.5
+        fa[5, 5, 5] = 1.3
+        prepared, mask = prepare_tbss_fa(fa)
+        # Clamped to 1 and eroded by one voxel
+        self.assertEqual(prepared.max(), 1.0)
+        self.assertTrue(np.array_equal(prepared != 0,
+                                       np.pad(np.ones((6, 6, 6), bool), 3,
+                                              mode='constant')))
+        # Rim of two voxels around the brain is excluded from the mask
+        self.assertTrue(mask[3:9, 3:9, 3:9].all())
+        self.assertFalse(mask[1:3, 3:9, 3:9].any())
+        self.assertTrue(mask[0, 0, 0])
+        # End slices are zeroed even if they were within the brain
+        prepared, _ = prepare_tbss_fa(np.full((6, 6, 6), 0.5))
+        self.assertFalse(prepared[0].any() or prepared[:, -1].any())
+        self.assertTrue(prepared[1:-1, 1:-1, 1:-1].all())
+
+
+class TestResponseSum(TestCase):
+
+    def test_incremental(self):
+        rng = np.random.RandomState(0)
+        responses = [rng.normal(1000.0, 300.0, (3, 5)) for _ in range(25)]
+        full = ResponseSum()
+        for i, response in enumerate(responses):
+            full.add(str(i), response)
+        # Add the responses in a different order, saving and reloading the
+        # sum after each one
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'sum.json')
+            incremental = ResponseSum()
+            for i in reversed(range(len(responses))):
+                incremental.add(str(i), responses[i])
+                # Adding the same response twice should have no effect
+                self.assertFalse(incremental.add(str(i), responses[i]))
+                incremental.save(path)
+                incremental = ResponseSum.load(path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.assertEqual(incremental.count, len(responses))
+        self.assertTrue(np.array_equal(incremental.mean(), full.mean()))
+        self.assertTrue(np.allclose(full.mean(), np.mean(responses, axis=0)))
+
+    def test_drift(self):
+        state = ResponseSum()
+        state.add('a', np.ones((2, 3)))
+        self.assertEqual(state.drift(state.mean()), float('inf'))
+        state.reference = state.mean()
+        state.add('b', np.full((2, 3), 1.02))
+        self.assertAlmostEqual(state.drift(state.mean()), 0.01)
+        self.assertRaises(Exception, state.add, 'c', np.ones((3, 3)))
+
+
+class TestDWIQC(TestCase):
+
+    def test_summary(self):
+        rng = np.random.RandomState(0)
+        shape = (10, 10, 8)
+        bvals = np.concatenate([np.zeros(3), np.full(12, 1000.0)])
+        data = np.concatenate(
+            [rng.normal(1000.0, 10.0, shape + (3,)),
+             rng.normal(300.0, 10.0, shape + (12,))], axis=3)
+        # Signal dropout in a single slice of one volume
+        data[:, :, 3, 7] *= 0.3
+        data = data.astype(np.float32)
+        mask = np.zeros(shape, dtype=bool)
+        mask[1:-1, 1:-1, :] = True
+        fa = rng.uniform(0, 1, shape)
+        motion_par = np.zeros((len(bvals), 16))
+        motion_par[4, :3] = [3.0, 4.0, 0.0]
+        motion_par[9, 5] = np.radians(-2.0)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'dwi.nii')
+            nib.save(nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0])),
+                     path)
+            image = nib.load(path)
+            summary = dwi_qc_summary(image, bvals, mask, fa=fa,
+                                     motion_par=motion_par,
+                                     min_slice_voxels=50)
+            # Reading the series in slabs of two volumes should give the
+            # same statistics
+            slabbed = dwi_qc_summary(image, bvals, mask, fa=fa,
+                                     motion_par=motion_par,
+                                     min_slice_voxels=50,
+                                     max_size=data[..., :2].nbytes)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.assertEqual(set(summary), set(slabbed))
+        for key, value in summary.items():
+            self.assertAlmostEqual(value, slabbed[key], places=6)
+        self.assertEqual(summary['num_volumes'], 15)
+        self.assertEqual(summary['num_b0'], 3)
+        self.assertEqual(summary['mask_voxels'], mask.sum())
+        self.assertEqual(summary['mask_volume'], mask.sum() * 8.0)
+        b0s = data[mask][:, :3].astype(float)
+        self.assertAlmostEqual(summary['b0_mean'], b0s.mean(), places=3)
+        self.assertAlmostEqual(
+            summary['b0_snr'],
+            np.median(b0s.mean(axis=1) / b0s.std(axis=1, ddof=1)), places=3)
+        self.assertEqual(summary['outlier_slices'], 1)
+        self.assertEqual(summary['outlier_volumes'], 1)
+        self.assertAlmostEqual(summary['fa_mean'], fa[mask].mean())
+        self.assertAlmostEqual(summary['fa_median'], np.median(fa[mask]))
+        self.assertNotIn('md_mean', summary)
+        self.assertAlmostEqual(summary['max_translation'], 5.0)
+        self.assertAlmostEqual(summary['max_rotation'], 2.0)
+        self.assertRaises(Exception, dwi_qc_summary, image, bvals[:-1],
+                          mask)
@@ -0,0 +1,317 @@
+import os.path
+import shutil
+import tempfile
+import subprocess as sp
+from unittest import TestCase, skipUnless
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import (
+    map_coordinates, gaussian_filter, binary_erosion)
+from nianalysis.interfaces.custom.image import (
+    reorient_resample, resample_to_reference, header_transform_matrix,
+    flirt_world_matrix, crop_matrix, write_itk_affine, ApplyTransformChain)
+
+
+def oblique_image(shape=(24, 30, 20, 2), seed=0):
+    "Random image stored in P-S-L order with anisotropic voxels"
+    rng = np.random.RandomState(seed)
+    data = rng.rand(*shape).astype(np.float32)
+    affine = np.array([[0., 0., -1.2, 10.],
+                       [-2., 0., 0., 20.],
+                       [0., 1.5, 0., -5.],
+                       [0., 0., 0., 1.]])
+    return nib.Nifti1Image(data, affine)
+
+
+class TestReorientResample(TestCase):
+
+    def test_reorient(self):
+        image = oblique_image()
+        data = np.asanyarray(image.dataobj)
+        reoriented = reorient_resample(image)
+        self.assertEqual(nib.aff2axcodes(reoriented.affine), ('L', 'A', 'S'))
+        self.assertEqual(reoriented.shape, (20, 24, 30, 2))
+        # Every voxel should keep its value at the same world coordinates
+        new_data = np.asanyarray(reoriented.dataobj)
+        vox2vox = np.linalg.inv(image.affine).dot(reoriented.affine)
+        indices = np.indices(reoriented.shape[:3]).reshape(3, -1)
+        orig = np.round(vox2vox[:3, :3].dot(indices) +
+                        vox2vox[:3, 3:]).astype(int)
+        self.assertTrue(np.array_equal(
+            new_data[tuple(indices)], data[tuple(orig)]))
+
+    def test_resample(self):
+        image = oblique_image()
+        data = np.asanyarray(image.dataobj)
+        resampled = reorient_resample(image, resolution=[1.0, 1.0, 1.0],
+                                      order=1)
+        self.assertEqual(resampled.shape, (24, 48, 45, 2))
+        self.assertTrue(np.allclose(resampled.header.get_zooms()[:3],
+                                    (1.0, 1.0, 1.0)))
+        # Compare against interpolating the original image directly at the
+        # world coordinates of the (interior) resampled voxels
+        new_data = np.asanyarray(resampled.dataobj)
+        vox2vox = np.linalg.inv(image.affine).dot(resampled.affine)
+        indices = np.indices([n - 4 for n in resampled.shape[:3]])
+        indices = indices.reshape(3, -1) + 2
+        coords = vox2vox[:3, :3].dot(indices) + vox2vox[:3, 3:]
+        for vol in range(2):
+            expected = map_coordinates(data[..., vol], coords, order=1)
+            self.assertTrue(np.allclose(
+                new_data[tuple(indices) + (vol,)], expected, atol=1e-5))
+
+    @skipUnless(shutil.which('fslreorient2std') and shutil.which('mrresize'),
+                "FSL and MRtrix are required to compare against the "
+                "original chain")
+    def test_equivalent_to_fsl_mrtrix_chain(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            in_file = os.path.join(tmp_dir, 'in.nii.gz')
+            reoriented = os.path.join(tmp_dir, 'reoriented.nii.gz')
+            resampled = os.path.join(tmp_dir, 'resampled.nii.gz')
+            data = np.zeros((40, 48, 36), dtype=np.float32)
+            data[8:32, 10:38, 6:30] = 100.0  # smooth, block-like phantom
+            image = nib.Nifti1Image(gaussian_filter(data, 2),
+                                    oblique_image().affine)
+            nib.save(image, in_file)
+            sp.check_call(['fslreorient2std', in_file, reoriented])
+            sp.check_call(['mrresize', '-quiet', '-voxel', '1,1,1',
+                           reoriented, resampled])
+            chain = nib.load(resampled)
+            fused = reorient_resample(image, resolution=[1.0, 1.0, 1.0])
+            self.assertEqual(chain.shape, fused.shape)
+            self.assertTrue(np.allclose(chain.affine, fused.affine,
+                                        atol=1e-3))
+            diff = np.abs(np.asanyarray(chain.dataobj) -
+                          np.asanyarray(fused.dataobj))
+            self.assertLess(diff.mean(), 1.0)
+            self.assertLess(np.percentile(diff, 99), 5.0)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class TestQformTransform(TestCase):
+
+    def setUp(self):
+        self.image = oblique_image()
+        ref_affine = np.diag([-1.3, 1.3, 1.3, 1.0])
+        ref_affine[:3, 3] = (15.0, -14.0, -9.0)
+        self.reference = nib.Nifti1Image(
+            np.zeros((25, 26, 27), dtype=np.float32), ref_affine)
+
+    def test_resample(self):
+        resampled = resample_to_reference(self.image, self.reference)
+        self.assertEqual(resampled.shape, (25, 26, 27, 2))
+        data = np.asanyarray(self.image.dataobj)
+        vox2vox = np.linalg.inv(self.image.affine).dot(self.reference.affine)
+        indices = np.indices(self.reference.shape).reshape(3, -1)
+        coords = vox2vox[:3, :3].dot(indices) + vox2vox[:3, 3:]
+        for vol in range(2):
+            expected = map_coordinates(data[..., vol], coords, order=1,
+                                       mode='constant')
+            self.assertTrue(np.allclose(
+                resampled[..., vol].ravel(), expected, atol=1e-5))
+
+    def test_chunked(self):
+        # Slabs of two slices should give the same result as a single pass
+        for order in (1, 3):
+            chunked = resample_to_reference(
+                self.image, self.reference, order=order,
+                max_size=2 * 4 * 25 * 26)
+            whole = resample_to_reference(self.image, self.reference,
+                                          order=order, max_size=2 ** 30)
+            self.assertTrue(np.allclose(chunked, whole, atol=1e-5))
+
+    def test_matrix(self):
+        self.assertTrue(np.allclose(
+            header_transform_matrix(self.image, self.image), np.eye(4)))
+        # 2 mm image onto a 1 mm reference covering the same space, both
+        # stored in RAS (neurological) order, so FLIRT flips their x-axes.
+        # Image x = 18 - 2i mm and reference x = 19 - i mm for the same
+        # world coordinate 2i, so the matrix is a 1 mm shift along x
+        image = nib.Nifti1Image(np.zeros((10, 10, 10), dtype=np.int16),
+                                np.diag([2.0, 2.0, 2.0, 1.0]))
+        expected = np.eye(4)
+        expected[0, 3] = 1.0
+        ras_ref = nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.float32),
+                                  np.eye(4))
+        self.assertTrue(np.allclose(
+            header_transform_matrix(image, ras_ref), expected))
+        # The same reference grid stored in LAS (radiological) order isn't
+        # flipped by FLIRT, so its scaled mm coordinates and the matrix are
+        # unchanged
+        las_affine = np.diag([-1.0, 1.0, 1.0, 1.0])
+        las_affine[0, 3] = 19.0
+        las_ref = nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.float32),
+                                  las_affine)
+        self.assertTrue(np.allclose(
+            header_transform_matrix(image, las_ref), expected))
+
+    @skipUnless(shutil.which('flirt'),
+                "FSL is required to compare against 'flirt -usesqform'")
+    def test_matrix_equivalent_to_flirt(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            in_file = os.path.join(tmp_dir, 'in.nii.gz')
+            ref_file = os.path.join(tmp_dir, 'ref.nii.gz')
+            mat_file = os.path.join(tmp_dir, 'flirt.mat')
+            nib.save(self.image, in_file)
+            nib.save(self.reference, ref_file)
+            sp.check_call(['flirt', '-in', in_file, '-ref', ref_file,
+                           '-applyxfm', '-usesqform', '-omat', mat_file,
+                           '-out', os.path.join(tmp_dir, 'out.nii.gz')])
+            self.assertTrue(np.allclose(
+                header_transform_matrix(self.image, self.reference),
+                np.loadtxt(mat_file), atol=1e-4))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def rigid_matrix(angles, translation):
+    "Rotation about the x, y and z axes followed by a translation"
+    matrix = np.eye(4)
+    for axis, angle in enumerate(angles):
+        i, j = [a for a in range(3) if a != axis]
+        rot = np.eye(4)
+        rot[i, i] = rot[j, j] = np.cos(angle)
+        rot[i, j], rot[j, i] = -np.sin(angle), np.sin(angle)
+        matrix = rot.dot(matrix)
+    matrix[:3, 3] = translation
+    return matrix
+
+
+class TestApplyTransformChain(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        # A linear ramp, which trilinear interpolation reproduces exactly so
+        # resampling it once or twice only differs at the edges of the FOV
+        image = oblique_image(shape=(24, 30, 20))
+        indices = np.indices(image.shape).astype(np.float32)
+        data = 100.0 + 2.0 * indices[0] - 1.5 * indices[1] + indices[2]
+        self.image = nib.Nifti1Image(data, image.affine)
+        inter_affine = np.diag([1.5, 1.5, 1.5, 1.0])
+        inter_affine[:3, 3] = (-15.0, -20.0, -15.0)
+        self.intermediate = nib.Nifti1Image(
+            np.zeros((22, 26, 22), dtype=np.float32), inter_affine)
+        ref_affine = np.diag([-2.0, 2.0, 2.0, 1.0])
+        ref_affine[:3, 3] = (10.0, -14.0, -10.0)
+        self.reference = nib.Nifti1Image(
+            np.zeros((12, 14, 12), dtype=np.float32), ref_affine)
+        # Small rigid misalignments on top of the header transforms
+        self.matrices = [
+            rigid_matrix((0.05, -0.03, 0.08), (1.0, -0.5, 0.7)).dot(
+                header_transform_matrix(self.image, self.intermediate)),
+            rigid_matrix((-0.04, 0.06, 0.02), (-0.8, 0.4, 1.2)).dot(
+                header_transform_matrix(self.intermediate, self.reference))]
+        self.paths = {}
+        for name, image in (('in', self.image),
+                            ('intermediate', self.intermediate),
+                            ('reference', self.reference)):
+            self.paths[name] = os.path.join(self.tmp_dir, name + '.nii.gz')
+            nib.save(image, self.paths[name])
+        self.mat_files = []
+        for i, matrix in enumerate(self.matrices):
+            self.mat_files.append(
+                os.path.join(self.tmp_dir, 'flirt{}.mat'.format(i)))
+            np.savetxt(self.mat_files[-1], matrix)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _chain(self, **kwargs):
+        result = ApplyTransformChain(
+            in_file=self.paths['in'], reference=self.paths['reference'],
+            flirt_matrices=self.mat_files,
+            flirt_references=[self.paths['intermediate'],
+                              self.paths['reference']], **kwargs).run()
+        return nib.load(result.outputs.out_file).get_fdata()
+
+    def _sequential(self):
+        "Applies each of the FLIRT matrices as a separate resampling"
+        image = self.image
+        for matrix, reference in zip(self.matrices,
+                                     (self.intermediate, self.reference)):
+            resampled = resample_to_reference(
+                image, reference,
+                transform=flirt_world_matrix(matrix, image, reference))
+            image = nib.Nifti1Image(resampled, reference.affine)
+        return image.get_fdata()
+
+    def test_world_matrix(self):
+        # The header transform corresponds to an identity in world space
+        self.assertTrue(np.allclose(flirt_world_matrix(
+            header_transform_matrix(self.image, self.reference), self.image,
+            self.reference), np.eye(4)))
+
+    def test_single_resampling(self):
+        chained = self._chain()
+        sequential = self._sequential()
+        self.assertEqual(chained.shape, self.reference.shape)
+        # Compare away from the edges of the FOV of either step
+        inside = binary_erosion((chained > 0) & (sequential > 0),
+                                iterations=2)
+        self.assertGreater(inside.sum(), 100)
+        self.assertTrue(np.allclose(chained[inside], sequential[inside],
+                                    atol=1e-3))
+
+    def test_crop_matrix(self):
+        data = np.asanyarray(self.image.dataobj)
+        cropped_affine = self.image.affine.copy()
+        cropped_affine[:3, 3] += (3.0, -2.0, 5.0)  # Arbitrary header offset
+        cropped = nib.Nifti1Image(data[4:20, 5:25, 2:18], cropped_affine)
+        nib.save(cropped, self.paths['reference'])
+        np.savetxt(self.mat_files[0],
+                   crop_matrix(self.image, cropped, (4, 5, 2)))
+        result = ApplyTransformChain(
+            in_file=self.paths['in'], reference=self.paths['reference'],
+            flirt_matrices=self.mat_files[:1],
+            flirt_references=[self.paths['reference']]).run()
+        self.assertTrue(np.allclose(
+            nib.load(result.outputs.out_file).get_fdata(),
+            data[4:20, 5:25, 2:18], atol=1e-3))
+
+    def test_itk_affine(self):
+        world = rigid_matrix((0.1, 0.2, -0.3), (5.0, -3.0, 2.0))
+        path = write_itk_affine(world, os.path.join(self.tmp_dir, 'a.txt'))
+        with open(path) as f:
+            params = [np.array(line.split(':')[1].split(), dtype=float)
+                      for line in f if line.startswith('Parameters:')][0]
+        # Maps fixed (reference) points onto moving points in LPS
+        ras2lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+        point = np.array([10.0, -20.0, 30.0, 1.0])
+        moved = ras2lps.dot(np.linalg.inv(world)).dot(point)
+        lps = ras2lps.dot(point)
+        self.assertTrue(np.allclose(
+            params[:9].reshape(3, 3).dot(lps[:3]) + params[9:], moved[:3]))
+
+    @skipUnless(shutil.which('antsApplyTransforms'),
+                "ANTs is required to apply chains with ANTs transforms")
+    def test_ants_chain(self):
+        identity = write_itk_affine(
+            np.eye(4), os.path.join(self.tmp_dir, 'identity.txt'))
+        in_process = self._chain()
+        ants = self._chain(transforms=[identity])
+        inside = binary_erosion(in_process > 0, iterations=2)
+        self.assertTrue(np.allclose(ants[inside], in_process[inside],
+                                    atol=1e-2))
+
+    @skipUnless(shutil.which('flirt'),
+                "FSL is required to compare against 'flirt -applyxfm'")
+    def test_equivalent_to_flirt(self):
+        in_file = self.paths['in']
+        for mat_file, ref in zip(self.mat_files, ('intermediate',
+                                                  'reference')):
+            out_file = os.path.join(self.tmp_dir, ref + '_flirt.nii.gz')
+            sp.check_call(['flirt', '-in', in_file, '-ref', self.paths[ref],
+                           '-applyxfm', '-init', mat_file, '-out', out_file,
+                           '-interp', 'trilinear'])
+            in_file = out_file
+        flirted = nib.load(in_file).get_fdata()
+        chained = self._chain()
+        inside = binary_erosion((chained > 0) & (flirted > 0), iterations=2)
+        self.assertTrue(np.allclose(chained[inside], flirted[inside],
+                                    atol=1e-2))
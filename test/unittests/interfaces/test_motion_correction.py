@@ -0,0 +1,128 @@
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ImplicitVRLittleEndian
+from nianalysis.interfaces.custom.motion_correction import (
+    motion_parameters_to_affines, phase_encoding_directions, topup_encoding,
+    dicom_orientation, ReorientUmap)
+
+
+def reference_affine(mp, cog):
+    "Per-volume construction of the affine (rotating about the centre)"
+    T = np.eye(4)
+    T[:3, 3] = cog
+    rx, ry, rz = mp[3:6]
+    Rx = np.array([[1, 0, 0],
+                   [0, np.cos(rx), np.sin(rx)],
+                   [0, -np.sin(rx), np.cos(rx)]])
+    Ry = np.array([[np.cos(ry), 0, -np.sin(ry)],
+                   [0, 1, 0],
+                   [np.sin(ry), 0, np.cos(ry)]])
+    Rz = np.array([[np.cos(rz), np.sin(rz), 0],
+                   [-np.sin(rz), np.cos(rz), 0],
+                   [0, 0, 1]])
+    m = np.eye(4)
+    m[:3, :3] = Rx.dot(Ry).dot(Rz)
+    m[:3, 3] = mp[:3]
+    m[:3, 3] = T.dot(m).dot(np.linalg.inv(T))[:3, 3]
+    return m
+
+
+class TestAffineMatrixGeneration(TestCase):
+
+    def test_batched_affines(self):
+        rng = np.random.RandomState(0)
+        motion_par = np.column_stack([rng.normal(0, 2, (300, 3)),
+                                      rng.normal(0, 0.1, (300, 3))])
+        centre = np.array([45.2, 60.7, 30.1])
+        affines = motion_parameters_to_affines(motion_par, centre)
+        self.assertEqual(affines.shape, (300, 4, 4))
+        for mp, affine in zip(motion_par, affines):
+            self.assertTrue(np.allclose(affine, reference_affine(mp, centre)))
+
+
+class TestPrepareDWI(TestCase):
+
+    def test_phase_encoding_directions(self):
+        self.assertEqual(phase_encoding_directions('ROW', '1'),
+                         ('RL', 'LR'))
+        self.assertEqual(phase_encoding_directions('COL', '-1'),
+                         ('PA', 'AP'))
+        self.assertRaises(Exception, phase_encoding_directions, 'SLC', '1')
+
+    def test_topup_encoding(self):
+        self.assertTrue(np.array_equal(
+            topup_encoding('AP', 0.1, num_reverse=2),
+            [[0, -1, 0, 0.1], [0, 1, 0, 0.1], [0, 1, 0, 0.1]]))
+        self.assertTrue(np.array_equal(
+            topup_encoding('LR', 0.05),
+            [[1, 0, 0, 0.05], [-1, 0, 0, 0.05]]))
+
+
+def write_umap_dicom(dicom_dir, orientation):
+    "Writes a single (pixel-less) DICOM header with the given orientation"
+    os.makedirs(dicom_dir)
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.4.1'
+    meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    path = os.path.join(dicom_dir, '0.dcm')
+    dcm = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    dcm.ImageOrientationPatient = orientation
+    dcm.save_as(path)
+
+
+class TestReorientUmap(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_dicom_orientation(self):
+        for name, iop, codes in (('axial', [1, 0, 0, 0, 1, 0],
+                                  ('L', 'P', 'S')),
+                                 ('sagittal', [0, 1, 0, 0, 0, -1],
+                                  ('P', 'I', 'R'))):
+            dicom_dir = os.path.join(self.tmp_dir, name)
+            write_umap_dicom(dicom_dir, iop)
+            self.assertEqual(
+                nib.orientations.ornt2axcodes(dicom_orientation(dicom_dir)),
+                codes)
+
+    def test_reorient(self):
+        umap_dir = os.path.join(self.tmp_dir, 'umap')
+        write_umap_dicom(umap_dir, [1, 0, 0, 0, 1, 0])
+        rng = np.random.RandomState(0)
+        ras = nib.Nifti1Image(rng.rand(6, 5, 4).astype(np.float32),
+                              np.diag([2.0, 2.0, 3.0, 1.0]))
+        lps = ras.as_reoriented(nib.orientations.axcodes2ornt('LPS'))
+        niftis = []
+        for name, image in (('ras', ras), ('lps', lps)):
+            niftis.append(os.path.join(self.tmp_dir, name + '.nii.gz'))
+            nib.save(image, niftis[-1])
+        work_dir = os.path.join(self.tmp_dir, 'work')
+        os.makedirs(work_dir)
+        os.chdir(work_dir)
+        result = ReorientUmap(umap=umap_dir, niftis=niftis,
+                              num_threads=2).run()
+        self.assertEqual(
+            [os.path.basename(f) for f in result.outputs.reoriented_umaps],
+            ['lps_reorient.nii.gz', 'ras_reorient.nii.gz'])
+        for path in result.outputs.reoriented_umaps:
+            reoriented = nib.load(path)
+            self.assertEqual(nib.aff2axcodes(reoriented.affine),
+                             ('L', 'P', 'S'))
+            # Voxels are only transposed/flipped, so the world coordinates
+            # of the data are unchanged
+            self.assertTrue(np.allclose(reoriented.affine, lps.affine))
+            self.assertTrue(np.array_equal(reoriented.get_fdata(),
+                                           lps.get_fdata()))
@@ -0,0 +1,95 @@
+import os
+import os.path
+import stat
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from nianalysis.interfaces.ants import AntsRegSyn
+
+
+# Stands in for antsRegistrationSyN.sh, writing out placeholder outputs and
+# recording each time it is run
+FAKE_REG_SCRIPT = """#!/bin/sh
+while getopts "d:m:f:o:t:n:r:s:x:p:j:" opt; do
+    case $opt in
+        o) prefix=$OPTARG;;
+    esac
+done
+echo "$prefix" >> {counter}
+for suffix in _0GenericAffine.mat .nii.gz _1Warp.nii.gz _1InverseWarp.nii.gz
+do
+    echo "$prefix$suffix" > "$prefix$suffix"
+done
+"""
+
+
+class TestRegistrationCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.counter = os.path.join(self.tmp_dir, 'counter.txt')
+        self.script = os.path.join(self.tmp_dir, 'fake_reg.sh')
+        with open(self.script, 'w') as f:
+            f.write(FAKE_REG_SCRIPT.format(counter=self.counter))
+        os.chmod(self.script, os.stat(self.script).st_mode | stat.S_IEXEC)
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _image(self, name, seed):
+        path = os.path.join(self.tmp_dir, name)
+        data = np.random.RandomState(seed).rand(8, 8, 8).astype('float32')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+        return path
+
+    def _register(self, in_file, ref_file, work_dir, **kwargs):
+        os.makedirs(work_dir)
+        os.chdir(work_dir)
+        reg = AntsRegSyn(input_file=in_file, ref_file=ref_file,
+                         num_dimensions=3, transformation='s',
+                         out_prefix='reg', cache_dir=self.cache_dir,
+                         **kwargs)
+        reg._cmd = self.script
+        return reg.run().outputs
+
+    def _num_runs(self):
+        if not os.path.exists(self.counter):
+            return 0
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def test_cache_hit(self):
+        in_file = self._image('in.nii.gz', 0)
+        ref_file = self._image('ref.nii.gz', 1)
+        self._register(in_file, ref_file,
+                       os.path.join(self.tmp_dir, 'first'))
+        self.assertEqual(self._num_runs(), 1)
+        # Copies of the same images at different paths should hit the cache
+        in_copy = os.path.join(self.tmp_dir, 'in_copy.nii.gz')
+        shutil.copy(in_file, in_copy)
+        outputs = self._register(in_copy, ref_file,
+                                 os.path.join(self.tmp_dir, 'second'))
+        self.assertEqual(self._num_runs(), 1)
+        for out_file in (outputs.regmat, outputs.reg_file,
+                         outputs.warp_file, outputs.inv_warp):
+            self.assertTrue(os.path.exists(out_file))
+            self.assertTrue(out_file.startswith(
+                os.path.join(self.tmp_dir, 'second')))
+
+    def test_cache_miss(self):
+        in_file = self._image('in.nii.gz', 0)
+        ref_file = self._image('ref.nii.gz', 1)
+        self._register(in_file, ref_file,
+                       os.path.join(self.tmp_dir, 'first'))
+        # Different parameters
+        self._register(in_file, ref_file,
+                       os.path.join(self.tmp_dir, 'second'), radius=2.0)
+        # Different image contents
+        self._register(self._image('other.nii.gz', 2), ref_file,
+                       os.path.join(self.tmp_dir, 'third'))
+        self.assertEqual(self._num_runs(), 3)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import os.path
+import shutil
 from nipype import config
 config.enable_debug_mode()
 from arcana.dataset import DatasetMatch  # @IgnorePep8
@@ -7,7 +8,7 @@ from nianalysis.study.mri.structural.diffusion import (  # @IgnorePep8
     DiffusionStudy, NODDIStudy)
 from nianalysis.file_format import (  # @IgnorePep8
     mrtrix_format, nifti_gz_format, fsl_bvals_format, fsl_bvecs_format,
-    text_format)
+    text_format, eddy_par_format)
 from nianalysis.testing import BaseTestCase, BaseMultiSubjectTestCase  # @IgnorePep8 @Reimport
 
 
@@ -21,6 +22,22 @@ class TestDiffusion(BaseTestCase):
         preproc = study.data('preproc')[0]
         self.assertTrue(os.path.exists(preproc.path))
 
+    def test_topup_reused(self):
+        inputs = [
+            DatasetMatch('primary', mrtrix_format, 'r_l_dwi_b700_30'),
+            DatasetMatch('dwi_reference', mrtrix_format, 'l_r_dwi_b0_6')]
+        study = self.create_study(DiffusionStudy, 'topup', inputs)
+        study.data('preproc')
+        fieldcoef = self.output_file_path('topup_fieldcoef.nii.gz',
+                                          study.name)
+        mtime = os.path.getmtime(fieldcoef)
+        # Rerunning the preprocessing should reuse the estimated field
+        os.remove(self.output_file_path('preproc.nii.gz', study.name))
+        study = self.create_study(DiffusionStudy, 'topup', inputs)
+        study.data('preproc')
+        self.assertDatasetCreated('preproc.nii.gz', study.name)
+        self.assertEqual(os.path.getmtime(fieldcoef), mtime)
+
     def test_extract_b0(self):
         study = self.create_study(
             DiffusionStudy, 'extract_b0', [
@@ -30,6 +47,18 @@ class TestDiffusion(BaseTestCase):
         study.extract_b0_pipeline().run(work_dir=self.work_dir)
         self.assertDatasetCreated('primary.nii.gz', study.name)
 
+    def test_qc(self):
+        study = self.create_study(
+            DiffusionStudy, 'qc', [
+                DatasetMatch('preproc', nifti_gz_format, 'preproc'),
+                DatasetMatch('bvalues', fsl_bvals_format, 'bvalues'),
+                DatasetMatch('brain_mask', nifti_gz_format, 'brain_mask'),
+                DatasetMatch('fa', nifti_gz_format, 'fa'),
+                DatasetMatch('adc', nifti_gz_format, 'adc'),
+                DatasetMatch('eddy_par', eddy_par_format, 'eddy_par')])
+        study.qc_pipeline().run(work_dir=self.work_dir)
+        self.assertDatasetCreated('dwi_qc.json', study.name)
+
     def test_bias_correct(self):
         study = self.create_study(
             DiffusionStudy, 'bias_correct', [
@@ -102,10 +131,48 @@ class TestMultiSubjectDiffusion(BaseMultiSubjectTestCase):
             DiffusionStudy, 'response', {
                 DatasetMatch('response', text_format, 'response')})
         study.average_response_pipeline().run(work_dir=self.work_dir)
-        for subject_id in self.subject_ids:
+        for name in ('avg_response.txt', 'fod_response.txt',
+                     'avg_response_state.json'):
+            self.assertDatasetCreated(name, study.name,
+                                      frequency='per_project')
+
+    def test_tbss_incremental(self):
+        tbss_inputs = [DatasetMatch('fa', nifti_gz_format, 'fa')]
+        project_outputs = ('tbss_mean_fa', 'tbss_proj_fa', 'tbss_skeleton',
+                           'tbss_skeleton_mask')
+        # Hold back one subject to add to the project after the first run
+        subject_ids = sorted(self.subject_ids)
+        added_subject = subject_ids.pop()
+        held_back_dir = os.path.join(self.work_dir, 'held_back')
+        shutil.move(os.path.join(self.project_dir, added_subject),
+                    held_back_dir)
+        study = self.create_study(DiffusionStudy, 'tbss', tbss_inputs)
+        study.tbss_pipeline().run(work_dir=self.work_dir)
+        registered = {}
+        for subject_id in subject_ids:
             for visit_id in self.visit_ids(subject_id):
-                self.assertDatasetCreated('avg_response.txt', study.name,
-                                          subject=subject_id, visit=visit_id)
+                path = self.output_file_path(
+                    'tbss_fa_std.nii.gz', study.name, subject=subject_id,
+                    visit=visit_id)
+                registered[path] = os.path.getmtime(path)
+        # Add the subject and regenerate the project-level outputs
+        shutil.move(held_back_dir,
+                    os.path.join(self.project_dir, added_subject))
+        for name in project_outputs:
+            os.remove(self.output_file_path(name + '.nii.gz', study.name,
+                                            frequency='per_project'))
+        study = self.create_study(DiffusionStudy, 'tbss', tbss_inputs)
+        study.tbss_pipeline().run(work_dir=self.work_dir)
+        # The existing subjects should not have been registered again
+        for path, mtime in registered.items():
+            self.assertEqual(os.path.getmtime(path), mtime,
+                             "'{}' was regenerated".format(path))
+        for visit_id in self.visit_ids(added_subject):
+            self.assertDatasetCreated('tbss_fa_std.nii.gz', study.name,
+                                      subject=added_subject, visit=visit_id)
+        for name in project_outputs:
+            self.assertDatasetCreated(name + '.nii.gz', study.name,
+                                      frequency='per_project')
 
 
 class TestNODDI(BaseTestCase):
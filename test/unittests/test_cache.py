@@ -0,0 +1,252 @@
+import os
+import os.path
+import stat
+import shutil
+import tempfile
+from unittest import TestCase
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ImplicitVRLittleEndian
+from nianalysis.cache import FileCache, link, dicom_series_key
+from nianalysis.interfaces.mrtrix import MRConvert
+from nianalysis.interfaces.converters import Dcm2niix
+
+
+# Stands in for mrconvert, copying the input to the output path, writing
+# placeholder gradient tables if they are exported and recording each time
+# it is run
+FAKE_MRCONVERT_SCRIPT = """#!/bin/sh
+echo run >> {counter}
+while [ $# -gt 2 ]; do
+    if [ "$1" = "-export_grad_fsl" ]; then
+        echo bvecs > "$2"
+        echo bvals > "$3"
+        shift 2
+    fi
+    shift
+done
+ls "$1" > "$2"
+"""
+
+# Stands in for dcm2niix, writing a listing of the input directory to each of
+# two echo images named after the '-f' option and recording each time it is
+# run
+FAKE_DCM2NIIX_SCRIPT = """#!/bin/sh
+echo run >> {counter}
+while [ $# -gt 1 ]; do
+    case "$1" in
+        -f) fname="$2"; shift ;;
+        -o) out_dir="$2"; shift ;;
+    esac
+    shift
+done
+for echo in 1 2; do
+    ls "$1" > "$out_dir/${{fname}}_e$echo.nii.gz"
+done
+"""
+
+
+def write_dicom_series(dicom_dir, series_uid, num_files):
+    os.makedirs(dicom_dir)
+    for i in range(num_files):
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = '{}.{}'.format(series_uid, i)
+        meta.TransferSyntaxUID = ImplicitVRLittleEndian
+        path = os.path.join(dicom_dir, '{}.dcm'.format(i))
+        dcm = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+        dcm.SeriesInstanceUID = series_uid
+        dcm.InstanceNumber = i
+        dcm.save_as(path)
+
+
+class TestFileCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _file(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_store_fetch(self):
+        cache = FileCache(self.cache_dir)
+        self.assertIsNone(cache.fetch(('key', 1)))
+        paths = [self._file('b.txt', 10), self._file('a.txt', 20)]
+        cache.store(('key', 1), paths, names=['2.txt', '1.txt'])
+        fetched = cache.fetch(('key', 1))
+        self.assertEqual([os.path.basename(p) for p in fetched],
+                         ['1.txt', '2.txt'])
+        self.assertEqual(os.path.getsize(fetched[0]), 20)
+        self.assertIsNone(cache.fetch(('key', 2)))
+
+    def test_prune(self):
+        cache = FileCache(self.cache_dir, max_size=350)
+        for i in range(3):
+            cache.store(i, [self._file('{}.txt'.format(i), 100)])
+            # Make sure the entries have distinct access times
+            entry = cache.entry_path(i)
+            os.utime(entry, (i, i))
+        cache.fetch(0)  # Marks the first entry as recently used
+        cache.store(3, [self._file('3.txt', 100)])
+        self.assertIsNotNone(cache.fetch(0))
+        self.assertIsNone(cache.fetch(1))
+        self.assertIsNotNone(cache.fetch(2))
+        self.assertIsNotNone(cache.fetch(3))
+
+
+class TestLink(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_link(self):
+        src_dir = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(os.path.join(src_dir, 'sub'))
+        with open(os.path.join(src_dir, 'sub', 'file.txt'), 'w') as f:
+            f.write('contents')
+        dst_dir = link(src_dir, os.path.join(self.tmp_dir, 'dst'))
+        src_file = os.path.join(src_dir, 'sub', 'file.txt')
+        dst_file = os.path.join(dst_dir, 'sub', 'file.txt')
+        with open(dst_file) as f:
+            self.assertEqual(f.read(), 'contents')
+        self.assertTrue(os.path.samefile(src_file, dst_file))
+
+
+class TestDicomSeriesKey(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_key(self):
+        dicom_dir = os.path.join(self.tmp_dir, 'series')
+        write_dicom_series(dicom_dir, '1.2.3.4', 3)
+        # Hidden files and non-DICOM files are skipped
+        open(os.path.join(dicom_dir, '.hidden'), 'w').close()
+        with open(os.path.join(dicom_dir, '00_readme.txt'), 'w') as f:
+            f.write('not a dicom')
+        self.assertEqual(dicom_series_key(dicom_dir), ('1.2.3.4', 4))
+        empty_dir = os.path.join(self.tmp_dir, 'empty')
+        os.makedirs(empty_dir)
+        self.assertIsNone(dicom_series_key(empty_dir))
+
+
+class TestConversionCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.dicom_dir = os.path.join(self.tmp_dir, 'dicom')
+        write_dicom_series(self.dicom_dir, '1.2.3.4', 2)
+        self.counter = os.path.join(self.tmp_dir, 'counter.txt')
+        self.script = os.path.join(self.tmp_dir, 'fake_mrconvert.sh')
+        with open(self.script, 'w') as f:
+            f.write(FAKE_MRCONVERT_SCRIPT.format(counter=self.counter))
+        os.chmod(self.script, os.stat(self.script).st_mode | stat.S_IEXEC)
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _convert(self, work_dir, **kwargs):
+        os.makedirs(work_dir)
+        os.chdir(work_dir)
+        convert = MRConvert(in_file=self.dicom_dir, out_ext='.mif',
+                            cache_dir=self.cache_dir, **kwargs)
+        convert._cmd = self.script
+        return convert.run().outputs.out_file
+
+    def _num_runs(self):
+        if not os.path.exists(self.counter):
+            return 0
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def test_cache_hit(self):
+        first = self._convert(os.path.join(self.tmp_dir, 'first'))
+        second = self._convert(os.path.join(self.tmp_dir, 'second'))
+        self.assertEqual(self._num_runs(), 1)
+        # The cached file is copied so modifying it doesn't affect the cache
+        self.assertFalse(os.path.samefile(first, second))
+        with open(second, 'w') as f:
+            f.write('modified')
+        third = self._convert(os.path.join(self.tmp_dir, 'third'))
+        with open(first) as f1, open(third) as f3:
+            self.assertEqual(f1.read(), f3.read())
+
+    def test_key_options(self):
+        self._convert(os.path.join(self.tmp_dir, 'first'))
+        # Options that affect the outputs are part of the key
+        self._convert(os.path.join(self.tmp_dir, 'exported'),
+                      export_grad_fsl='bvecs bvals')
+        self.assertEqual(self._num_runs(), 2)
+        bvecs = os.path.join(self.tmp_dir, 'in.bvec')
+        bvals = os.path.join(self.tmp_dir, 'in.bval')
+        for path in (bvecs, bvals):
+            with open(path, 'w') as f:
+                f.write('0 1 0')
+        self._convert(os.path.join(self.tmp_dir, 'grad'),
+                      grad_fsl=(bvecs, bvals))
+        self.assertEqual(self._num_runs(), 3)
+        # The exported gradient tables are restored on a cache hit
+        work_dir = os.path.join(self.tmp_dir, 'exported_again')
+        self._convert(work_dir, export_grad_fsl='bvecs bvals')
+        self.assertEqual(self._num_runs(), 3)
+        for fname in ('bvecs', 'bvals'):
+            self.assertTrue(os.path.exists(os.path.join(work_dir, fname)))
+
+
+class TestDcm2niixConversionCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.counter = os.path.join(self.tmp_dir, 'counter.txt')
+        self.script = os.path.join(self.tmp_dir, 'fake_dcm2niix.sh')
+        with open(self.script, 'w') as f:
+            f.write(FAKE_DCM2NIIX_SCRIPT.format(counter=self.counter))
+        os.chmod(self.script, os.stat(self.script).st_mode | stat.S_IEXEC)
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _convert(self, dicom_dir, work_dir):
+        os.makedirs(work_dir)
+        os.chdir(work_dir)
+        convert = Dcm2niix(input_dir=dicom_dir, compression='y',
+                           cache_dir=self.cache_dir)
+        convert._cmd = self.script
+        return convert.run().outputs.converted
+
+    def test_renamed_series(self):
+        # The same series stored in differently named directories
+        first_dir = os.path.join(self.tmp_dir, 'project1', 't1_mprage')
+        second_dir = os.path.join(self.tmp_dir, 'project2', 'T1w')
+        write_dicom_series(first_dir, '1.2.3.4', 2)
+        write_dicom_series(second_dir, '1.2.3.4', 2)
+        first = self._convert(first_dir, os.path.join(self.tmp_dir, 'first'))
+        second = self._convert(second_dir,
+                               os.path.join(self.tmp_dir, 'second'))
+        with open(self.counter) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(os.path.basename(first), 't1_mprage_e2.nii.gz')
+        self.assertEqual(os.path.basename(second), 'T1w_e2.nii.gz')
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(second))),
+            ['T1w_e1.nii.gz', 'T1w_e2.nii.gz'])
+        with open(first) as f1, open(second) as f2:
+            self.assertEqual(f1.read(), f2.read())
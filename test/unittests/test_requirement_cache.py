@@ -0,0 +1,138 @@
+import os
+import os.path
+import stat
+import shutil
+import tempfile
+import subprocess as sp
+from unittest import TestCase
+from nipype.pipeline.engine import Workflow
+from nipype.interfaces.base import (
+    BaseInterface, BaseInterfaceInputSpec, TraitedSpec, traits)
+from nianalysis.node import Node
+from nianalysis.requirement import Requirement
+from nianalysis.cache import requirement_cache, cached_version
+
+
+# Stands in for a tool that is probed for its version, recording each time it
+# is run
+FAKE_TOOL_SCRIPT = """#!/bin/sh
+echo probe >> {counter}
+echo "faketool version 1.2.3"
+"""
+
+# Stands in for the environment modules command, recording each time the
+# available modules are listed
+FAKE_MODULECMD_SCRIPT = """#!/bin/sh
+if [ "$2" = "avail" ]; then
+    echo avail >> {counter}
+    echo "faketool/1.2.3" >&2
+fi
+"""
+
+faketool_req = Requirement('faketool', min_version=(1, 0))
+
+
+def faketool_version():
+    return sp.check_output(['faketool']).decode().split()[-1]
+
+
+class ToolVersionInputSpec(BaseInterfaceInputSpec):
+    index = traits.Int(desc="Index of the node")
+
+
+class ToolVersionOutputSpec(TraitedSpec):
+    version = traits.Str(desc="Version of the tool")
+
+
+class ToolVersion(BaseInterface):
+    "Probes the version of the tool on initialisation and when run"
+
+    input_spec = ToolVersionInputSpec
+    output_spec = ToolVersionOutputSpec
+
+    def __init__(self, **inputs):
+        super(ToolVersion, self).__init__(**inputs)
+        self._version = cached_version('faketool', faketool_version,
+                                       'faketool')
+
+    def _run_interface(self, runtime):
+        self._version = cached_version('faketool', faketool_version,
+                                       'faketool')
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['version'] = self._version
+        return outputs
+
+
+class TestRequirementCache(TestCase):
+
+    NUM_NODES = 100
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        module_dir = os.path.join(self.tmp_dir, 'modules')
+        os.makedirs(bin_dir)
+        os.makedirs(os.path.join(module_dir, 'faketool'))
+        self.tool_counter = os.path.join(self.tmp_dir, 'tool.txt')
+        self.avail_counter = os.path.join(self.tmp_dir, 'avail.txt')
+        self.tool = self._script(bin_dir, 'faketool', FAKE_TOOL_SCRIPT,
+                                 self.tool_counter)
+        self._script(bin_dir, 'modulecmd', FAKE_MODULECMD_SCRIPT,
+                     self.avail_counter)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['MODULESHOME'] = self.tmp_dir
+        os.environ['MODULEPATH'] = module_dir
+        os.environ.pop('LOADEDMODULES', None)
+        self.cache_path = requirement_cache.path
+        requirement_cache.path = os.path.join(self.tmp_dir, 'requirements.json')
+        requirement_cache.clear()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        requirement_cache.path = self.cache_path
+        requirement_cache.clear()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _script(self, dirname, name, template, counter):
+        path = os.path.join(dirname, name)
+        with open(path, 'w') as f:
+            f.write(template.format(counter=counter))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def _count(self, counter):
+        if not os.path.exists(counter):
+            return 0
+        with open(counter) as f:
+            return len(f.readlines())
+
+    def test_pipeline_probes(self):
+        workflow = Workflow('probes',
+                            base_dir=os.path.join(self.tmp_dir, 'work'))
+        for i in range(self.NUM_NODES):
+            node = Node(ToolVersion(index=i), name='node{}'.format(i),
+                        requirements=[faketool_req])
+            workflow.add_nodes([node])
+        result = workflow.run(plugin='Linear')
+        self.assertEqual(len(result.nodes()), self.NUM_NODES)
+        self.assertEqual(self._count(self.tool_counter), 1)
+        self.assertLessEqual(self._count(self.avail_counter), 1)
+
+    def test_persistent(self):
+        self.assertEqual(
+            cached_version('faketool', faketool_version, 'faketool'),
+            '1.2.3')
+        # Entries should be reloaded from disk by new processes
+        requirement_cache.clear()
+        cached_version('faketool', faketool_version, 'faketool')
+        self.assertEqual(self._count(self.tool_counter), 1)
+        # Updating the tool should invalidate the entry
+        mtime = os.stat(self.tool).st_mtime + 10
+        os.utime(self.tool, (mtime, mtime))
+        cached_version('faketool', faketool_version, 'faketool')
+        self.assertEqual(self._count(self.tool_counter), 2)